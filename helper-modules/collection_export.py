@@ -0,0 +1,230 @@
+# Export an existing face collection into reindex manifests with bounded memory.
+#
+# The notebook version (0-Data-Preparation.ipynb) keeps every face in memory, sorts the whole list
+# and writes one JSON file. This module:
+#   1. pages ListFaces on a background thread while the main thread buffers faces,
+#   2. sorts each buffer of `run_size` faces by ImageId and spills it to disk (a "run"),
+#   3. checkpoints the ListFaces NextToken after every run, so an interrupted export resumes from
+#      the last spilled page instead of starting over,
+#   4. k-way merges the runs, groups faces by ImageId and streams the records into manifest shards.
+#
+# Shards are JSON arrays with one record per line: the Step Functions ItemReader (InputType JSON)
+# and the records/*.json trigger consume them as-is, and they can be written incrementally.
+#
+#   python collection_export.py --collection-id old-collection --new-collection-id new-collection \
+#       --image-bucket photos-bucket --work-dir ./export --upload s3://ris-stack-bucket/records/
+
+import argparse, hashlib, heapq, json, os, queue, threading
+from itertools import groupby
+from urllib.parse import urlparse
+
+CHECKPOINT_FILE = "checkpoint.json"
+RUN_SIZE = 500000
+RECORDS_PER_SHARD = 250000
+PAGE_SIZE = 4096  # ListFaces MaxResults upper bound
+
+
+def load_checkpoint(work_dir, collection_id):
+    path = os.path.join(work_dir, CHECKPOINT_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint["collection_id"] != collection_id:
+            raise ValueError("{} belongs to collection {}".format(path, checkpoint["collection_id"]))
+        return checkpoint
+    return {"collection_id": collection_id, "next_token": None, "runs": [], "faces": 0, "listed": False}
+
+
+def save_checkpoint(work_dir, checkpoint):
+    # Write-then-rename so a crash never leaves a truncated checkpoint
+    path = os.path.join(work_dir, CHECKPOINT_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+
+def page_faces(rek_client, collection_id, next_token, pages):
+    # Producer: puts (faces, next_token) tuples on the queue, then None
+    try:
+        while True:
+            kwargs = {"CollectionId": collection_id, "MaxResults": PAGE_SIZE}
+            if next_token:
+                kwargs["NextToken"] = next_token
+            response = rek_client.list_faces(**kwargs)
+            next_token = response.get("NextToken")
+            pages.put((response.get("Faces", []), next_token))
+            if not next_token:
+                break
+    except Exception as e:
+        pages.put(e)
+        return
+    pages.put(None)
+
+
+def spill_run(work_dir, faces, run_number):
+    faces.sort(key=lambda face: (face["ImageId"], face["FaceId"]))
+    path = os.path.join(work_dir, "run-{:05d}.jsonl".format(run_number))
+    with open(path + ".tmp", "w") as f:
+        for face in faces:
+            f.write(json.dumps(face))
+            f.write("\n")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def list_and_spill(rek_client, collection_id, work_dir, run_size=RUN_SIZE):
+    os.makedirs(work_dir, exist_ok=True)
+    checkpoint = load_checkpoint(work_dir, collection_id)
+    if checkpoint["listed"]:
+        return checkpoint
+
+    pages = queue.Queue(maxsize=8)
+    fetcher = threading.Thread(target=page_faces, args=(rek_client, collection_id, checkpoint["next_token"], pages), daemon=True)
+    fetcher.start()
+
+    buffer = []
+    while True:
+        page = pages.get()
+        if isinstance(page, Exception):
+            raise page
+        done = page is None
+        if not done:
+            faces, next_token = page
+            buffer.extend(faces)
+        # Spill on page boundaries only, so the checkpointed token matches what is on disk
+        if buffer and (done or len(buffer) >= run_size):
+            checkpoint["runs"].append(spill_run(work_dir, buffer, len(checkpoint["runs"])))
+            checkpoint["faces"] += len(buffer)
+            checkpoint["next_token"] = None if done else next_token
+            buffer = []
+            save_checkpoint(work_dir, checkpoint)
+            print("Spilled run {} -- {} faces listed".format(len(checkpoint["runs"]), checkpoint["faces"]))
+        if done:
+            break
+
+    checkpoint["listed"] = True
+    save_checkpoint(work_dir, checkpoint)
+    return checkpoint
+
+
+def read_run(path):
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def merged_faces(runs):
+    return heapq.merge(*[read_run(path) for path in runs], key=lambda face: (face["ImageId"], face["FaceId"]))
+
+
+def build_records(faces, new_collection_id, resolver):
+    # One record per ImageId. resolver(face) -> (userId, bucket, key), called once per image like
+    # getAdditionalInfo in the data preparation notebook. Resolvers with resolve_groups()
+    # (face_resolver.CachingResolver) look up whole batches of images ahead of the cursor.
+    groups = (list(image_faces) for _, image_faces in groupby(faces, key=lambda face: face["ImageId"]))
+    if hasattr(resolver, "resolve_groups"):
+        resolved = resolver.resolve_groups(groups)
+    else:
+        resolved = ((image_faces, resolver(image_faces[0])) for image_faces in groups)
+
+    for image_faces, (user_id, bucket, key) in resolved:
+        yield {
+            "Bucket": bucket,
+            "Key": key,
+            "ExternalImageId": image_faces[0].get("ExternalImageId", ""),
+            "CollectionId": new_collection_id,
+            "Faces": [
+                {
+                    "UserId": user_id,
+                    "FaceId": face["FaceId"],
+                    "ImageId": face["ImageId"],
+                    "BoundingBoxes": face["BoundingBox"]
+                }
+                for face in image_faces
+            ]
+        }
+
+
+def write_shards(records, work_dir, records_per_shard=RECORDS_PER_SHARD, prefix="solution_records"):
+    shards = []
+    f = None
+    count = 0
+    for record in records:
+        if f is None or count == records_per_shard:
+            if f is not None:
+                f.write("\n]\n")
+                f.close()
+            path = os.path.join(work_dir, "{}-{:05d}.json".format(prefix, len(shards)))
+            shards.append(path)
+            f = open(path, "w")
+            f.write("[\n")
+            count = 0
+        elif count:
+            f.write(",\n")
+        f.write(json.dumps(record))
+        count += 1
+    if f is not None:
+        f.write("\n]\n")
+        f.close()
+    return shards
+
+
+def export_collection(rek_client, collection_id, new_collection_id, work_dir, resolver,
+                      run_size=RUN_SIZE, records_per_shard=RECORDS_PER_SHARD):
+    checkpoint = list_and_spill(rek_client, collection_id, work_dir, run_size)
+    records = build_records(merged_faces(checkpoint["runs"]), new_collection_id, resolver)
+    shards = write_shards(records, work_dir, records_per_shard)
+    print("Exported {} faces into {} manifest shards".format(checkpoint["faces"], len(shards)))
+    return shards
+
+
+def upload_shards(s3_client, shards, location):
+    parsed = urlparse(location)
+    prefix = parsed.path.lstrip("/")
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    for path in shards:
+        key = prefix + os.path.basename(path)
+        # Every new object in the records/ folder starts a job: a shard already uploaded with the
+        # same content (e.g. by an interrupted run) is not uploaded again
+        with open(path, "rb") as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+        try:
+            uploaded = s3_client.head_object(Bucket=parsed.netloc, Key=key).get("Metadata", {}).get("shard-md5")
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+                raise
+            uploaded = None
+        if uploaded == digest:
+            print("Skipping s3://{}/{}, already uploaded".format(parsed.netloc, key))
+            continue
+        s3_client.upload_file(path, parsed.netloc, key, ExtraArgs={"Metadata": {"shard-md5": digest}})
+        print("Uploaded s3://{}/{}".format(parsed.netloc, key))
+
+
+def main():
+    import boto3
+
+    parser = argparse.ArgumentParser(description="Export a Rekognition collection into sharded reindex manifests")
+    parser.add_argument("--collection-id", required=True)
+    parser.add_argument("--new-collection-id", required=True)
+    parser.add_argument("--image-bucket", required=True, help="Bucket holding the original images, keyed by ExternalImageId")
+    parser.add_argument("--work-dir", default="export")
+    parser.add_argument("--run-size", type=int, default=RUN_SIZE, help="Faces held in memory before spilling a sorted run")
+    parser.add_argument("--records-per-shard", type=int, default=RECORDS_PER_SHARD)
+    parser.add_argument("--upload", help="s3:// prefix to upload the shards to, e.g. the stack's records/ folder")
+    args = parser.parse_args()
+
+    # Same fallback as the notebook: the image key is the ExternalImageId. Replace with your own
+    # mapping (see getAdditionalInfo) if that does not hold for your collection.
+    def resolver(face):
+        return "", args.image_bucket, face["ExternalImageId"]
+
+    shards = export_collection(boto3.client("rekognition"), args.collection_id, args.new_collection_id,
+                               args.work_dir, resolver, args.run_size, args.records_per_shard)
+    if args.upload:
+        upload_shards(boto3.client("s3"), shards, args.upload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# Verify a migrated collection against the old one and the ReIndexResults table.
+#
+# After a migration every face of the old collection should have an item in the results table (keyed
+# by OldFaceId) whose FaceId is a face of the new collection, and every face of the new collection
+# should be referenced by one of those items. This module reads the three sources concurrently
+# (ListFaces of each collection on its own thread, the table as a parallel Scan), hash-partitions the
+# rows by ExternalImageId and joins one partition at a time. Rows are buffered in memory and, once
+# --memory-rows are buffered, appended to one file per source and partition, so the join of a 20M face
+# collection holds one partition at a time; small collections never touch the disk. It reports
+#   - missing mapping:    a face of the old collection without an item in the results table,
+#   - not reindexed:      an old face stored as "Not reindexed" (the image had fewer faces than expected),
+#   - missing new face:   an item whose FaceId is not in the new collection,
+#   - unmapped new face:  a face of the new collection no item refers to,
+#   - duplicate index:    unmapped new faces of an extra ImageId of an image whose other faces are
+#                         mapped (the image was indexed more than once),
+#   - shared new face:    a new face several old faces are mapped to,
+#   - orphan mapping:     an item whose new face exists but whose OldFaceId is not in the old collection,
+# in issues.jsonl, and the images whose face count differs between the collections in deltas.jsonl.
+# Items that match neither collection belong to other migrations sharing the table and are only
+# counted. The join key is the ExternalImageId: the manifest must carry the ExternalImageId of the old
+# faces, as collection_export.py writes it.
+#
+# ListFaces pages through a collection one call at a time, so the run takes about as long as listing
+# the larger collection (20M faces are ~4900 calls of 4096 faces): the other collection and the table
+# are read meanwhile, and the join itself is a few minutes.
+#
+#   python collection_verify.py --collection-id old-collection --new-collection-id new-collection \
+#       --results-table RIS-stack-ReIndexResults --work-dir ./verify
+
+import argparse, json, os, shutil, time, zlib
+
+from collection_export import PAGE_SIZE
+from failure_replay import stream
+
+OLD, NEW, MAPPING = "old", "new", "mapping"
+SOURCES = (OLD, NEW, MAPPING)
+PARTITIONS = 256
+MEMORY_ROWS = 2000000  # rows buffered across all partitions before they are spilled
+SCAN_SEGMENTS = 16
+MAX_RETRIES = 8
+THROTTLING_ERRORS = {"ThrottlingException", "ProvisionedThroughputExceededException", "LimitExceededException"}
+NOT_REINDEXED = "Not reindexed"
+NEW_FACE_PREFIX = "NewFace-"
+ISSUES_FILE = "issues.jsonl"
+DELTAS_FILE = "deltas.jsonl"
+
+
+def call_with_retry(function, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return function(**kwargs)
+        except Exception as e:
+            code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if code not in THROTTLING_ERRORS or attempt == MAX_RETRIES:
+                raise
+            time.sleep(min(10.0, 0.2 * (2 ** attempt)))
+
+
+def list_collection(rek_client, collection_id, source):
+    # Rows are [FaceId, ImageId, ExternalImageId]
+    next_token = None
+    while True:
+        kwargs = {"CollectionId": collection_id, "MaxResults": PAGE_SIZE}
+        if next_token:
+            kwargs["NextToken"] = next_token
+        response = call_with_retry(rek_client.list_faces, **kwargs)
+        yield [(source, [face["FaceId"], face.get("ImageId", ""), face.get("ExternalImageId", "")])
+               for face in response.get("Faces", [])]
+        next_token = response.get("NextToken")
+        if not next_token:
+            return
+
+
+def scan_results_segment(dynamodb_client, table_name, segment, total_segments):
+    # Rows are [OldFaceId, FaceId, ExternalImageId]
+    paginator = dynamodb_client.get_paginator("scan")
+    for page in paginator.paginate(TableName=table_name, Segment=segment, TotalSegments=total_segments,
+                                   ProjectionExpression="OldFaceId, FaceId, ExternalImageId"):
+        yield [(MAPPING, [item["OldFaceId"]["S"], item.get("FaceId", {}).get("S", ""),
+                          item.get("ExternalImageId", {}).get("S", "")]) for item in page["Items"]]
+
+
+def verify_tasks(rek_client, dynamodb_client, collection_id, new_collection_id, table_name, total_segments=SCAN_SEGMENTS):
+    tasks = [lambda: list_collection(rek_client, collection_id, OLD),
+             lambda: list_collection(rek_client, new_collection_id, NEW)]
+    return tasks + [lambda segment=segment: scan_results_segment(dynamodb_client, table_name, segment, total_segments)
+                    for segment in range(total_segments)]
+
+
+class Partitions:
+    # Rows of every source hash-partitioned by ExternalImageId (the last column), in memory until
+    # memory_rows are buffered, then appended to <work_dir>/partitions/<source>-<partition>.jsonl
+
+    def __init__(self, work_dir, partitions=PARTITIONS, memory_rows=MEMORY_ROWS):
+        self.path = os.path.join(work_dir, "partitions")
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.partitions = partitions
+        self.memory_rows = memory_rows
+        self.buffers = {source: [[] for _ in range(partitions)] for source in SOURCES}
+        self.buffered = 0
+        self.spills = 0
+        self.rows = {source: 0 for source in SOURCES}
+
+    def file(self, source, partition):
+        return os.path.join(self.path, "{}-{:05d}.jsonl".format(source, partition))
+
+    def add(self, source, row):
+        self.buffers[source][zlib.crc32(row[2].encode("utf-8")) % self.partitions].append(row)
+        self.rows[source] += 1
+        self.buffered += 1
+        if self.buffered >= self.memory_rows:
+            self.spill()
+
+    def spill(self):
+        os.makedirs(self.path, exist_ok=True)
+        for source, buffers in self.buffers.items():
+            for partition, rows in enumerate(buffers):
+                if rows:
+                    with open(self.file(source, partition), "a") as f:
+                        f.write("".join(json.dumps(row) + "\n" for row in rows))
+                    buffers[partition] = []
+        self.buffered = 0
+        self.spills += 1
+
+    def load(self, partition):
+        # {source: rows} of one partition, spilled rows first
+        loaded = {}
+        for source in SOURCES:
+            rows = []
+            path = self.file(source, partition)
+            if os.path.exists(path):
+                with open(path) as f:
+                    # One decode for the whole file instead of one per line
+                    rows = json.loads("[" + ",".join(f.read().splitlines()) + "]")
+            loaded[source] = rows + self.buffers[source][partition]
+            self.buffers[source][partition] = []
+        return loaded
+
+
+def join_partition(rows):
+    # Returns the issues, the per-image face counts {ExternalImageId: [old, new]} and the items of
+    # other collections
+    old = {face_id: (image_id, external_id) for face_id, image_id, external_id in rows[OLD]}
+    new = {face_id: (image_id, external_id) for face_id, image_id, external_id in rows[NEW]}
+    mapped_old, mapped_new = set(), {}
+    issues = []
+    unrelated = 0
+    for old_face_id, face_id, external_id in rows[MAPPING]:
+        known = old_face_id in old
+        if face_id not in new:
+            if not known:
+                unrelated += 1
+            elif face_id == NOT_REINDEXED:
+                mapped_old.add(old_face_id)
+                issues.append({"issue": "not reindexed", "ExternalImageId": external_id, "OldFaceId": old_face_id})
+            else:
+                mapped_old.add(old_face_id)
+                issues.append({"issue": "missing new face", "ExternalImageId": external_id, "OldFaceId": old_face_id, "FaceId": face_id})
+            continue
+        if known:
+            mapped_old.add(old_face_id)
+        elif not old_face_id.startswith(NEW_FACE_PREFIX):
+            issues.append({"issue": "orphan mapping", "ExternalImageId": external_id, "OldFaceId": old_face_id, "FaceId": face_id})
+        mapped_new.setdefault(face_id, []).append(old_face_id)
+
+    for face_id, (image_id, external_id) in old.items():
+        if face_id not in mapped_old:
+            issues.append({"issue": "missing mapping", "ExternalImageId": external_id, "OldFaceId": face_id, "OldImageId": image_id})
+    for face_id, old_face_ids in mapped_new.items():
+        if len(old_face_ids) > 1:
+            issues.append({"issue": "shared new face", "ExternalImageId": new[face_id][1], "FaceId": face_id, "OldFaceIds": sorted(old_face_ids)})
+
+    # An unmapped face is a duplicate index when its image was indexed again under another ImageId
+    mapped_images = {new[face_id] for face_id in mapped_new}
+    mapped_external_ids = {external_id for _, external_id in mapped_images}
+    counts = {}
+    for face_id, (image_id, external_id) in new.items():
+        counts.setdefault(external_id, [0, 0])[1] += 1
+        if face_id in mapped_new:
+            continue
+        duplicate = external_id in mapped_external_ids and (image_id, external_id) not in mapped_images
+        issues.append({"issue": "duplicate index" if duplicate else "unmapped new face", "ExternalImageId": external_id,
+                       "FaceId": face_id, "ImageId": image_id})
+    for image_id, external_id in old.values():
+        counts.setdefault(external_id, [0, 0])[0] += 1
+    return issues, counts, unrelated
+
+
+class CollectionVerification:
+
+    def __init__(self, work_dir, partitions=PARTITIONS, memory_rows=MEMORY_ROWS):
+        self.work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+        self.partitions = Partitions(work_dir, partitions, memory_rows)
+        self.issues = {}  # issue -> count
+        self.images = 0
+        self.deltas = 0
+        self.unrelated = 0
+
+    def collect(self, rows):
+        for source, row in rows:
+            self.partitions.add(source, row)
+
+    def verify(self):
+        # Joins the partitions one at a time and writes the issues and the per-image count deltas
+        with open(os.path.join(self.work_dir, ISSUES_FILE), "w") as issues, \
+                open(os.path.join(self.work_dir, DELTAS_FILE), "w") as deltas:
+            for partition in range(self.partitions.partitions):
+                found, counts, unrelated = join_partition(self.partitions.load(partition))
+                for issue in found:
+                    self.issues[issue["issue"]] = self.issues.get(issue["issue"], 0) + 1
+                    issues.write(json.dumps(issue) + "\n")
+                self.images += len(counts)
+                self.unrelated += unrelated
+                for external_id, (old, new) in counts.items():
+                    if old != new:
+                        self.deltas += 1
+                        deltas.write(json.dumps({"ExternalImageId": external_id, "OldFaces": old, "NewFaces": new,
+                                                 "Delta": new - old}) + "\n")
+        shutil.rmtree(self.partitions.path, ignore_errors=True)
+        return self.issues
+
+    def summary(self):
+        rows = self.partitions.rows
+        lines = ["{} old faces, {} new faces, {} results items ({} of other collections), {} spills".format(
+            rows[OLD], rows[NEW], rows[MAPPING], self.unrelated, self.partitions.spills),
+            "{} images, {} with a different face count".format(self.images, self.deltas)]
+        for issue, count in sorted(self.issues.items(), key=lambda entry: -entry[1]):
+            lines.append("  {:<20}{:>10}".format(issue, count))
+        if not self.issues:
+            lines.append("  no issues")
+        return "\n".join(lines)
+
+
+def verify_collection(rek_client, dynamodb_client, collection_id, new_collection_id, table_name, work_dir,
+                      total_segments=SCAN_SEGMENTS, partitions=PARTITIONS, memory_rows=MEMORY_ROWS):
+    verification = CollectionVerification(work_dir, partitions, memory_rows)
+    tasks = verify_tasks(rek_client, dynamodb_client, collection_id, new_collection_id, table_name, total_segments)
+    verification.collect(stream(tasks, len(tasks)))
+    verification.verify()
+    return verification
+
+
+def main():
+    import boto3
+    from botocore.config import Config
+
+    parser = argparse.ArgumentParser(description="Verify a migrated collection against the old one and the results table")
+    parser.add_argument("--collection-id", required=True, help="Collection the faces were migrated from")
+    parser.add_argument("--new-collection-id", required=True)
+    parser.add_argument("--results-table", required=True, help="ReIndexResults table of the stack")
+    parser.add_argument("--segments", type=int, default=SCAN_SEGMENTS, help="Parallel Scan segments of the results table")
+    parser.add_argument("--partitions", type=int, default=PARTITIONS)
+    parser.add_argument("--memory-rows", type=int, default=MEMORY_ROWS, help="Rows held in memory before spilling the partitions")
+    parser.add_argument("--work-dir", default="verify")
+    parser.add_argument("--region")
+    args = parser.parse_args()
+
+    session = boto3.Session(region_name=args.region)
+    config = Config(max_pool_connections=args.segments + 2, retries={"mode": "adaptive"})
+    verification = verify_collection(session.client("rekognition", config=config), session.client("dynamodb", config=config),
+                                     args.collection_id, args.new_collection_id, args.results_table, args.work_dir,
+                                     args.segments, args.partitions, args.memory_rows)
+    print(verification.summary())
+    print("Issues in {}, per-image face count deltas in {}".format(os.path.join(args.work_dir, ISSUES_FILE),
+                                                                   os.path.join(args.work_dir, DELTAS_FILE)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Batched, cached and prefetched lookups of the additional information (UserId, Bucket, Key)
+# that getAdditionalInfo returns for a face.
+#
+# `bulk_lookup(face_ids)` is your mapping: it receives up to `batch_size` FaceIds and returns a
+# dict {FaceId: (userId, bucket, key)}. CachingResolver keeps an LRU cache with a TTL in front of
+# it, and resolve_groups() looks up batches ahead of the streaming cursor on a thread pool so the
+# record builder rarely waits on the remote mapping.
+#
+#   resolver = CachingResolver(my_bulk_lookup, batch_size=1000, workers=8)
+#   export_collection(rek_client, old_collection, new_collection, "export", resolver)
+
+import threading, time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LRUCache:
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < self.clock():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class CachingResolver:
+
+    def __init__(self, bulk_lookup, batch_size=1000, cache_size=100000, ttl=3600, workers=4, prefetch_batches=8):
+        self.bulk_lookup = bulk_lookup
+        self.batch_size = batch_size
+        self.cache = LRUCache(cache_size, ttl)
+        self.workers = workers
+        self.prefetch_batches = prefetch_batches
+        self.lookups = 0
+
+    def fetch(self, face_ids):
+        # Resolve a batch: cached ids are served locally, the rest in one bulk call
+        resolved = {}
+        missing = []
+        for face_id in face_ids:
+            value = self.cache.get(face_id)
+            if value is None:
+                missing.append(face_id)
+            else:
+                resolved[face_id] = value
+        if missing:
+            self.lookups += 1
+            found = self.bulk_lookup(missing)
+            for face_id in missing:
+                if face_id not in found:
+                    raise KeyError("No additional info found for FaceId {}".format(face_id))
+                self.cache.put(face_id, found[face_id])
+                resolved[face_id] = found[face_id]
+        return resolved
+
+    def __call__(self, face):
+        # Single-face resolver, same signature as the resolver build_records accepts
+        return self.fetch([face["FaceId"]])[face["FaceId"]]
+
+    def resolve_groups(self, groups):
+        # groups: iterator of per-image face lists. Yields (group, (userId, bucket, key)) in order,
+        # with up to prefetch_batches bulk lookups in flight ahead of the consumer.
+        groups = iter(groups)
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            exhausted = False
+            while True:
+                while not exhausted and len(in_flight) < self.prefetch_batches:
+                    batch = []
+                    for group in groups:
+                        batch.append(group)
+                        if len(batch) == self.batch_size:
+                            break
+                    if not batch:
+                        exhausted = True
+                        break
+                    future = executor.submit(self.fetch, [group[0]["FaceId"] for group in batch])
+                    in_flight.append((batch, future))
+                if not in_flight:
+                    return
+                batch, future = in_flight.popleft()
+                resolved = future.result()
+                for group in batch:
+                    yield group, resolved[group[0]["FaceId"]]
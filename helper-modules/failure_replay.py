@@ -0,0 +1,341 @@
+# Rebuild a retry manifest from the failures of earlier reindexing jobs.
+#
+# Failed records are spread over three places:
+#   - the Firehose output in the errors bucket (validation-results/YYYY/MM/DD/HH/...), one
+#     {"record", "reason"} JSON line per record rejected by the Processor or the validation pipeline,
+#   - the ReIndexLogs table, one item per record the ReIndexing function logged (keyed by the first
+#     FaceId, NO_FACE_ID#<yyyymmddHH>#<digest> for records without faces, and the single legacy
+#     NO_FACE_ID item with its Payloads list),
+#   - optionally the FaceReindexDLQ, jobs whose IndexFaces calls kept failing (e.g. throttling), with
+#     the records collapsed into them under "Duplicates".
+#
+# This module streams the three sources in parallel (Firehose objects on a worker pool, the table as a
+# parallel Scan), classifies every failure by its reason as retryable (throttling, service errors,
+# records the Processor could not enqueue, dead letters) or permanent (schema, missing objects, images
+# without the expected faces), deduplicates by CollectionId/Bucket/Key/ExternalImageId and writes the
+# retryable records as manifest shards. A record that also has a permanent failure is not retried: it
+# reached a final outcome in a later delivery, or it would fail again. Permanent failures are written
+# to permanent.jsonl with their reason, for review.
+#
+# With --stack-bucket the shards are uploaded to replay/<run>/ and a job file listing them to
+# records/resume/<run>.job.json, which starts one job in resume mode: records whose faces are already
+# in the results table are skipped, and images the ledger shows as reindexed are not indexed again.
+#
+#   python failure_replay.py --errors-bucket ris-stack-errors-bucket --logs-table RIS-stack-ReIndexLogs \
+#       --dead-letter-queue https://sqs.us-east-1.amazonaws.com/123456789012/RIS-stack-FaceReindexDLQ \
+#       --since 2024-06-01T10 --stack-bucket ris-stack-bucket
+
+import argparse, gzip, json, os, queue, re, threading, time
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+from collection_export import write_shards
+
+FIREHOSE_PREFIX = "validation-results/"
+NO_FACE_ID = "NO_FACE_ID"
+READ_WORKERS = 32
+SCAN_SEGMENTS = 16
+DEAD_LETTER_READERS = 16  # ReceiveMessage returns at most 10 messages per call
+RECORDS_PER_SHARD = 10000  # small shards spread the replay over the parallel executions of the job
+DEAD_LETTER_VISIBILITY = 3600  # dead letters stay hidden from other readers while the replay runs
+PERMANENT_FILE = "permanent.jsonl"
+DEAD_LETTER_REASON = "Dead-letter queue: not processed after {} deliveries"
+
+# Properties the pipeline adds to a manifest record on its way, dropped from the replayed records
+PIPELINE_PROPERTIES = ("ExecutionId", "Fingerprint", "ObjectTag", "Image", "Duplicates")
+
+# First match wins; reasons that match none are permanent
+RETRYABLE_REASONS = [
+    ("not enqueued", re.compile(r"^SQS send failed")),
+    ("throttling", re.compile(r"Throttl|SlowDown|TooManyRequests|RequestLimitExceeded|ProvisionedThroughputExceeded"
+                              r"|LimitExceeded|Rate exceeded")),
+    ("service error", re.compile(r"InternalError|InternalServerError|InternalFailure|ServiceUnavailable|ServiceFailure"
+                                 r"|RequestTimeout|timed out|Could not connect|Connection|\(50[0-4]\)")),
+    ("dead letter", re.compile(r"^Dead-letter queue")),
+]
+PERMANENT_REASONS = [
+    ("invalid record", re.compile(r"^Schema validation failed|^Missing required|^Invalid|^Bucket and Key|No faces provided")),
+    ("missing object", re.compile(r"Object does not exist|Object has zero bytes|\(404\)|NoSuchKey")),
+    ("invalid image", re.compile(r"^Image validation failed|^Image normalization failed")),
+    ("no face found", re.compile(r"no faces found")),
+    # The results of these records are stored, the reason is a note on the match
+    ("reindexed with notes", re.compile(r"Not able to map|Indexed more than|only 1 face found|Not able to match")),
+]
+
+
+@lru_cache(maxsize=4096)
+def classify(reason):
+    # (retryable, category) of a failure reason. Incidents repeat a handful of reasons over and over,
+    # each distinct reason is matched once.
+    reason = reason or ""
+    for category, pattern in RETRYABLE_REASONS:
+        if pattern.search(reason):
+            return True, category
+    for category, pattern in PERMANENT_REASONS:
+        if pattern.search(reason):
+            return False, category
+    return False, "other"
+
+
+def manifest_records(payload):
+    # The manifest records of a failure payload: a job expands into the records collapsed into it
+    if not isinstance(payload, dict):
+        return []
+    if not any(prop in payload for prop in PIPELINE_PROPERTIES):
+        return [payload]
+    records = [payload] + [dict(duplicate, CollectionId=payload.get("CollectionId"))
+                           for duplicate in payload.get("Duplicates", []) if isinstance(duplicate, dict)]
+    return [{prop: value for prop, value in record.items() if prop not in PIPELINE_PROPERTIES} for record in records]
+
+
+def record_key(record):
+    return (record.get("CollectionId"), record.get("Bucket"), record.get("Key"), record.get("ExternalImageId"))
+
+
+def stream(tasks, workers):
+    # Runs tasks (callables returning iterables of lists of failures) on a pool and yields the failures
+    # as they are read. The queue is bounded, readers wait while the consumer catches up.
+    results = queue.Queue(maxsize=workers * 4)
+    stop = threading.Event()
+
+    def run(task):
+        try:
+            for batch in task():
+                if stop.is_set():
+                    break
+                results.put((batch, None))
+            results.put((None, None))
+        except Exception as e:
+            results.put((None, e))
+
+    error = None
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(tasks)))) as executor:
+        for task in tasks:
+            executor.submit(run, task)
+        finished = 0
+        while finished < len(tasks):
+            batch, failure = results.get()
+            if batch is None:
+                finished += 1
+                if failure is not None and error is None:
+                    # Readers still running finish their current put and stop
+                    error = failure
+                    stop.set()
+                continue
+            if error is None:
+                yield from batch
+    if error is not None:
+        raise error
+
+
+def firehose_keys(s3_client, bucket, prefix=FIREHOSE_PREFIX, since=None):
+    # Firehose writes under <prefix>YYYY/MM/DD/HH/ (UTC): listing starts after the first hour requested
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if since:
+        kwargs["StartAfter"] = prefix + time.strftime("%Y/%m/%d/%H", time.strptime(since, "%Y-%m-%dT%H"))
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(**kwargs):
+        for obj in page.get("Contents", []):
+            yield obj["Key"]
+
+
+def read_firehose_object(s3_client, bucket, key):
+    body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    if body[:2] == b"\x1f\x8b":  # delivery streams configured with GZIP compression
+        body = gzip.decompress(body)
+    lines = [line for line in body.decode("utf-8").splitlines() if line.strip()]
+    try:
+        # One decode for the whole object instead of one per line
+        entries = json.loads("[" + ",".join(lines) + "]")
+    except ValueError:
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue  # a truncated line is skipped, the others are read
+    failures = []
+    for entry in entries:
+        if isinstance(entry, dict) and "record" in entry:
+            failures.extend((record, entry.get("reason"), "firehose") for record in manifest_records(entry["record"]))
+    return [failures]
+
+
+def firehose_tasks(s3_client, bucket, prefix=FIREHOSE_PREFIX, since=None):
+    return [lambda key=key: read_firehose_object(s3_client, bucket, key) for key in firehose_keys(s3_client, bucket, prefix, since)]
+
+
+def log_failures(item):
+    # Failures of a ReIndexLogs item: one, or a list for the legacy NO_FACE_ID item
+    entries = [item]
+    if item.get("FaceId", {}).get("S") == NO_FACE_ID and "Payloads" in item:
+        entries = [entry.get("M", {}) for entry in item["Payloads"].get("L", [])]
+    failures = []
+    for entry in entries:
+        try:
+            payload = json.loads(entry.get("Payload", {}).get("S", "null"))
+        except ValueError:
+            continue
+        failures.extend((record, entry.get("ErrorReason", {}).get("S"), "logs") for record in manifest_records(payload))
+    return failures
+
+
+def scan_logs_segment(dynamodb_client, table_name, segment, total_segments):
+    paginator = dynamodb_client.get_paginator("scan")
+    for page in paginator.paginate(TableName=table_name, Segment=segment, TotalSegments=total_segments,
+                                   ProjectionExpression="FaceId, Payload, ErrorReason, Payloads"):
+        yield [failure for item in page["Items"] for failure in log_failures(item)]
+
+
+def logs_tasks(dynamodb_client, table_name, total_segments=SCAN_SEGMENTS):
+    return [lambda segment=segment: scan_logs_segment(dynamodb_client, table_name, segment, total_segments)
+            for segment in range(total_segments)]
+
+
+def receive_dead_letters(sqs_client, queue_url, receipts, lock):
+    # Reads until the queue comes back empty; the messages stay hidden for DEAD_LETTER_VISIBILITY and
+    # go back to the queue afterwards unless the replay deletes them
+    empty = 0
+    while empty < 2:
+        messages = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=1,
+                                              VisibilityTimeout=DEAD_LETTER_VISIBILITY,
+                                              AttributeNames=["ApproximateReceiveCount"]).get("Messages", [])
+        if not messages:
+            empty += 1
+            continue
+        empty = 0
+        failures = []
+        for message in messages:
+            with lock:
+                receipts.append(message["ReceiptHandle"])
+            try:
+                payload = json.loads(message["Body"])
+            except ValueError:
+                continue
+            reason = DEAD_LETTER_REASON.format(message.get("Attributes", {}).get("ApproximateReceiveCount", "?"))
+            failures.extend((record, reason, "dead letters") for record in manifest_records(payload))
+        yield failures
+
+
+def dead_letter_tasks(sqs_client, queue_url, receipts, readers=DEAD_LETTER_READERS):
+    lock = threading.Lock()
+    return [lambda: receive_dead_letters(sqs_client, queue_url, receipts, lock) for _ in range(readers)]
+
+
+def delete_dead_letters(sqs_client, queue_url, receipts):
+    for start in range(0, len(receipts), 10):
+        entries = [{"Id": str(number), "ReceiptHandle": receipt} for number, receipt in enumerate(receipts[start:start + 10])]
+        sqs_client.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+
+
+class FailureReplay:
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+        self.retry = {}  # record key -> record
+        self.permanent = {}  # record key -> (record, reason, category)
+        self.categories = {}  # (retryable, category) -> failures
+        self.sources = {}  # source -> failures
+        self.failures = 0
+
+    def add(self, record, reason, source):
+        classified = classify(reason if isinstance(reason, str) else "")
+        self.failures += 1
+        self.categories[classified] = self.categories.get(classified, 0) + 1
+        self.sources[source] = self.sources.get(source, 0) + 1
+        key = record_key(record)
+        if key in self.permanent:
+            return
+        if classified[0]:
+            self.retry[key] = record
+        else:
+            self.retry.pop(key, None)
+            self.permanent[key] = (record, reason, classified[1])
+
+    def collect(self, failures):
+        for record, reason, source in failures:
+            self.add(record, reason, source)
+
+    def write(self, records_per_shard=RECORDS_PER_SHARD, prefix="retry_records"):
+        # Returns the paths of the retry manifest shards
+        with open(os.path.join(self.work_dir, PERMANENT_FILE), "w") as f:
+            for record, reason, category in self.permanent.values():
+                f.write(json.dumps({"record": record, "reason": reason, "category": category}) + "\n")
+        return write_shards(self.retry.values(), self.work_dir, records_per_shard, prefix)
+
+    def summary(self):
+        lines = ["{} failures read ({}): {} records to retry, {} permanent failures".format(
+            self.failures, ", ".join("{} {}".format(count, source) for source, count in sorted(self.sources.items())),
+            len(self.retry), len(self.permanent))]
+        for (retryable, category), count in sorted(self.categories.items(), key=lambda entry: -entry[1]):
+            lines.append("  {:<10}{:<24}{:>10}".format("retry" if retryable else "permanent", category, count))
+        return "\n".join(lines)
+
+
+def upload_replay(s3_client, shards, bucket, run, resume=True):
+    # Uploads the shards under replay/<run>/ and the job file that starts them as one job
+    keys = []
+    for path in shards:
+        key = "replay/{}/{}".format(run, os.path.basename(path))
+        s3_client.upload_file(path, bucket, key)
+        keys.append(key)
+    job_key = "records/{}{}.job.json".format("resume/" if resume else "", run)
+    s3_client.put_object(Bucket=bucket, Key=job_key, Body=json.dumps({"manifests": keys}).encode("utf-8"))
+    print("Uploaded {} shards, job file s3://{}/{}".format(len(keys), bucket, job_key))
+    return job_key
+
+
+def main():
+    import boto3
+    from botocore.config import Config
+
+    parser = argparse.ArgumentParser(description="Rebuild a retry manifest from the failures of earlier reindexing jobs")
+    parser.add_argument("--errors-bucket", help="Bucket of the Firehose error output")
+    parser.add_argument("--errors-prefix", default=FIREHOSE_PREFIX)
+    parser.add_argument("--since", help="First hour of Firehose output to read, UTC, e.g. 2024-06-01T10")
+    parser.add_argument("--logs-table", help="ReIndexLogs table of the stack")
+    parser.add_argument("--segments", type=int, default=SCAN_SEGMENTS, help="Parallel Scan segments of the logs table")
+    parser.add_argument("--dead-letter-queue", help="URL of the FaceReindexDLQ")
+    parser.add_argument("--dead-letter-readers", type=int, default=DEAD_LETTER_READERS)
+    parser.add_argument("--delete-dead-letters", action="store_true",
+                        help="Delete the dead letters once the retry manifest is written")
+    parser.add_argument("--workers", type=int, default=READ_WORKERS)
+    parser.add_argument("--work-dir", default="replay")
+    parser.add_argument("--records-per-shard", type=int, default=RECORDS_PER_SHARD)
+    parser.add_argument("--stack-bucket", help="Upload the shards and a job file to the stack bucket to start the replay")
+    parser.add_argument("--no-resume", action="store_true", help="Replay every record, even those already in the results table")
+    parser.add_argument("--region")
+    args = parser.parse_args()
+
+    session = boto3.Session(region_name=args.region)
+    config = Config(max_pool_connections=args.workers + args.segments + args.dead_letter_readers, retries={"mode": "adaptive"})
+    s3_client = session.client("s3", config=config)
+    sqs_client = session.client("sqs", config=config)
+    replay = FailureReplay(args.work_dir)
+    receipts = []
+
+    tasks = []
+    if args.errors_bucket:
+        tasks += firehose_tasks(s3_client, args.errors_bucket, args.errors_prefix, args.since)
+    if args.logs_table:
+        tasks += logs_tasks(session.client("dynamodb", config=config), args.logs_table, args.segments)
+    if args.dead_letter_queue:
+        tasks += dead_letter_tasks(sqs_client, args.dead_letter_queue, receipts, args.dead_letter_readers)
+    if not tasks:
+        parser.error("nothing to read: give --errors-bucket, --logs-table or --dead-letter-queue")
+    replay.collect(stream(tasks, args.workers + args.segments + args.dead_letter_readers))
+
+    shards = replay.write(args.records_per_shard)
+    print(replay.summary())
+    print("{} retry shards in {}".format(len(shards), args.work_dir))
+    if args.stack_bucket and shards:
+        upload_replay(s3_client, shards, args.stack_bucket, "replay-" + time.strftime("%Y%m%dT%H%M%S", time.gmtime()),
+                      resume=not args.no_resume)
+    if args.delete_dead_letters and receipts:
+        delete_dead_letters(sqs_client, args.dead_letter_queue, receipts)
+        print("Deleted {} dead letters".format(len(receipts)))
+
+
+if __name__ == "__main__":
+    main()
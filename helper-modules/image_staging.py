@@ -0,0 +1,269 @@
+# Stage the images of reindex manifests into a bucket of the destination region (or account).
+#
+# Instead of `aws s3 sync` of whole source prefixes before the first IndexFaces call, this module:
+#   1. reads the manifest shards and copies only the Bucket/Key objects the records reference, each
+#      object once, with server-side copies on a worker pool (objects above `multipart_threshold` are
+#      copied as parallel UploadPartCopy parts),
+#   2. rewrites the records of a shard to the staged location once all its objects are copied and
+#      uploads the shard to the stack's records/ folder right away, so reindexing of the staged shards
+#      runs while the next shards are still being copied,
+#   3. appends every copied object to a checkpoint log and records staged and uploaded shards
+#      separately, so an interrupted run resumes with the objects, shards and uploads that are left.
+#      A shard is recorded as staged before it is uploaded, and the upload skips a shard already in
+#      the records/ folder, so a crash between the two neither loses nor starts the shard twice.
+#
+# Records whose source object does not exist are left out of the staged shard and written to
+# missing.jsonl in the work directory. The credentials used need s3:GetObject on the source bucket and
+# s3:PutObject on the destination bucket.
+#
+#   python image_staging.py manifests/solution_records-*.json --destination-bucket images-eu-west-1 \
+#       --source-region us-east-1 --region eu-west-1 --upload s3://ris-stack-bucket/records/
+
+import argparse, json, os, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+from collection_export import upload_shards
+
+COPIED_FILE = "copied.jsonl"
+SHARDS_FILE = "shards.json"
+UPLOADED_FILE = "uploaded.json"
+MISSING_FILE = "missing.jsonl"
+COPY_WORKERS = 32
+PART_WORKERS = 16
+MULTIPART_THRESHOLD = 256 * 1024 * 1024
+PART_SIZE = 64 * 1024 * 1024
+MISSING_ERRORS = {"404", "NoSuchKey", "NotFound"}
+
+
+def error_code(error):
+    return getattr(error, "response", {}).get("Error", {}).get("Code")
+
+
+def read_manifest(s3_client, location):
+    # A local file or an s3:// URI holding a JSON array of records
+    if location.startswith("s3://"):
+        parsed = urlparse(location)
+        return json.loads(s3_client.get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip("/"))["Body"].read())
+    with open(location) as f:
+        return json.load(f)
+
+
+def write_manifest(records, path):
+    # Same layout as collection_export.write_shards: a JSON array with one record per line
+    with open(path + ".tmp", "w") as f:
+        f.write("[\n")
+        f.write(",\n".join(json.dumps(record) for record in records))
+        f.write("\n]\n")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+class ImageStager:
+
+    def __init__(self, source_client, destination_client, destination_bucket, work_dir, destination_prefix="",
+                 bucket_folders=False, collection_id=None, workers=COPY_WORKERS, part_workers=PART_WORKERS,
+                 multipart_threshold=MULTIPART_THRESHOLD, part_size=PART_SIZE):
+        self.source_client = source_client
+        self.destination_client = destination_client
+        self.destination_bucket = destination_bucket
+        self.destination_prefix = destination_prefix
+        self.bucket_folders = bucket_folders
+        self.collection_id = collection_id
+        self.work_dir = work_dir
+        self.workers = workers
+        self.part_workers = part_workers
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(work_dir, "staged"), exist_ok=True)
+        self.copied = self.load_copied()
+        self.shards = self.load_shards()
+        self.uploaded = self.load_uploaded()
+        self.copies = 0
+        self.copied_bytes = 0
+
+    def load_copied(self):
+        copied = set()
+        path = os.path.join(self.work_dir, COPIED_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    # A line cut short by a crash is an object to copy again
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    copied.add((entry["bucket"], entry["key"]))
+        return copied
+
+    def load_shards(self):
+        path = os.path.join(self.work_dir, SHARDS_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        return {}  # shard name -> staged manifest path
+
+    def load_uploaded(self):
+        path = os.path.join(self.work_dir, UPLOADED_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                return set(json.load(f))
+        # Work directories of earlier versions only recorded a shard once it was uploaded
+        return set(self.shards)
+
+    def save_shards(self):
+        self.save_json(SHARDS_FILE, self.shards)
+
+    def save_uploaded(self):
+        self.save_json(UPLOADED_FILE, sorted(self.uploaded))
+
+    def save_json(self, name, value):
+        path = os.path.join(self.work_dir, name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(value, f)
+        os.replace(path + ".tmp", path)
+
+    def destination_key(self, bucket, key):
+        if self.bucket_folders:
+            key = "{}/{}".format(bucket, key)
+        return self.destination_prefix + key
+
+    def copy(self, bucket, key):
+        # Server-side copy of one object; returns its size
+        size = self.source_client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        destination_key = self.destination_key(bucket, key)
+        source = {"Bucket": bucket, "Key": key}
+        if size <= self.multipart_threshold:
+            self.destination_client.copy_object(Bucket=self.destination_bucket, Key=destination_key, CopySource=source)
+        else:
+            self.copy_multipart(source, destination_key, size)
+
+        with self.lock:
+            with open(os.path.join(self.work_dir, COPIED_FILE), "a") as f:
+                f.write(json.dumps({"bucket": bucket, "key": key, "size": size}) + "\n")
+            self.copied.add((bucket, key))
+            self.copies += 1
+            self.copied_bytes += size
+        return size
+
+    def copy_multipart(self, source, destination_key, size):
+        upload_id = self.destination_client.create_multipart_upload(
+            Bucket=self.destination_bucket, Key=destination_key)["UploadId"]
+
+        def copy_part(number):
+            start = (number - 1) * self.part_size
+            end = min(size, start + self.part_size) - 1
+            response = self.destination_client.upload_part_copy(
+                Bucket=self.destination_bucket, Key=destination_key, UploadId=upload_id, PartNumber=number,
+                CopySource=source, CopySourceRange="bytes={}-{}".format(start, end))
+            return {"PartNumber": number, "ETag": response["CopyPartResult"]["ETag"]}
+
+        try:
+            numbers = range(1, (size - 1) // self.part_size + 2)
+            with ThreadPoolExecutor(max_workers=min(self.part_workers, len(numbers))) as executor:
+                parts = list(executor.map(copy_part, numbers))
+            self.destination_client.complete_multipart_upload(
+                Bucket=self.destination_bucket, Key=destination_key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+        except Exception:
+            # Parts of an abandoned upload are billed until aborted
+            self.destination_client.abort_multipart_upload(Bucket=self.destination_bucket, Key=destination_key, UploadId=upload_id)
+            raise
+
+    def copy_objects(self, objects):
+        # Copies the objects not copied yet; returns the set of missing source objects. Other errors
+        # are raised once every copy has finished, so the successful ones are checkpointed.
+        pending = [obj for obj in objects if obj not in self.copied]
+        missing, errors = set(), []
+        if not pending:
+            return missing
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(pending))) as executor:
+            futures = {executor.submit(self.copy, *obj): obj for obj in pending}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    if error_code(e) in MISSING_ERRORS:
+                        missing.add(futures[future])
+                    else:
+                        errors.append((futures[future], e))
+        if errors:
+            (bucket, key), error = errors[0]
+            raise RuntimeError("{} objects could not be copied, first s3://{}/{}: {}".format(len(errors), bucket, key, error))
+        return missing
+
+    def stage_records(self, records):
+        objects = list(dict.fromkeys((record["Bucket"], record["Key"]) for record in records))
+        missing = self.copy_objects(objects)
+        staged = []
+        for record in records:
+            if (record["Bucket"], record["Key"]) in missing:
+                with open(os.path.join(self.work_dir, MISSING_FILE), "a") as f:
+                    f.write(json.dumps(record) + "\n")
+                continue
+            record = dict(record, Bucket=self.destination_bucket, Key=self.destination_key(record["Bucket"], record["Key"]))
+            if self.collection_id:
+                record["CollectionId"] = self.collection_id
+            staged.append(record)
+        return staged, len(missing)
+
+    def stage(self, manifests, read, on_staged=None):
+        # read(manifest) -> records; on_staged(path) is called with every staged shard, in order,
+        # and must be idempotent: it is called again if the run stopped before it was recorded.
+        # Shards staged by an earlier run are not staged again.
+        paths = []
+        for manifest in manifests:
+            name = os.path.basename(urlparse(manifest).path) if manifest.startswith("s3://") else os.path.basename(manifest)
+            if name in self.shards:
+                print("Skipping {}, staged by an earlier run".format(name))
+                path = self.shards[name]
+            else:
+                staged, missing = self.stage_records(read(manifest))
+                path = write_manifest(staged, os.path.join(self.work_dir, "staged", name))
+                self.shards[name] = path
+                self.save_shards()
+                print("Staged {}: {} records, {} missing objects -- {} objects copied".format(name, len(staged), missing, self.copies))
+            if on_staged and name not in self.uploaded:
+                on_staged(path)
+                self.uploaded.add(name)
+                self.save_uploaded()
+            paths.append(path)
+        return paths
+
+
+def main():
+    import boto3
+    from botocore.config import Config
+
+    parser = argparse.ArgumentParser(description="Copy the images referenced by reindex manifests to the destination region")
+    parser.add_argument("manifests", nargs="+", help="Manifest shards, local files or s3:// URIs, staged in this order")
+    parser.add_argument("--destination-bucket", required=True)
+    parser.add_argument("--destination-prefix", default="", help="Prepended to the source keys")
+    parser.add_argument("--bucket-folders", action="store_true", help="Stage under <source bucket>/, for manifests spanning several buckets")
+    parser.add_argument("--collection-id", help="Also set CollectionId of the staged records")
+    parser.add_argument("--work-dir", default="staging")
+    parser.add_argument("--workers", type=int, default=COPY_WORKERS)
+    parser.add_argument("--part-workers", type=int, default=PART_WORKERS)
+    parser.add_argument("--multipart-threshold-mb", type=int, default=MULTIPART_THRESHOLD // (1024 * 1024))
+    parser.add_argument("--part-size-mb", type=int, default=PART_SIZE // (1024 * 1024))
+    parser.add_argument("--source-region")
+    parser.add_argument("--region", help="Destination region")
+    parser.add_argument("--upload", help="s3:// prefix every staged shard is uploaded to, e.g. the stack's records/ folder")
+    args = parser.parse_args()
+
+    config = Config(max_pool_connections=args.workers + args.part_workers, retries={"mode": "adaptive"})
+    source_client = boto3.client("s3", region_name=args.source_region, config=config)
+    destination_client = boto3.client("s3", region_name=args.region, config=config)
+    stager = ImageStager(source_client, destination_client, args.destination_bucket, args.work_dir,
+                         args.destination_prefix, args.bucket_folders, args.collection_id, args.workers,
+                         args.part_workers, args.multipart_threshold_mb * 1024 * 1024, args.part_size_mb * 1024 * 1024)
+
+    def on_staged(path):
+        upload_shards(destination_client, [path], args.upload)
+
+    stager.stage(args.manifests, lambda manifest: read_manifest(source_client, manifest), on_staged if args.upload else None)
+    print("{} objects, {:.1f} MB copied".format(stager.copies, stager.copied_bytes / (1024.0 * 1024.0)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+# Query the Parquet export of the reindexing results (ResultsExportLocation of the stack).
+#
+# The StoreResults function writes one part per batch under
+#   <location>/collection=<CollectionId>/job=<job id>/part-<digest>.parquet
+# (see solution-assets/lambda_functions/results_export.py). Reading the mapping from it instead of
+# scanning the ReIndexResults table:
+#   - only the requested columns are read (e.g. OldFaceId, FaceId), the others are never downloaded,
+#   - a collection or a job only lists its own partition,
+#   - rows are typed: bounding boxes are four float columns, IsNewFace a boolean.
+#
+#   python results_query.py query s3://bucket/exports/ --collection new-collection --columns OldFaceId FaceId
+#   python results_query.py compact s3://bucket/exports/ --collection new-collection --job job-0123abcd
+#   python results_query.py backfill s3://bucket/exports/ --results-table RIS-stack-ReIndexResults \
+#       --collection new-collection
+#
+# `compact` merges the small parts of a finished job into a few large files. `backfill` exports a
+# results table filled before the export was enabled, with a parallel Scan, as job `backfill`.
+# Needs pyarrow (and boto3 for backfill).
+
+import argparse, json, os, re, sys, uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "solution-assets", "lambda_functions"))
+
+from results_export import COLUMNS, COMPRESSION, NOT_REINDEXED, arrowSchema
+
+PARTITION_COLUMNS = ["collection", "job"]
+ROWS_PER_FILE = 5000000
+BACKFILL_ROWS_PER_PART = 1000000
+BACKFILL_JOB = "backfill"
+COMPACTED_FILE = re.compile(r"compacted-(\d+)-\d+\.parquet$")
+
+
+def filesystem(location):
+    # (pyarrow filesystem, base path) for an s3:// URI or a local directory
+    from pyarrow import fs
+    if "://" not in location:
+        location = os.path.abspath(location)
+    return fs.FileSystem.from_uri(location)
+
+
+def partition_path(base, collection=None, job=None):
+    path = base.rstrip("/")
+    if collection is not None:
+        path += "/collection={}".format(collection)
+        if job is not None:
+            path += "/job={}".format(job)
+    return path
+
+
+def load_results(location, columns=None, collection=None, job=None, dedupe=True):
+    # Returns a pyarrow Table with the requested columns (all by default), partition columns included.
+    # With dedupe, every OldFaceId appears once: rows written twice (a message delivered again in another
+    # batch) and faces reindexed again by a later job, which keep the row written last like the results table.
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    fs, base = filesystem(location)
+    # Listing starts at the partition of the collection (and job) instead of the whole export
+    path = partition_path(base, collection, job)
+    partitioning = ds.partitioning(pa.schema([(name, pa.string()) for name in PARTITION_COLUMNS]), flavor="hive")
+    dataset = ds.dataset(path, format="parquet", filesystem=fs, partitioning=partitioning)
+
+    columns = list(columns) if columns else [name for name, _ in COLUMNS]
+    read = list(columns) + (["OldFaceId"] if dedupe and "OldFaceId" not in columns else [])
+    expression = ds.field("job") == job if job is not None and collection is None else None
+    if dedupe:
+        # Every batch comes from one file: tag its rows with the write time of the file
+        written = written_times(fs, path)
+        scanner = dataset.scanner(columns=read, filter=expression)
+        batches = []
+        for tagged in scanner.scan_batches():
+            written_at = pa.scalar(written.get(tagged.fragment.path, 0), pa.int64())
+            batches.append(tagged.record_batch.append_column("_written", pa.repeat(written_at, tagged.record_batch.num_rows)))
+        table = pa.Table.from_batches(batches, schema=scanner.projected_schema.append(pa.field("_written", pa.int64())))
+        if table.num_rows:
+            table = latest_rows(table, "OldFaceId")
+    else:
+        table = dataset.to_table(columns=read, filter=expression)
+
+    # Partition directories that are part of the path are not parsed again
+    for name, value in (("collection", collection), ("job", job)):
+        if name in columns and value is not None:
+            table = table.set_column(table.column_names.index(name), name, pa.array([value] * table.num_rows, pa.string()))
+    return table.select(columns)
+
+
+def written_times(fs, path):
+    # Parquet file -> write time (ns). Compacted files are named after the latest write of the parts they
+    # replaced, so compacting an older job does not make its rows the latest.
+    from pyarrow import fs as pafs
+    times = {}
+    for info in fs.get_file_info(pafs.FileSelector(path, recursive=True)):
+        if info.path.endswith(".parquet"):
+            compacted = COMPACTED_FILE.search(info.path)
+            times[info.path] = int(compacted.group(1)) if compacted else info.mtime_ns or 0
+    return times
+
+
+def latest_rows(table, key):
+    # Keeps the row of every key value with the latest `_written` time, without leaving Arrow
+    import pyarrow.compute as pc
+    order = pc.sort_indices(table, sort_keys=[("_written", "descending")])
+    return first_rows(table.take(order).drop_columns(["_written"]), key)
+
+
+def first_rows(table, key):
+    # Keeps the first row of every key value, without leaving Arrow
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    positions = pa.table({key: table[key], "_row": pa.array(range(table.num_rows), pa.int64())})
+    first = positions.group_by(key, use_threads=False).aggregate([("_row", "min")])["_row_min"]
+    if len(first) == table.num_rows:
+        return table
+    return table.take(pc.take(first, pc.array_sort_indices(first)))
+
+
+def face_mapping(location, collection, job=None):
+    # OldFaceId -> new FaceId of the faces that were reindexed
+    table = load_results(location, ["OldFaceId", "FaceId"], collection, job)
+    return {old: new for old, new in zip(table["OldFaceId"].to_pylist(), table["FaceId"].to_pylist())
+            if new != NOT_REINDEXED}
+
+
+def user_faces(location, collection, job=None):
+    # UserID -> new FaceIds, the input of the user vector migration. New faces found by Rekognition and
+    # faces that could not be reindexed have no user to migrate.
+    table = load_results(location, ["UserID", "FaceId", "IsNewFace"], collection, job)
+    users = defaultdict(list)
+    for user_id, face_id, is_new in zip(table["UserID"].to_pylist(), table["FaceId"].to_pylist(),
+                                        table["IsNewFace"].to_pylist()):
+        if is_new or face_id == NOT_REINDEXED or user_id.startswith("NewFace-"):
+            continue
+        users[user_id].append(face_id)
+    return users
+
+
+def write_files(fs, path, table, prefix, rows_per_file=ROWS_PER_FILE):
+    import pyarrow.parquet as pq
+    written = []
+    for number, start in enumerate(range(0, table.num_rows, rows_per_file)):
+        key = "{}/{}-{:05d}.parquet".format(path, prefix, number)
+        pq.write_table(table.slice(start, rows_per_file), key, filesystem=fs, compression=COMPRESSION)
+        written.append(key)
+    return written
+
+
+def compact(location, collection, job, rows_per_file=ROWS_PER_FILE):
+    # Rewrites the parts of one job as a few large, deduplicated files. The new files are written before
+    # the parts are deleted; running it again after an interruption reads both and writes the same result.
+    fs, base = filesystem(location)
+    path = partition_path(base, collection, job)
+    before = written_times(fs, path)
+    table = load_results(location, [name for name, _ in COLUMNS], collection, job)
+    written = write_files(fs, path, table, "compacted-{}".format(max(before.values(), default=0)), rows_per_file)
+    for key in before:
+        if key not in written:
+            fs.delete_file(key)
+    return table.num_rows, len(before), len(written)
+
+
+def scan_segment(dynamodb_client, table_name, segment, total_segments, fs, path):
+    # Writes the items of one Scan segment as parts of BACKFILL_ROWS_PER_PART rows
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    rows, parts, total = [], 0, 0
+
+    def write():
+        key = "{}/part-backfill-{:03d}-{}.parquet".format(path, segment, uuid.uuid4().hex[:12])
+        pq.write_table(pa.Table.from_pylist(rows, schema=arrowSchema()), key, filesystem=fs, compression=COMPRESSION)
+
+    paginator = dynamodb_client.get_paginator("scan")
+    for page in paginator.paginate(TableName=table_name, Segment=segment, TotalSegments=total_segments):
+        for item in page["Items"]:
+            values = {name: value.get("S") for name, value in item.items()}
+            try:
+                box = json.loads(values.get("BoundingBoxes") or "null")
+            except ValueError:
+                box = None
+            box = box if isinstance(box, dict) else {}
+            is_new = values.get("IsNewFace")
+            rows.append({
+                "OldFaceId": values.get("OldFaceId"), "FaceId": values.get("FaceId"),
+                "OldImageId": values.get("OldImageId"), "ImageId": values.get("ImageId"),
+                "UserID": values.get("UserID"), "ExternalImageId": values.get("ExternalImageId"),
+                "Bucket": values.get("Bucket"), "Key": values.get("Key"),
+                "Width": box.get("Width"), "Height": box.get("Height"), "Left": box.get("Left"), "Top": box.get("Top"),
+                "IsNewFace": None if is_new is None else is_new == "True",
+            })
+        if len(rows) >= BACKFILL_ROWS_PER_PART:
+            write()
+            total += len(rows)
+            rows, parts = [], parts + 1
+    if rows:
+        write()
+        total += len(rows)
+        parts += 1
+    return total, parts
+
+
+def backfill(dynamodb_client, table_name, location, collection, total_segments):
+    fs, base = filesystem(location)
+    path = partition_path(base, collection, BACKFILL_JOB)
+    fs.create_dir(path, recursive=True)
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        results = list(executor.map(lambda segment: scan_segment(dynamodb_client, table_name, segment, total_segments, fs, path),
+                                    range(total_segments)))
+    return sum(rows for rows, _ in results), sum(parts for _, parts in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query, compact or backfill the Parquet export of the reindexing results")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    query = commands.add_parser("query", help="Write selected columns as CSV")
+    query.add_argument("location", help="s3://bucket/prefix/ or a local directory")
+    query.add_argument("--collection")
+    query.add_argument("--job")
+    query.add_argument("--columns", nargs="+", help="Default: every column")
+    query.add_argument("--output", help="CSV file, default stdout")
+    query.add_argument("--keep-duplicates", action="store_true")
+
+    compaction = commands.add_parser("compact", help="Merge the parts of a finished job")
+    compaction.add_argument("location")
+    compaction.add_argument("--collection", required=True)
+    compaction.add_argument("--job", required=True)
+    compaction.add_argument("--rows-per-file", type=int, default=ROWS_PER_FILE)
+
+    fill = commands.add_parser("backfill", help="Export an existing results table")
+    fill.add_argument("location")
+    fill.add_argument("--results-table", required=True)
+    fill.add_argument("--collection", required=True, help="Collection the results table was reindexed into")
+    fill.add_argument("--segments", type=int, default=8, help="Parallel Scan segments")
+    fill.add_argument("--region")
+    args = parser.parse_args()
+
+    if args.command == "query":
+        import pyarrow.csv
+        table = load_results(args.location, args.columns, args.collection, args.job, dedupe=not args.keep_duplicates)
+        pyarrow.csv.write_csv(table, args.output or sys.stdout.buffer)
+    elif args.command == "compact":
+        rows, parts, files = compact(args.location, args.collection, args.job, args.rows_per_file)
+        print("{} rows: {} parts compacted into {} files".format(rows, parts, files))
+    else:
+        import boto3
+        from botocore.config import Config
+        client = boto3.Session(region_name=args.region).client(
+            "dynamodb", config=Config(max_pool_connections=args.segments, retries={"mode": "adaptive"}))
+        rows, parts = backfill(client, args.results_table, args.location, args.collection, args.segments)
+        print("{} items exported in {} parts".format(rows, parts))
+
+
+if __name__ == "__main__":
+    main()
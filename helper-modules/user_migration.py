@@ -0,0 +1,223 @@
+# Recreate User Vectors in the target collection from the ReIndexResults table.
+#
+# Scales the steps of 1-User-Vector-Migration.ipynb to large tables:
+#   1. parallel segmented Scan (Segment / TotalSegments) grouping the new FaceIds by UserID,
+#   2. CreateUser + AssociateFaces (chunked to the 100 FaceIds per call limit) on a worker pool,
+#      with each API paced by its own token bucket,
+#   3. the grouped users are saved once the scan completes and every fully associated user is appended
+#      to a checkpoint log, so a crash resumes with the remaining users instead of restarting. Users with
+#      faces AssociateFaces rejected go to a separate log with those FaceIds, and the next run retries
+#      only them.
+#
+#   python user_migration.py --results-table RIS-stack-ReIndexResults --collection-id new-collection \
+#       --work-dir ./user-migration --segments 8 --create-user-tps 5 --associate-tps 5
+#
+# With --results-export s3://bucket/prefix/ the users are read from the Parquet export of the results
+# (results_query.py) instead of a Scan of the table.
+
+import argparse, hashlib, json, os, sys, threading, time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "solution-assets", "lambda_functions"))
+
+from rate_limiter import TokenBucket
+
+ASSOCIATE_FACES_LIMIT = 100
+USERS_FILE = "users.json"
+COMPLETED_FILE = "completed.jsonl"
+UNSUCCESSFUL_FILE = "unsuccessful.jsonl"
+MAX_RETRIES = 8
+THROTTLING_ERRORS = {"ThrottlingException", "ProvisionedThroughputExceededException", "LimitExceededException"}
+
+
+def scan_segment(dynamodb_client, table_name, segment, total_segments):
+    users = defaultdict(list)
+    paginator = dynamodb_client.get_paginator("scan")
+    pages = paginator.paginate(TableName=table_name, Segment=segment, TotalSegments=total_segments,
+                               ProjectionExpression="UserID, FaceId")
+    for page in pages:
+        for item in page["Items"]:
+            user_id = item.get("UserID", {}).get("S")
+            face_id = item.get("FaceId", {}).get("S")
+            # New faces found by Rekognition and faces that could not be reindexed have no user to migrate
+            if not user_id or not face_id or face_id == "Not reindexed" or user_id.startswith("NewFace-"):
+                continue
+            users[user_id].append(face_id)
+    return users
+
+
+def scan_users(dynamodb_client, table_name, total_segments):
+    users = defaultdict(list)
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        futures = [executor.submit(scan_segment, dynamodb_client, table_name, segment, total_segments)
+                   for segment in range(total_segments)]
+        for future in as_completed(futures):
+            for user_id, face_ids in future.result().items():
+                users[user_id].extend(face_ids)
+    return users
+
+
+def load_users(dynamodb_client, table_name, total_segments, work_dir, results_export=None, collection_id=None):
+    # With results_export (the Parquet export of the results) only the UserID, FaceId and IsNewFace
+    # columns of the collection are read instead of scanning the table
+    os.makedirs(work_dir, exist_ok=True)
+    path = os.path.join(work_dir, USERS_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    if results_export:
+        from results_query import user_faces
+        users = user_faces(results_export, collection_id)
+    else:
+        users = scan_users(dynamodb_client, table_name, total_segments)
+    with open(path + ".tmp", "w") as f:
+        json.dump(users, f)
+    os.replace(path + ".tmp", path)
+    return users
+
+
+def load_completed(work_dir):
+    path = os.path.join(work_dir, COMPLETED_FILE)
+    completed = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    completed.add(json.loads(line)["UserId"])
+    return completed
+
+
+def load_unsuccessful(work_dir):
+    # FaceIds left to associate per user, from the last attempt of each user
+    path = os.path.join(work_dir, UNSUCCESSFUL_FILE)
+    unsuccessful = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    unsuccessful[result["UserId"]] = result["Unsuccessful"]
+    return unsuccessful
+
+
+def request_token(*parts):
+    # Same token for the same request, so retries after a crash are idempotent on the API side
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:64]
+
+
+def call_with_retry(limiter, function, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            return function(**kwargs)
+        except Exception as e:
+            code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if code not in THROTTLING_ERRORS or attempt == MAX_RETRIES:
+                raise
+            time.sleep(min(10.0, 0.2 * (2 ** attempt)))
+
+
+class UserMigration:
+
+    def __init__(self, rek_client, collection_id, work_dir, create_user_tps=5, associate_tps=5, workers=8):
+        self.rek_client = rek_client
+        self.collection_id = collection_id
+        self.work_dir = work_dir
+        self.create_user_limiter = TokenBucket(create_user_tps)
+        self.associate_limiter = TokenBucket(associate_tps)
+        self.workers = workers
+        self.log_lock = threading.Lock()
+
+    def migrate_user(self, user_id, face_ids):
+        # A face listed twice would be rejected by AssociateFaces, or split across two chunks
+        face_ids = list(dict.fromkeys(face_ids))
+        try:
+            call_with_retry(self.create_user_limiter, self.rek_client.create_user,
+                            CollectionId=self.collection_id, UserId=user_id,
+                            ClientRequestToken=request_token(self.collection_id, user_id))
+        except (self.rek_client.exceptions.ConflictException, self.rek_client.exceptions.ResourceAlreadyExistsException):
+            pass  # User already exists, e.g. created before a crash
+
+        associated, unsuccessful = 0, []
+        for start in range(0, len(face_ids), ASSOCIATE_FACES_LIMIT):
+            chunk = face_ids[start:start + ASSOCIATE_FACES_LIMIT]
+            response = call_with_retry(self.associate_limiter, self.rek_client.associate_faces,
+                                       CollectionId=self.collection_id, UserId=user_id, FaceIds=chunk,
+                                       ClientRequestToken=request_token(self.collection_id, user_id, *chunk))
+            associated += len(response.get("AssociatedFaces", []))
+            unsuccessful.extend(response.get("UnsuccessfulFaceAssociations", []))
+        return {"UserId": user_id, "Faces": len(face_ids), "Associated": associated,
+                "Unsuccessful": [face.get("FaceId") for face in unsuccessful],
+                "Reasons": {face.get("FaceId"): face.get("Reasons", []) for face in unsuccessful}}
+
+    def record(self, result, file_name=COMPLETED_FILE):
+        with self.log_lock:
+            with open(os.path.join(self.work_dir, file_name), "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+    def run(self, users):
+        completed = load_completed(self.work_dir)
+        unsuccessful = load_unsuccessful(self.work_dir)
+        # Users partially associated by a previous run only retry the faces that were rejected
+        pending = [(user_id, unsuccessful.get(user_id, face_ids)) for user_id, face_ids in users.items()
+                   if user_id not in completed]
+        print("Users: {} -- already migrated: {} -- pending: {} (retrying rejected faces: {})".format(
+            len(users), len(completed), len(pending), sum(1 for user_id, _ in pending if user_id in unsuccessful)))
+
+        failed = []
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.migrate_user, user_id, face_ids): user_id for user_id, face_ids in pending}
+            for future in as_completed(futures):
+                user_id = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print("Error migrating user {}: {}".format(user_id, e))
+                    failed.append(user_id)
+                    continue
+                if result["Unsuccessful"]:
+                    # Not checkpointed: the rejected FaceIds are kept for the next run
+                    print("User {}: {}/{} faces associated -- rejected: {}".format(
+                        user_id, result["Associated"], result["Faces"], result["Reasons"]))
+                    self.record(result, UNSUCCESSFUL_FILE)
+                    failed.append(user_id)
+                    continue
+                self.record(result)
+                done += 1
+                if done % 1000 == 0:
+                    print("Migrated {}/{} users".format(done, len(pending)))
+        print("Migrated {} users -- failed: {}".format(done, len(failed)))
+        return failed
+
+
+def main():
+    import boto3
+    from botocore.config import Config
+
+    parser = argparse.ArgumentParser(description="Recreate users and face associations from the ReIndexResults table")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--results-table")
+    source.add_argument("--results-export", help="s3:// location of the Parquet export, read instead of scanning the table")
+    parser.add_argument("--collection-id", required=True)
+    parser.add_argument("--work-dir", default="user-migration")
+    parser.add_argument("--segments", type=int, default=8, help="Parallel Scan segments")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--create-user-tps", type=float, default=5)
+    parser.add_argument("--associate-tps", type=float, default=5)
+    parser.add_argument("--region")
+    args = parser.parse_args()
+
+    session = boto3.Session(region_name=args.region)
+    config = Config(max_pool_connections=max(args.segments, args.workers), retries={"mode": "adaptive"})
+    users = load_users(session.client("dynamodb", config=config), args.results_table, args.segments, args.work_dir,
+                       args.results_export, args.collection_id)
+    migration = UserMigration(session.client("rekognition", config=config), args.collection_id, args.work_dir,
+                              args.create_user_tps, args.associate_tps, args.workers)
+    failed = migration.run(users)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
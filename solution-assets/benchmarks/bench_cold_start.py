@@ -0,0 +1,112 @@
+# Cold start cost of every Lambda handler: each measurement runs in a fresh interpreter, like a new
+# execution environment, and reports
+#   import  - time to import the handler module (the Lambda init phase)
+#   clients - time to build the boto3 clients the module declares, paid by the first invocation
+#             that calls each service (before aws_clients.LazyClient this was part of the import)
+#   rss     - peak resident memory after both, against the 128 MB the functions are configured with
+# No AWS call is made. Building clients needs boto3 installed; without it only imports are measured.
+#
+#   python bench_cold_start.py --runs 5
+#   python bench_cold_start.py --handlers lambda_reindex lambda_processing --json
+
+import argparse, json, os, statistics, subprocess, sys
+
+LAMBDA_FUNCTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions')
+
+HANDLERS = [
+    'lambda_stepfunctions', 'lambda_processing', 'lambda_reindex', 'lambda_dynamo', 'lambda_completion',
+    'lambda_checksqs', 'lambda_updateconcurrency', 'lambda_vs_stepfunctions', 'lambda_vs_processing',
+    'lambda_vs_validation', 'lambda_vs_checksqs',
+]
+
+# Enough configuration for every module to import; nothing is called
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'cold-start-benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'cold-start-benchmark',
+    'dynamologs': 'ReIndexLogs',
+    'dynamoTable': 'ReIndexResults',
+    'dynamosqsurl': 'https://sqs.us-east-1.amazonaws.com/000000000000/StoreQueue',
+    'reindexsqsurl': 'https://sqs.us-east-1.amazonaws.com/000000000000/FaceReindexQueue',
+    'qualityfilter': 'AUTO',
+}
+
+# Runs in the child interpreter: argv[1] is the handler module, prints one JSON line
+MEASURE = r'''
+import json, resource, sys, time
+sys.path.insert(0, sys.argv[2])
+start = time.perf_counter()
+try:
+    module = __import__(sys.argv[1])
+except ImportError as e:
+    print(json.dumps({'import': 0.0, 'clients': 0.0, 'services': [], 'rss': 0.0, 'error': str(e)}))
+    sys.exit(0)
+imported = time.perf_counter()
+
+import aws_clients
+services = sorted({(value.service, value.pool_size) for value in vars(module).values()
+                   if isinstance(value, aws_clients.LazyClient)})
+clients = 0.0
+error = None
+try:
+    clientsStart = time.perf_counter()
+    for service, pool_size in services:
+        aws_clients.get_client(service, pool_size)
+    clients = time.perf_counter() - clientsStart
+except ImportError as e:
+    error = str(e)
+print(json.dumps({
+    'import': (imported - start) * 1000.0,
+    'clients': clients * 1000.0,
+    'services': [service for service, _ in services],
+    'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    'error': error,
+}))
+'''
+
+
+def measure(handler):
+    environment = dict(os.environ)
+    environment.update(ENVIRONMENT)
+    output = subprocess.run([sys.executable, '-c', MEASURE, handler, LAMBDA_FUNCTIONS], env=environment,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def benchmark(handlers, runs):
+    report = {}
+    for handler in handlers:
+        samples = [measure(handler) for _ in range(runs)]
+        report[handler] = {
+            'importMs': round(statistics.median(sample['import'] for sample in samples), 1),
+            'clientsMs': round(statistics.median(sample['clients'] for sample in samples), 1),
+            'services': samples[0]['services'],
+            'rssMb': round(max(sample['rss'] for sample in samples), 1),
+            'error': samples[0]['error'],
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import and client initialization time of the Lambda handlers")
+    parser.add_argument('--handlers', nargs='+', default=HANDLERS)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per handler, the median is reported')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    report = benchmark(args.handlers, args.runs)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print("{:<26}{:>12}{:>13}{:>10}  {}".format("handler", "import ms", "clients ms", "rss MB", "services"))
+    for handler, result in report.items():
+        print("{:<26}{:>12}{:>13}{:>10}  {}".format(handler, result['importMs'], result['clientsMs'], result['rssMb'],
+                                                   ', '.join(result['services'])))
+    errors = {result['error'] for result in report.values() if result['error']}
+    if errors:
+        print("Not measured: {}".format('; '.join(sorted(errors))))
+
+
+if __name__ == '__main__':
+    main()
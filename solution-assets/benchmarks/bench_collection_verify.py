@@ -0,0 +1,146 @@
+# Benchmark and end-to-end check of collection_verify against FakeRekognition and the local DynamoDB.
+#
+# Builds a migration: an old collection of --images images with 1 to 3 faces each, the new collection
+# and the ReIndexResults items mapping one to the other, plus items of another migration sharing the
+# table. Then seeds known defects (missing items, "Not reindexed" faces, items whose new face was
+# deleted, extra faces found by IndexFaces, images indexed twice, two old faces mapped to one new face
+# and items whose old face is gone) and verifies the migration
+#   1. reading the sources one call at a time, every row held in memory,
+#   2. reading them concurrently (both ListFaces and the parallel Scan), spilling the partitions,
+# and checks that both runs report exactly the seeded defects and per-image count deltas. Every
+# ListFaces call pays --list-latency-ms, every Scan page --latency-ms.
+#
+#   python bench_collection_verify.py --images 100000 --list-latency-ms 200
+
+import argparse, json, os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'helper-modules'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions'))
+
+from local_aws import LocalDynamoDB, FakeRekognition, Metrics
+from collection_verify import CollectionVerification, verify_tasks, ISSUES_FILE, DELTAS_FILE
+from failure_replay import stream
+
+OLD_COLLECTION = 'old-collection'
+NEW_COLLECTION = 'new-collection'
+RESULTS_TABLE = 'ReIndexResults'
+DEFECTS = ['missing mapping', 'not reindexed', 'missing new face', 'unmapped new face', 'duplicate index',
+           'shared new face', 'orphan mapping']
+
+
+def box(position):
+    return {'Width': 0.2, 'Height': 0.2, 'Left': 0.05 + 0.3 * position, 'Top': 0.1}
+
+
+def resultItem(oldFaceId, faceId, externalImageId):
+    return {'OldFaceId': {'S': oldFaceId}, 'FaceId': {'S': faceId}, 'ExternalImageId': {'S': externalImageId},
+            'UserID': {'S': ''}}
+
+
+def buildMigration(rekognition, dynamodb, args, rng):
+    # Returns the expected {issue: count} and {ExternalImageId: delta}
+    dynamodb.create_table(RESULTS_TABLE, 'OldFaceId')
+    expected = {defect: 0 for defect in DEFECTS}
+    deltas = {}
+    for number in range(args.images):
+        externalImageId = 'ext-{:07d}'.format(number)
+        oldFaces = [rekognition.add_face(OLD_COLLECTION, box(position), externalImageId)
+                    for position in range(rng.randint(1, 3))]
+        newImageId = 'new-image-{}'.format(number)
+        defect = rng.choice(DEFECTS) if rng.random() < args.defect_share else None
+        if defect == 'shared new face' and len(oldFaces) == 1:
+            defect = None
+        for position, oldFace in enumerate(oldFaces):
+            if position == 0 and defect == 'missing mapping':
+                rekognition.add_face(NEW_COLLECTION, box(position), externalImageId, newImageId)
+                expected['unmapped new face'] += 1
+                continue
+            if position == 0 and defect == 'not reindexed':
+                dynamodb.write(RESULTS_TABLE, resultItem(oldFace['FaceId'], 'Not reindexed', externalImageId))
+                deltas[externalImageId] = -1
+                continue
+            newFace = rekognition.add_face(NEW_COLLECTION, box(position), externalImageId, newImageId)
+            if position == 1 and defect == 'shared new face':
+                # The second old face maps to the first new face, the second new face is left unmapped
+                dynamodb.write(RESULTS_TABLE, resultItem(oldFace['FaceId'], firstFaceId, externalImageId))
+                expected['unmapped new face'] += 1
+                continue
+            dynamodb.write(RESULTS_TABLE, resultItem(oldFace['FaceId'], newFace['FaceId'], externalImageId))
+            firstFaceId = newFace['FaceId']
+            if position == 0 and defect == 'missing new face':
+                del rekognition.collections[NEW_COLLECTION][newFace['FaceId']]
+                deltas[externalImageId] = -1
+        if defect == 'unmapped new face':
+            rekognition.add_face(NEW_COLLECTION, box(3), externalImageId, newImageId)
+            deltas[externalImageId] = 1
+        if defect == 'duplicate index':
+            for position in range(len(oldFaces)):
+                rekognition.add_face(NEW_COLLECTION, box(position), externalImageId, 'again-{}'.format(number))
+            expected['duplicate index'] += len(oldFaces) - 1
+            deltas[externalImageId] = len(oldFaces)
+        if defect == 'orphan mapping':
+            newFace = rekognition.add_face(NEW_COLLECTION, box(3), externalImageId, newImageId)
+            dynamodb.write(RESULTS_TABLE, resultItem('deleted-{}'.format(number), newFace['FaceId'], externalImageId))
+            deltas[externalImageId] = 1
+        if defect:
+            expected[defect] += 1
+        # Faces Rekognition found that were not in the old collection are stored as new faces
+        if number % 50 == 0:
+            newFace = rekognition.add_face(NEW_COLLECTION, box(3), externalImageId, newImageId)
+            dynamodb.write(RESULTS_TABLE, resultItem('NewFace-' + newFace['FaceId'], newFace['FaceId'], externalImageId))
+            deltas[externalImageId] = deltas.get(externalImageId, 0) + 1
+    # Another migration writing to the same table
+    for number in range(args.images // 10):
+        dynamodb.write(RESULTS_TABLE, resultItem('other-{}'.format(number), 'other-new-{}'.format(number), 'other-{}'.format(number)))
+    return expected, {externalImageId: delta for externalImageId, delta in deltas.items() if delta}
+
+
+def run(rekognition, dynamodb, workers, segments, memoryRows, partitions):
+    verification = CollectionVerification(tempfile.mkdtemp(prefix='verify-'), partitions, memoryRows)
+    start = time.perf_counter()
+    tasks = verify_tasks(rekognition, dynamodb, OLD_COLLECTION, NEW_COLLECTION, RESULTS_TABLE, segments)
+    verification.collect(stream(tasks, workers))
+    verification.verify()
+    return verification, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=100000)
+    parser.add_argument('--defect-share', type=float, default=0.02, help='images seeded with a defect')
+    parser.add_argument('--list-latency-ms', type=float, default=200.0)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--segments', type=int, default=16)
+    parser.add_argument('--partitions', type=int, default=64)
+    parser.add_argument('--memory-rows', type=int, default=100000, help='rows buffered before spilling, concurrent run')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    metrics = Metrics()
+    rekognition = FakeRekognition(metrics, None, args.list_latency_ms, listFacesTps=1000, seed=args.seed)
+    dynamodb = LocalDynamoDB(metrics, args.latency_ms)
+    expected, deltas = buildMigration(rekognition, dynamodb, args, random.Random(args.seed))
+    print("{} old faces, {} new faces, {} results items -- {} defects seeded".format(
+        len(rekognition.collections[OLD_COLLECTION]), len(rekognition.collections[NEW_COLLECTION]),
+        len(dynamodb.items(RESULTS_TABLE)), sum(expected.values())))
+
+    print("{:<12}{:>10}{:>10}{:>10}{:>10}".format("run", "seconds", "issues", "deltas", "spills"))
+    for name, workers, segments, memoryRows in (("sequential", 1, 1, 10 ** 9),
+                                                ("concurrent", args.segments + 2, args.segments, args.memory_rows)):
+        verification, elapsed = run(rekognition, dynamodb, workers, segments, memoryRows, args.partitions)
+        found = {defect: verification.issues.get(defect, 0) for defect in DEFECTS}
+        assert found == expected and set(verification.issues) <= set(DEFECTS), (found, expected)
+        with open(os.path.join(verification.work_dir, DELTAS_FILE)) as f:
+            reported = {entry['ExternalImageId']: entry['Delta'] for entry in map(json.loads, f)}
+        assert reported == deltas, (len(reported), len(deltas))
+        with open(os.path.join(verification.work_dir, ISSUES_FILE)) as f:
+            assert sum(1 for _ in f) == sum(expected.values())
+        assert verification.unrelated == args.images // 10
+        print("{:<12}{:>10.2f}{:>10}{:>10}{:>10}".format(name, elapsed, sum(found.values()), len(reported),
+                                                         verification.partitions.spills))
+    print()
+    print(verification.summary())
+
+
+if __name__ == '__main__':
+    main()
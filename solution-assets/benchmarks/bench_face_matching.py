@@ -0,0 +1,119 @@
+# Micro-benchmark for face_matching: the previous per-pair calculate_iou loop (scenario 3.3)
+# vs. the IoU matrix + optimal assignment used by lambda_reindex, on
+#   grid  - separate faces, every indexed face overlaps one provided face
+#   crowd - faces overlapping their neighbour and duplicate detections, where the first-match loop
+#           gives one provided face to several indexed faces
+# and checks that match_faces never assigns a provided face twice nor keeps a pair below the threshold.
+#
+#   python bench_face_matching.py --faces 50 100 --repeat 200
+
+import argparse, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions'))
+
+from face_matching import calculate_iou, match_faces
+
+IOU_Threshold = 0.5
+
+
+def groupPhoto(faceCount, rng):
+    # Faces on a grid with jitter; Rekognition boxes are the provided boxes shifted slightly,
+    # plus a few extra detections and a few missed faces
+    side = int(faceCount ** 0.5) + 1
+    cell = 1.0 / side
+    provided, indexed = [], []
+    for n in range(faceCount):
+        row, col = divmod(n, side)
+        size = cell * rng.uniform(0.5, 0.9)
+        box = {"Width": size, "Height": size, "Left": col * cell + rng.uniform(0, cell - size), "Top": row * cell + rng.uniform(0, cell - size)}
+        provided.append({"UserId": "u{}".format(n), "FaceId": "f{}".format(n), "ImageId": "i", "BoundingBoxes": box})
+        if rng.random() < 0.95:
+            shift = size * 0.1
+            indexed.append({"Face": {"FaceId": "n{}".format(n), "ImageId": "j", "BoundingBox": {
+                "Width": size * rng.uniform(0.9, 1.1), "Height": size * rng.uniform(0.9, 1.1),
+                "Left": box["Left"] + rng.uniform(-shift, shift), "Top": box["Top"] + rng.uniform(-shift, shift)}}})
+    rng.shuffle(indexed)
+    return provided, indexed
+
+
+def crowdPhoto(faceCount, rng):
+    # Faces in pairs, the second one shifted by a tenth of its size (IoU about 0.8 with the first),
+    # and some faces detected twice with slightly different boxes
+    clusters = (faceCount + 1) // 2
+    side = int(clusters ** 0.5) + 1
+    cell = 1.0 / side
+    provided, indexed = [], []
+    for n in range(faceCount):
+        row, col = divmod(n // 2, side)
+        size = cell * 0.6
+        box = {"Width": size, "Height": size, "Left": col * cell + (size * 0.1 if n % 2 else 0.0), "Top": row * cell}
+        provided.append({"UserId": "u{}".format(n), "FaceId": "f{}".format(n), "ImageId": "i", "BoundingBoxes": box})
+        for copy in range(2 if rng.random() < 0.2 else 1):
+            shift = size * 0.03
+            indexed.append({"Face": {"FaceId": "n{}-{}".format(n, copy), "ImageId": "j", "BoundingBox": {
+                "Width": size * rng.uniform(0.97, 1.03), "Height": size * rng.uniform(0.97, 1.03),
+                "Left": box["Left"] + rng.uniform(-shift, shift), "Top": box["Top"] + rng.uniform(-shift, shift)}}})
+    rng.shuffle(indexed)
+    return provided, indexed
+
+
+def legacyMatch(payloadFaces, rekogIndexedFaces):
+    # The previous nested loop with first-match break
+    matches = {}
+    for position, rekogIndexedFace in enumerate(rekogIndexedFaces):
+        for providedPosition, providedFace in enumerate(payloadFaces):
+            iou = calculate_iou(providedFace["BoundingBoxes"], rekogIndexedFace["Face"]["BoundingBox"])
+            if iou > IOU_Threshold:
+                matches[position] = (providedPosition, iou)
+                break
+    return matches
+
+
+def timeIt(function, cases, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for provided, indexed in cases:
+            function(provided, indexed)
+    return (time.perf_counter() - start) / (repeat * len(cases))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--faces', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('--cases', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print("{:<8}{:>6}{:>16}{:>16}{:>20}{:>16}".format("photo", "faces", "per-pair (ms)", "matrix (ms)", "legacy dup claims", "total IoU +%"))
+    for photo, generate in (("grid", groupPhoto), ("crowd", crowdPhoto)):
+        for faceCount in args.faces:
+            cases = [generate(faceCount, rng) for _ in range(args.cases)]
+            legacyTime = timeIt(legacyMatch, cases, args.repeat)
+            matrixTime = timeIt(lambda p, i: match_faces(p, i, IOU_Threshold), cases, args.repeat)
+
+            duplicates, legacyIou, matrixIou = 0, 0.0, 0.0
+            for provided, indexed in cases:
+                legacy = legacyMatch(provided, indexed)
+                claimed = [providedPosition for providedPosition, _ in legacy.values()]
+                duplicates += len(claimed) - len(set(claimed))
+                # A provided face claimed twice only counts once, with its best IoU
+                best = {}
+                for providedPosition, iou in legacy.values():
+                    best[providedPosition] = max(iou, best.get(providedPosition, 0.0))
+                legacyIou += sum(best.values())
+                matches = match_faces(provided, indexed, IOU_Threshold)
+                assigned = [providedPosition for providedPosition, _ in matches.values()]
+                assert len(assigned) == len(set(assigned)), "provided face assigned twice"
+                assert all(iou > IOU_Threshold for _, iou in matches.values())
+                assert len(assigned) >= len(best)
+                matrixIou += sum(iou for _, iou in matches.values())
+            if photo == "crowd":
+                assert duplicates > 0, "crowd cases should make the first-match loop claim a face twice"
+
+            gain = 100.0 * (matrixIou - legacyIou) / legacyIou if legacyIou else 0.0
+            print("{:<8}{:>6}{:>16.3f}{:>16.3f}{:>20}{:>16.2f}".format(photo, faceCount, legacyTime * 1000, matrixTime * 1000, duplicates, gain))
+    print("ok")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Benchmark for face_resolver.CachingResolver against a simulated remote mapping.
+# Compares one getAdditionalInfo point lookup per image with batched, prefetched lookups.
+#
+#   python bench_face_resolver.py --images 20000 --latency-ms 5 --batch-size 1000
+
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'helper-modules'))
+
+from collection_export import build_records
+from face_resolver import CachingResolver
+
+
+class SimulatedMapping:
+    # Remote database: every call pays `latency` plus a small per-row cost
+
+    def __init__(self, latencyMs, perRowUs):
+        self.latency = latencyMs / 1000.0
+        self.perRow = perRowUs / 1000000.0
+        self.calls = 0
+
+    def lookup(self, faceId):
+        self.calls += 1
+        time.sleep(self.latency + self.perRow)
+        return "user-" + faceId, "photos-bucket", faceId + ".jpg"
+
+    def bulk_lookup(self, faceIds):
+        self.calls += 1
+        time.sleep(self.latency + self.perRow * len(faceIds))
+        return {faceId: ("user-" + faceId, "photos-bucket", faceId + ".jpg") for faceId in faceIds}
+
+
+def sortedFaces(images, facesPerImage):
+    for image in range(images):
+        for face in range(facesPerImage):
+            yield {"FaceId": "face-{}-{}".format(image, face), "ImageId": "image-{:08d}".format(image),
+                   "ExternalImageId": "ext-{}".format(image), "BoundingBox": {"Width": 0.1, "Height": 0.1, "Left": 0.1, "Top": 0.1}}
+
+
+def run(images, facesPerImage, resolver):
+    start = time.perf_counter()
+    count = sum(1 for _ in build_records(sortedFaces(images, facesPerImage), "new-collection", resolver))
+    return count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=20000)
+    parser.add_argument('--faces-per-image', type=int, default=2)
+    parser.add_argument('--latency-ms', type=float, default=5.0)
+    parser.add_argument('--per-row-us', type=float, default=20.0)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--point-images', type=int, default=1000, help='images used for the (slow) point lookup baseline')
+    args = parser.parse_args()
+
+    print("{:<28}{:>10}{:>14}{:>16}".format("resolver", "images", "remote calls", "lookups/s"))
+
+    mapping = SimulatedMapping(args.latency_ms, args.per_row_us)
+    count, elapsed = run(args.point_images, args.faces_per_image, lambda face: mapping.lookup(face["FaceId"]))
+    print("{:<28}{:>10}{:>14}{:>16.0f}".format("point lookup", count, mapping.calls, count / elapsed))
+
+    mapping = SimulatedMapping(args.latency_ms, args.per_row_us)
+    resolver = CachingResolver(mapping.bulk_lookup, batch_size=args.batch_size, workers=1, prefetch_batches=1)
+    count, elapsed = run(args.images, args.faces_per_image, resolver)
+    print("{:<28}{:>10}{:>14}{:>16.0f}".format("bulk", count, mapping.calls, count / elapsed))
+
+    mapping = SimulatedMapping(args.latency_ms, args.per_row_us)
+    resolver = CachingResolver(mapping.bulk_lookup, batch_size=args.batch_size, workers=args.workers)
+    count, elapsed = run(args.images, args.faces_per_image, resolver)
+    print("{:<28}{:>10}{:>14}{:>16.0f}".format("bulk + prefetch", count, mapping.calls, count / elapsed))
+
+    # Second pass over the same images (e.g. a resumed export) is served from the cache
+    count, elapsed = run(args.images, args.faces_per_image, resolver)
+    print("{:<28}{:>10}{:>14}{:>16.0f}".format("bulk + prefetch (cached)", count, mapping.calls, count / elapsed))
+    print("cache hits: {} -- misses: {}".format(resolver.cache.hits, resolver.cache.misses))
+
+
+if __name__ == '__main__':
+    main()
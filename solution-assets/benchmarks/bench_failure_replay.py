@@ -0,0 +1,178 @@
+# Benchmark and end-to-end check of failure_replay against the local S3, DynamoDB and SQS stand-ins.
+#
+# Builds the aftermath of a throttling incident: Firehose error objects in the errors bucket (S3
+# SlowDown on HeadObject, records the Processor could not enqueue, missing objects and malformed
+# records, many of them logged twice by reruns), the ReIndexLogs table (per-FaceId items, sharded
+# NO_FACE_ID# items and the legacy NO_FACE_ID item with its Payloads list) and the FaceReindexDLQ
+# (IndexFaces jobs, some carrying collapsed duplicates). Then
+#   1. rebuilds the retry manifest reading the sources one call at a time,
+#   2. rebuilds it with the worker pool and the parallel Scan,
+# and checks that the retry shards hold exactly the records to retry, once each, and that every one
+# of them passes record_schema. Every call pays --latency-ms.
+#
+#   python bench_failure_replay.py --records 300000 --latency-ms 20
+
+import argparse, json, os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'helper-modules'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions'))
+
+from local_aws import LocalS3, LocalDynamoDB, LocalSQS, Metrics
+from failure_replay import FailureReplay, stream, firehose_tasks, logs_tasks, dead_letter_tasks
+from record_schema import validate_records
+
+ERRORS_BUCKET = 'ris-errors'
+LOGS_TABLE = 'ReIndexLogs'
+COLLECTION = 'new-collection'
+
+FIREHOSE_REASONS = [
+    (0.55, True, "S3 validation failed: An error occurred (SlowDown) when calling the HeadObject operation: Please reduce your request rate."),
+    (0.15, True, "SQS send failed: AWS.SimpleQueueService.RequestThrottled Request is throttled."),
+    (0.20, False, "S3 validation failed: Object does not exist"),
+    (0.10, False, "Missing required properties: ExternalImageId"),
+]
+LOG_REASONS = ["1 face expected, no faces found.", "Not able to map face found.", "Indexed more than 1 expected face.",
+               "No faces provided by user"]
+
+
+def makeRecord(number, faces=1):
+    return {'Bucket': 'photos', 'Key': 'images/{:07d}.jpg'.format(number), 'ExternalImageId': 'ext-{}'.format(number),
+            'CollectionId': COLLECTION,
+            'Faces': [{'UserId': 'user-{}'.format(number), 'FaceId': 'face-{}-{}'.format(number, face), 'ImageId': 'image-{}'.format(number),
+                       'BoundingBoxes': {'Width': 0.2, 'Height': 0.2, 'Left': 0.1 + 0.3 * face, 'Top': 0.1}} for face in range(faces)]}
+
+
+def keyOf(record):
+    return (record['CollectionId'], record['Bucket'], record['Key'], record.get('ExternalImageId'))
+
+
+def pickReason(rng):
+    draw = rng.random()
+    for share, retryable, reason in FIREHOSE_REASONS:
+        if draw < share:
+            return retryable, reason
+        draw -= share
+    return FIREHOSE_REASONS[-1][1:]
+
+
+def buildSources(s3, dynamodb, args, rng):
+    # Returns the keys of the records to retry
+    retry, permanent = set(), set()
+    dynamodb.create_table(LOGS_TABLE, 'FaceId')
+
+    # Firehose: JSON lines, objects of --lines-per-object, under validation-results/YYYY/MM/DD/HH/
+    lines, objects = [], 0
+
+    def flush():
+        nonlocal lines, objects
+        key = 'validation-results/2024/06/01/{:02d}/RIS-stack-ValidationResults-{:06d}'.format(10 + objects % 12, objects)
+        s3.put(ERRORS_BUCKET, key, ''.join(lines).encode('utf-8'))
+        lines, objects = [], objects + 1
+
+    firehoseRecords = int(args.records * 0.8)
+    for number in range(firehoseRecords):
+        record = makeRecord(number)
+        retryable, reason = pickReason(rng)
+        if not retryable and reason.startswith('Missing'):
+            del record['ExternalImageId']
+        (retry if retryable else permanent).add(keyOf(record))
+        for _ in range(2 if rng.random() < args.rerun_share else 1):
+            lines.append(json.dumps({'record': record, 'reason': reason}) + '\n')
+            if len(lines) >= args.lines_per_object:
+                flush()
+    # Output of an earlier day, skipped by --since
+    s3.put(ERRORS_BUCKET, 'validation-results/2024/05/31/23/old', json.dumps(
+        {'record': makeRecord(10 ** 6), 'reason': FIREHOSE_REASONS[0][2]}).encode('utf-8'))
+    if lines:
+        flush()
+
+    # ReIndexLogs: outcomes of records processed after the incident, some of them retried records
+    logged = int(args.records * 0.1)
+    legacy = []
+    for position in range(logged):
+        number = rng.randrange(firehoseRecords) if position % 5 == 0 else firehoseRecords + position
+        record = makeRecord(number, faces=0 if position % 7 == 0 else 1)
+        reason = LOG_REASONS[3] if not record['Faces'] else rng.choice(LOG_REASONS[:3])
+        retry.discard(keyOf(record))
+        permanent.add(keyOf(record))
+        payload = json.dumps(dict(record, ExecutionId='arn:aws:states:job-1-0', Fingerprint='f'))
+        if record['Faces']:
+            key = record['Faces'][0]['FaceId']
+        elif position % 2:
+            legacy.append({'M': {'FaceId': {'S': 'NO_FACE_ID'}, 'Payload': {'S': payload}, 'ErrorReason': {'S': reason}}})
+            continue
+        else:
+            key = 'NO_FACE_ID#2024060110#{:016x}'.format(position)
+        dynamodb.write(LOGS_TABLE, {'FaceId': {'S': key}, 'Payload': {'S': payload}, 'ErrorReason': {'S': reason}})
+    dynamodb.write(LOGS_TABLE, {'FaceId': {'S': 'NO_FACE_ID'}, 'Payloads': {'L': legacy}})
+
+    # Dead letters: jobs throttled by IndexFaces, a few with collapsed duplicates
+    deadLetters = []
+    for position in range(int(args.records * 0.1)):
+        job = makeRecord(2 * 10 ** 6 + position, faces=2)
+        if position % 10 == 0:
+            duplicate = makeRecord(2 * 10 ** 6 + position, faces=2)
+            duplicate['ExternalImageId'] += '-copy'
+            del duplicate['CollectionId']
+            job['Duplicates'] = [duplicate]
+            retry.add((COLLECTION, duplicate['Bucket'], duplicate['Key'], duplicate['ExternalImageId']))
+        retry.add(keyOf(job))
+        deadLetters.append(json.dumps(dict(job, ExecutionId='arn:aws:states:job-1-0', ObjectTag='etag')))
+    return retry - permanent, deadLetters
+
+
+def run(s3, dynamodb, sqs, deadLetters, threads, segments, readers):
+    queueUrl = sqs.create_queue('FaceReindexDLQ')
+    for body in deadLetters:
+        sqs.queue(queueUrl).send(body)
+    replay = FailureReplay(tempfile.mkdtemp(prefix='replay-'))
+    before = dict(s3.metrics.calls)
+    start = time.perf_counter()
+    receipts = []
+    tasks = (firehose_tasks(s3, ERRORS_BUCKET, since='2024-06-01T00') + logs_tasks(dynamodb, LOGS_TABLE, segments)
+             + dead_letter_tasks(sqs, queueUrl, receipts, readers))
+    replay.collect(stream(tasks, threads))
+    shards = replay.write()
+    elapsed = time.perf_counter() - start
+    calls = {operation: count - before.get((service, operation), 0) for (service, operation), count in s3.metrics.calls.items()}
+    return replay, shards, elapsed, calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=300000)
+    parser.add_argument('--lines-per-object', type=int, default=2000, help='failures per Firehose object')
+    parser.add_argument('--rerun-share', type=float, default=0.3, help='failures logged twice by a rerun')
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--segments', type=int, default=16)
+    parser.add_argument('--readers', type=int, default=16, help='dead-letter queue readers')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    metrics = Metrics()
+    s3, dynamodb = LocalS3(metrics, args.latency_ms), LocalDynamoDB(metrics, args.latency_ms)
+    expected, deadLetters = buildSources(s3, dynamodb, args, random.Random(args.seed))
+    print("{} Firehose objects, {} log items, {} dead letters -- {} records to retry".format(
+        len(s3.objects(ERRORS_BUCKET)), len(dynamodb.items(LOGS_TABLE)), len(deadLetters), len(expected)))
+
+    print("{:<12}{:>10}{:>12}{:>12}{:>10}{:>10}{:>8}".format("run", "seconds", "failures", "retry", "permanent", "calls", "shards"))
+    for name, threads, segments, readers in (("sequential", 1, 1, 1),
+                                             ("parallel", args.workers + args.segments + args.readers, args.segments, args.readers)):
+        replay, shards, elapsed, calls = run(s3, dynamodb, LocalSQS(metrics, args.latency_ms), deadLetters, threads, segments, readers)
+        records = []
+        for path in shards:
+            with open(path) as f:
+                records.extend(json.load(f))
+        keys = [keyOf(record) for record in records]
+        assert len(keys) == len(set(keys)) and set(keys) == expected, (len(keys), len(set(keys)), len(expected))
+        valid, failed = validate_records(records)
+        assert not failed and not any('ExecutionId' in record or 'Duplicates' in record for record in records), failed[:1]
+        print("{:<12}{:>10.2f}{:>12}{:>12}{:>10}{:>10}{:>8}".format(name, elapsed, replay.failures, len(replay.retry),
+                                                                    len(replay.permanent), sum(calls.values()), len(shards)))
+    print()
+    print(replay.summary())
+
+
+if __name__ == '__main__':
+    main()
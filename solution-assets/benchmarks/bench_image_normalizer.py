@@ -0,0 +1,133 @@
+# Benchmark and end-to-end check of image_normalizer.ImageNormalizer against the local S3 stand-in.
+#
+# Generates images with Pillow, each with a red rectangle at a known relative bounding box: JPEGs
+# within the limits, oversized JPEGs (also with an EXIF orientation), PNGs with transparency, WebP,
+# GIF and TIFF images, images below the minimum size and objects that are not images. It then
+#   1. normalizes them with a worker pool and reports the S3 calls (one ranged GetObject per image,
+#      whole objects are only read for the images that are converted),
+#   2. checks the derived images: JPEG, under the size limit, and the rectangle found where the
+#      provided bounding box says it is (IoU against the box, in the orientation Rekognition reads),
+#   3. normalizes them again and reports the cache hits.
+# The size limit is scaled down (--limit-mb) so oversized images stay quick to generate.
+#
+#   python bench_image_normalizer.py --images 60 --limit-mb 1
+
+import argparse, io, os, random, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions'))
+
+from local_aws import LocalS3, Metrics
+import image_normalizer
+from face_matching import calculate_iou
+
+SOURCE_BUCKET = 'photos'
+LOCATION = 's3://ris-normalized/derived/'
+KINDS = ['jpeg', 'large-jpeg', 'rotated-jpeg', 'png', 'webp', 'gif', 'tiff', 'tiny', 'not-an-image']
+
+
+def drawImage(rng, kind, limitBytes):
+    # Returns (body, box relative to the image as Rekognition reads it, expected outcome)
+    from PIL import Image, ImageDraw
+    if kind == 'not-an-image':
+        return os.urandom(4096), None, 'rejected'
+    if kind == 'tiny':
+        width, height = 60, 40
+    elif kind in ('large-jpeg', 'rotated-jpeg'):
+        # Noise hardly compresses: about a byte per pixel at quality 95, twice the limit
+        side = int((limitBytes * 2 / 0.75) ** 0.5)
+        width, height = side, int(side * 0.75)
+    else:
+        width, height = rng.randint(400, 900), rng.randint(300, 700)
+    box = {'Width': 0.2, 'Height': 0.25, 'Left': round(rng.uniform(0.05, 0.7), 3), 'Top': round(rng.uniform(0.05, 0.6), 3)}
+
+    noisy = kind in ('large-jpeg', 'rotated-jpeg')
+    image = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3)) if noisy else Image.new('RGB', (width, height), (40, 90, 160))
+    ImageDraw.Draw(image).rectangle([box['Left'] * width, box['Top'] * height, (box['Left'] + box['Width']) * width,
+                                     (box['Top'] + box['Height']) * height], fill=(255, 0, 0))
+    output = io.BytesIO()
+    if kind == 'rotated-jpeg':
+        # Stored rotated, with EXIF orientation 6 (rotate 90 clockwise to display): the box is relative
+        # to the upright image Rekognition reads
+        stored = image.transpose(Image.Transpose.ROTATE_90)
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        stored.save(output, 'JPEG', quality=95, exif=exif.tobytes())
+    elif kind in ('jpeg', 'large-jpeg', 'tiny'):
+        image.save(output, 'JPEG', quality=95)
+    elif kind == 'png':
+        image.putalpha(255)
+        image.save(output, 'PNG')
+    else:
+        image.save(output, kind.upper())
+    expected = {'jpeg': 'unchanged', 'png': 'unchanged', 'tiny': 'rejected'}.get(kind, 'derived')
+    return output.getvalue(), box, expected
+
+
+def redBox(body):
+    # Relative bounding box of the red pixels of a derived image
+    from PIL import Image
+    image = Image.open(io.BytesIO(body)).convert('RGB')
+    width, height = image.size
+    small = image.resize((width // 4 or 1, height // 4 or 1))
+    pixels = small.load()
+    red = [(x, y) for x in range(small.size[0]) for y in range(small.size[1])
+           if pixels[x, y][0] > 200 and pixels[x, y][1] < 80 and pixels[x, y][2] < 80]
+    if not red:
+        return None
+    xs, ys = [x for x, _ in red], [y for _, y in red]
+    return {'Left': min(xs) / float(small.size[0]), 'Top': min(ys) / float(small.size[1]),
+            'Width': (max(xs) - min(xs) + 1) / float(small.size[0]), 'Height': (max(ys) - min(ys) + 1) / float(small.size[1])}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=45)
+    parser.add_argument('--limit-mb', type=float, default=1.0, help='stands in for the 15 MB IndexFaces limit')
+    parser.add_argument('--latency-ms', type=float, default=10.0)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    limit = int(args.limit_mb * 1024 * 1024)
+    image_normalizer.REKOGNITION_MAX_BYTES = limit
+    image_normalizer.TARGET_BYTES = int(limit * 0.8)
+
+    rng = random.Random(args.seed)
+    s3 = LocalS3(Metrics(), args.latency_ms)
+    images = []
+    for number in range(args.images):
+        kind = KINDS[number % len(KINDS)]
+        body, box, expected = drawImage(rng, kind, limit)
+        key = 'images/{:05d}-{}'.format(number, kind)
+        s3.put(SOURCE_BUCKET, key, body)
+        images.append((key, kind, len(body), box, expected))
+    total = sum(size for _, _, size, _, _ in images)
+    print("{} images, {:.1f} MB".format(len(images), total / 1048576.0))
+
+    for run in ('first pass', 'second pass'):
+        normalizer = image_normalizer.ImageNormalizer(s3, LOCATION)
+        before = dict(s3.metrics.calls)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            results = list(executor.map(lambda image: normalizer.normalize(SOURCE_BUCKET, image[0]), images))
+        elapsed = time.perf_counter() - start
+        calls = {operation: count - before.get((service, operation), 0) for (service, operation), count in s3.metrics.calls.items()}
+
+        outcomes, ious = {}, []
+        for (key, kind, size, box, expected), (derived, reason) in zip(images, results):
+            outcome = 'rejected' if reason else 'derived' if derived else 'unchanged'
+            assert outcome == expected, (key, outcome, expected, reason)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if derived:
+                body = s3.objects(derived['Bucket'])[derived['Key']]['Body']
+                assert body[:3] == b'\xff\xd8\xff' and len(body) <= limit, (key, len(body))
+                found = redBox(body)
+                ious.append(calculate_iou(box, found) if found else 0.0)
+        print("{}: {:.2f}s -- {} -- GetObject {} PutObject {} HeadObject {} -- min IoU of the boxes {:.3f}".format(
+            run, elapsed, ', '.join('{} {}'.format(count, outcome) for outcome, count in sorted(outcomes.items())),
+            calls.get('GetObject', 0), calls.get('PutObject', 0), calls.get('HeadObject', 0), min(ious) if ious else 1.0))
+
+
+if __name__ == '__main__':
+    main()
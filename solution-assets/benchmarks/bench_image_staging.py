@@ -0,0 +1,146 @@
+# Benchmark and end-to-end check of image_staging.ImageStager against the local S3 stand-in.
+#
+# Builds manifest shards referencing images in a source bucket (some records share an image, some
+# images are large enough for multipart copies, some are missing), then
+#   1. stages them with a single worker (one copy at a time, like a sequential sync),
+#   2. stages them with the worker pool,
+#   3. interrupts a pooled run after a number of copies, and once between uploading a shard and
+#      recording the upload, and resumes it,
+# and checks every staged object and rewritten record, and that every shard is uploaded once. Copies pay the call latency plus size / --copy-mbps.
+#
+#   python bench_image_staging.py --shards 4 --images 400 --workers 32
+
+import argparse, contextlib, json, os, random, sys, tempfile, time
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'helper-modules'))
+
+from local_aws import LocalS3, Metrics, clientError
+from image_staging import ImageStager
+from collection_export import upload_shards
+
+SOURCE_BUCKET = 'photos-us-east-1'
+DESTINATION_BUCKET = 'photos-eu-west-1'
+RECORDS_LOCATION = 's3://ris-stack-bucket/records/'
+KB = 1024
+
+
+def buildShards(s3, shards, images, largeShare, missingShare, duplicateShare, seed):
+    rng = random.Random(seed)
+    keys = []
+    for image in range(images):
+        key = 'photos/{:06d}.jpg'.format(image)
+        if rng.random() >= missingShare:
+            size = 2048 * KB if rng.random() < largeShare else rng.randint(20, 200) * KB
+            s3.put(SOURCE_BUCKET, key, os.urandom(size))
+        keys.append(key)
+    records = []
+    for number, key in enumerate(keys):
+        records.append({'Bucket': SOURCE_BUCKET, 'Key': key, 'ExternalImageId': 'ext-{}'.format(number),
+                        'CollectionId': 'old-collection', 'Faces': []})
+        if rng.random() < duplicateShare:
+            records.append(dict(records[-1], ExternalImageId='ext-{}-copy'.format(number)))
+    size = (len(records) - 1) // shards + 1
+    return {'shard-{:03d}.json'.format(number): records[number * size:(number + 1) * size] for number in range(shards)}
+
+
+class Interrupting:
+    # Destination client failing every call after `limit` copies, like a killed process
+
+    def __init__(self, client, limit):
+        self.client = client
+        self.limit = limit
+        self.copies = 0
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def call(**kwargs):
+            if name in ('copy_object', 'create_multipart_upload'):
+                self.copies += 1
+                if self.copies > self.limit:
+                    raise clientError('RequestTimeout', 'Interrupted', name)
+            return method(**kwargs)
+        return call
+
+
+def check(s3, shards, staged, collectionId):
+    source = s3.objects(SOURCE_BUCKET)
+    destination = s3.objects(DESTINATION_BUCKET)
+    expected = sum(1 for records in shards.values() for record in records if record['Key'] in source)
+    records = 0
+    for path in staged:
+        with open(path) as f:
+            for record in json.load(f):
+                records += 1
+                assert record['Bucket'] == DESTINATION_BUCKET and record['CollectionId'] == collectionId
+                assert destination[record['Key']]['Body'] == source[record['Key'].split('/', 1)[1]]['Body']
+    assert records == expected, (records, expected)
+    return records
+
+
+def run(s3, shards, workers, partWorkers, collectionId, limit=None):
+    workDir = tempfile.mkdtemp(prefix='staging-')
+    s3.buckets.pop(DESTINATION_BUCKET, None)
+    s3.buckets.pop(urlparse(RECORDS_LOCATION).netloc, None)
+    before = dict(s3.metrics.calls)
+    start = time.perf_counter()
+    interruptions = 0
+    crashed = []
+
+    def onStaged(path):
+        upload_shards(s3, [path], RECORDS_LOCATION)
+        if limit and not crashed:
+            # Killed after the upload, before the stager recorded it
+            crashed.append(path)
+            raise RuntimeError('Interrupted after uploading {}'.format(path))
+
+    while True:
+        destination = Interrupting(s3, limit) if limit else s3
+        stager = ImageStager(s3, destination, DESTINATION_BUCKET, workDir, 'staged/', collection_id=collectionId,
+                             workers=workers, part_workers=partWorkers, multipart_threshold=1024 * KB, part_size=256 * KB)
+        try:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                staged = stager.stage(sorted(shards), lambda name: shards[name], onStaged)
+            break
+        except RuntimeError:
+            interruptions += 1
+    elapsed = time.perf_counter() - start
+    calls = {operation: count - before.get((service, operation), 0) for (service, operation), count in s3.metrics.calls.items()}
+    # Every shard reaches the records/ folder exactly once, including the one uploaded before the crash
+    assert sorted(s3.objects(urlparse(RECORDS_LOCATION).netloc)) == ['records/' + name for name in sorted(shards)]
+    assert calls.get('PutObject', 0) == len(shards), calls.get('PutObject')
+    return check(s3, shards, staged, collectionId), elapsed, calls, interruptions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--images', type=int, default=400)
+    parser.add_argument('--large-share', type=float, default=0.05, help='share of images copied as multipart')
+    parser.add_argument('--missing-share', type=float, default=0.02)
+    parser.add_argument('--duplicate-share', type=float, default=0.08)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--copy-mbps', type=float, default=50.0, help='server-side copy throughput per request')
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--part-workers', type=int, default=8)
+    parser.add_argument('--interrupt-after', type=int, default=150, help='copies before the resumed run is interrupted')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    s3 = LocalS3(Metrics(), args.latency_ms, args.copy_mbps)
+    shards = buildShards(s3, args.shards, args.images, args.large_share, args.missing_share, args.duplicate_share, args.seed)
+    print("{} records in {} shards, {} source objects".format(sum(len(records) for records in shards.values()),
+                                                              len(shards), len(s3.objects(SOURCE_BUCKET))))
+
+    print("{:<22}{:>10}{:>10}{:>12}{:>12}{:>14}".format("run", "records", "seconds", "copies", "part copies", "interruptions"))
+    for name, workers, partWorkers, limit in (("sequential", 1, 1, None), ("pooled", args.workers, args.part_workers, None),
+                                              ("pooled, interrupted", args.workers, args.part_workers, args.interrupt_after)):
+        records, elapsed, calls, interruptions = run(s3, shards, workers, partWorkers, 'new-collection', limit)
+        print("{:<22}{:>10}{:>10.2f}{:>12}{:>12}{:>14}".format(name, records, elapsed, calls.get('CopyObject', 0),
+                                                              calls.get('UploadPartCopy', 0), interruptions))
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
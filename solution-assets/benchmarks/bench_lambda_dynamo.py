@@ -0,0 +1,117 @@
+# Local benchmark for lambda_dynamo: per-face put_item vs. buffered BatchWriteItem.
+# Runs against a stubbed DynamoDB client, no AWS account needed.
+#
+#   python bench_lambda_dynamo.py --faces 1000 --latency-ms 8 --throttle 0.05
+
+import argparse, json, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('dynamoTable', 'bench-results')
+
+import lambda_dynamo
+import results_store
+
+
+class StubDynamoClient:
+    # Every call sleeps for the configured latency; batch writes leave a random share of items unprocessed
+
+    def __init__(self, latencyMs, throttleRate, seed=7):
+        self.latency = latencyMs / 1000.0
+        self.throttleRate = throttleRate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.table = {}
+
+    def put_item(self, TableName, Item):
+        self.calls += 1
+        time.sleep(self.latency)
+        self.table[Item['OldFaceId']['S']] = Item
+        return {}
+
+    def batch_write_item(self, RequestItems):
+        self.calls += 1
+        time.sleep(self.latency)
+        unprocessed = {}
+        for tableName, requests in RequestItems.items():
+            assert len(requests) <= 25
+            for request in requests:
+                if self.random.random() < self.throttleRate:
+                    unprocessed.setdefault(tableName, []).append(request)
+                else:
+                    item = request['PutRequest']['Item']
+                    self.table[item['OldFaceId']['S']] = item
+        return {'UnprocessedItems': unprocessed}
+
+
+def buildEvent(totalFaces, facesPerImage, messagesPerBatch):
+    records = []
+    faceNumber = 0
+    while faceNumber < totalFaces:
+        faces = []
+        for _ in range(min(facesPerImage, totalFaces - faceNumber)):
+            faces.append({
+                "UserID": "user-{}".format(faceNumber),
+                "OldFaceId": "old-{}".format(faceNumber),
+                "OldImageId": "old-image-{}".format(faceNumber // facesPerImage),
+                "FaceId": "new-{}".format(faceNumber),
+                "ImageId": "new-image-{}".format(faceNumber // facesPerImage),
+                "BoundingBoxes": {"Width": 0.1, "Height": 0.1, "Left": 0.2, "Top": 0.2},
+                "IsNewFace": False
+            })
+            faceNumber += 1
+        payload = {"Bucket": "bucket", "Key": "image-{}.jpg".format(len(records)), "ExternalImageId": "ext", "Faces": faces}
+        records.append({"messageId": "msg-{}".format(len(records)), "body": json.dumps(payload)})
+
+    # Split into SQS batches the way the event source mapping would deliver them
+    return [{"Records": records[i:i + messagesPerBatch]} for i in range(0, len(records), messagesPerBatch)]
+
+
+def runLegacy(events, client):
+    # The previous implementation: one put_item per face
+    for event in events:
+        for record in event['Records']:
+            payload = json.loads(record["body"])
+            for item in lambda_dynamo.buildDynamoItems(payload):
+                client.put_item(TableName=os.environ["dynamoTable"], Item=item)
+
+
+def runBatched(events, client):
+    lambda_dynamo.dynClient = client
+    failed = 0
+    for event in events:
+        failed += len(lambda_dynamo.lambda_handler(event, None)['batchItemFailures'])
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--faces', type=int, default=1000)
+    parser.add_argument('--faces-per-image', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--latency-ms', type=float, default=8.0)
+    parser.add_argument('--throttle', type=float, default=0.05, help='share of batch items returned as UnprocessedItems')
+    args = parser.parse_args()
+
+    events = buildEvent(args.faces, args.faces_per_image, args.batch_size)
+    results_store.BACKOFF_BASE = 0.005
+
+    legacyClient = StubDynamoClient(args.latency_ms, 0)
+    start = time.perf_counter()
+    runLegacy(events, legacyClient)
+    legacyTime = time.perf_counter() - start
+
+    batchClient = StubDynamoClient(args.latency_ms, args.throttle)
+    start = time.perf_counter()
+    failed = runBatched(events, batchClient)
+    batchTime = time.perf_counter() - start
+
+    scale = 1000.0 / args.faces
+    print("{:<22}{:>18}{:>22}".format("mode", "round trips/1k", "wall time/1k (s)"))
+    print("{:<22}{:>18.0f}{:>22.3f}".format("put_item", legacyClient.calls * scale, legacyTime * scale))
+    print("{:<22}{:>18.0f}{:>22.3f}".format("batch_write_item", batchClient.calls * scale, batchTime * scale))
+    print("items written: {} / {} -- failed messages: {}".format(len(batchClient.table), args.faces, failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,801 @@
+# In-process stand-ins for the AWS services the solution talks to, used by the local simulators
+# and stress tests. They implement the subset of the low-level client API the lambda functions and
+# helper modules call, count every call per operation and can add a fixed per-call latency.
+#
+#   aws = LocalAWS(latencyMs=5)
+#   with aws.patched():          # boto3.client(...) / boto3.resource(...) return the stand-ins
+#       import lambda_processing
+
+import hashlib, heapq, itertools, json, random, re, threading, time, uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from decimal import Decimal
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+
+def clientError(code, message, operation, **extra):
+    response = {'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': 400}}
+    response.update(extra)
+    return ClientError(response, operation)
+
+
+class Metrics:
+
+    def __init__(self):
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, service, operation, n=1):
+        with self.lock:
+            self.calls[(service, operation)] += n
+
+    def total(self, service=None):
+        with self.lock:
+            return sum(count for (svc, _), count in self.calls.items() if service is None or svc == service)
+
+
+class Service:
+    name = None
+
+    def __init__(self, metrics, latencyMs=0.0):
+        self.metrics = metrics
+        self.latency = latencyMs / 1000.0
+
+    def call(self, operation):
+        self.metrics.count(self.name, operation)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_paginator(self, operation):
+        return Paginator(getattr(self, operation))
+
+
+class Paginator:
+    # Follows NextToken / ContinuationToken / LastEvaluatedKey like the botocore paginators
+
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if page.get('NextToken'):
+                kwargs['NextToken'] = page['NextToken']
+            elif page.get('NextContinuationToken'):
+                kwargs['ContinuationToken'] = page['NextContinuationToken']
+            elif page.get('LastEvaluatedKey'):
+                kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+            else:
+                return
+
+
+# --- SQS -------------------------------------------------------------------------------------
+
+class LocalQueue:
+
+    def __init__(self, name, visibilityTimeout=30, maxReceiveCount=None, deadLetterQueue=None, timeScale=1.0):
+        self.name = name
+        self.visibilityTimeout = visibilityTimeout
+        self.maxReceiveCount = maxReceiveCount
+        self.deadLetterQueue = deadLetterQueue
+        self.timeScale = timeScale
+        self.ready = deque()
+        self.waiting = []  # heap of (visibleAt, seq, message): delayed or released messages
+        self.inFlight = {}  # messageId -> message
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+    def send(self, body, delaySeconds=0):
+        message = {'messageId': str(uuid.uuid4()), 'body': body, 'sentAt': time.time(), 'receiveCount': 0}
+        with self.lock:
+            if delaySeconds:
+                heapq.heappush(self.waiting, (time.monotonic() + delaySeconds * self.timeScale, next(self.seq), message))
+            else:
+                self.ready.append(message)
+        return message['messageId']
+
+    def promote(self):
+        now = time.monotonic()
+        while self.waiting and self.waiting[0][0] <= now:
+            self.ready.append(heapq.heappop(self.waiting)[2])
+
+    def receive(self, maxMessages):
+        # Returns Lambda event records; messages over maxReceiveCount move to the dead-letter queue
+        records = []
+        with self.lock:
+            self.promote()
+            while self.ready and len(records) < maxMessages:
+                message = self.ready.popleft()
+                if self.maxReceiveCount and message['receiveCount'] >= self.maxReceiveCount:
+                    if self.deadLetterQueue is not None:
+                        self.deadLetterQueue.send(message['body'])
+                    continue
+                message['receiveCount'] += 1
+                self.inFlight[message['messageId']] = message
+                records.append({
+                    'messageId': message['messageId'],
+                    'body': message['body'],
+                    'attributes': {
+                        'ApproximateReceiveCount': str(message['receiveCount']),
+                        'SentTimestamp': str(int(message['sentAt'] * 1000))
+                    },
+                    'eventSource': 'aws:sqs'
+                })
+        return records
+
+    def delete(self, messageId):
+        with self.lock:
+            self.inFlight.pop(messageId, None)
+
+    def release(self, messageId):
+        # Message was not deleted: visible again once the visibility timeout expires
+        with self.lock:
+            message = self.inFlight.pop(messageId, None)
+            if message is not None:
+                heapq.heappush(self.waiting, (time.monotonic() + self.visibilityTimeout * self.timeScale, next(self.seq), message))
+
+    def attributes(self):
+        with self.lock:
+            self.promote()
+            return {
+                'ApproximateNumberOfMessages': str(len(self.ready)),
+                'ApproximateNumberOfMessagesNotVisible': str(len(self.inFlight) + len(self.waiting))
+            }
+
+    def __len__(self):
+        with self.lock:
+            return len(self.ready) + len(self.inFlight) + len(self.waiting)
+
+
+class LocalSQS(Service):
+    name = 'sqs'
+
+    def __init__(self, metrics, latencyMs=0.0, timeScale=1.0):
+        super().__init__(metrics, latencyMs)
+        self.timeScale = timeScale
+        self.queues = {}
+
+    def create_queue(self, QueueName, visibilityTimeout=30, maxReceiveCount=None, deadLetterQueue=None):
+        url = 'https://sqs.local/{}'.format(QueueName)
+        self.queues[url] = LocalQueue(QueueName, visibilityTimeout, maxReceiveCount, deadLetterQueue, self.timeScale)
+        return url
+
+    def queue(self, url):
+        if url not in self.queues:
+            raise clientError('AWS.SimpleQueueService.NonExistentQueue', 'The specified queue does not exist', 'SendMessage')
+        return self.queues[url]
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+        self.call('SendMessage')
+        return {'MessageId': self.queue(QueueUrl).send(MessageBody, DelaySeconds)}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.call('SendMessageBatch')
+        queue = self.queue(QueueUrl)
+        successful = []
+        for entry in Entries:
+            messageId = queue.send(entry['MessageBody'], entry.get('DelaySeconds', 0))
+            successful.append({'Id': entry['Id'], 'MessageId': messageId})
+        return {'Successful': successful, 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        # Received messages stay in flight until deleted (no visibility timeout), the receipt handle
+        # is the message id
+        self.call('ReceiveMessage')
+        records = self.queue(QueueUrl).receive(MaxNumberOfMessages)
+        return {'Messages': [{'MessageId': record['messageId'], 'ReceiptHandle': record['messageId'],
+                              'Body': record['body'], 'Attributes': record['attributes']} for record in records]}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.call('DeleteMessageBatch')
+        queue = self.queue(QueueUrl)
+        for entry in Entries:
+            queue.delete(entry['ReceiptHandle'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None):
+        self.call('GetQueueAttributes')
+        return {'Attributes': self.queue(QueueUrl).attributes()}
+
+
+# --- S3 --------------------------------------------------------------------------------------
+
+class Body:
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.data) - self.position
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def iter_lines(self):
+        for line in self.data.splitlines():
+            yield line
+
+    def close(self):
+        pass
+
+
+class LocalS3(Service):
+    name = 's3'
+
+    def __init__(self, metrics, latencyMs=0.0, copyMBps=None):
+        super().__init__(metrics, latencyMs)
+        self.buckets = {}  # bucket -> {key: {'Body': bytes, 'ETag': str, 'LastModified': float, 'Metadata': dict}}
+        self.uploads = {}  # UploadId -> {'Bucket', 'Key', 'Metadata', 'Parts': {number: (ETag, bytes)}}
+        self.lock = threading.Lock()
+        # Server-side copies take size / copyMBps on top of the call latency (None: instant)
+        self.copyRate = copyMBps * 1024 * 1024 if copyMBps else None
+
+    def objects(self, bucket):
+        with self.lock:
+            return self.buckets.setdefault(bucket, {})
+
+    def put(self, bucket, key, data, metadata=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.objects(bucket)[key] = {'Body': data, 'ETag': '"{}"'.format(hashlib.md5(data).hexdigest()),
+                                     'LastModified': time.time(), 'Metadata': dict(metadata or {})}
+
+    def get(self, bucket, key, operation):
+        obj = self.objects(bucket).get(key)
+        if obj is None:
+            # HeadObject has no body, so botocore only reports the status code
+            code = '404' if operation == 'HeadObject' else 'NoSuchKey'
+            raise clientError(code, 'Not Found', operation)
+        return obj
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.call('HeadObject')
+        obj = self.get(Bucket, Key, 'HeadObject')
+        return {'ContentLength': len(obj['Body']), 'ETag': obj['ETag'], 'Metadata': obj['Metadata']}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self.call('GetObject')
+        obj = self.get(Bucket, Key, 'GetObject')
+        data = obj['Body']
+        response = {'ETag': obj['ETag'], 'Metadata': obj['Metadata']}
+        if Range:
+            start, end = re.match(r'bytes=(\d+)-(\d*)', Range).groups()
+            data = data[int(start):int(end) + 1 if end else None]
+            response['ContentRange'] = 'bytes {}-{}/{}'.format(start, int(start) + len(data) - 1, len(obj['Body']))
+        response.update({'Body': Body(data), 'ContentLength': len(data)})
+        return response
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None, **kwargs):
+        self.call('PutObject')
+        self.put(Bucket, Key, Body.read() if hasattr(Body, 'read') else Body, Metadata)
+        return {'ETag': self.objects(Bucket)[Key]['ETag']}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, **kwargs):
+        with open(Filename, 'rb') as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read(), Metadata=(ExtraArgs or {}).get('Metadata'))
+
+    def transfer(self, size):
+        if self.copyRate:
+            time.sleep(size / self.copyRate)
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self.call('CopyObject')
+        source = self.get(CopySource['Bucket'], CopySource['Key'], 'CopyObject')
+        self.transfer(len(source['Body']))
+        self.put(Bucket, Key, source['Body'], source['Metadata'])
+        return {'CopyObjectResult': {'ETag': self.objects(Bucket)[Key]['ETag']}}
+
+    def upload(self, uploadId, operation):
+        with self.lock:
+            upload = self.uploads.get(uploadId)
+        if upload is None:
+            raise clientError('NoSuchUpload', 'The specified upload does not exist', operation)
+        return upload
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        self.call('CreateMultipartUpload')
+        uploadId = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[uploadId] = {'Bucket': Bucket, 'Key': Key, 'Metadata': dict(Metadata or {}), 'Parts': {}}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': uploadId}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange=None, **kwargs):
+        self.call('UploadPartCopy')
+        data = self.get(CopySource['Bucket'], CopySource['Key'], 'UploadPartCopy')['Body']
+        if CopySourceRange:
+            start, end = re.match(r'bytes=(\d+)-(\d+)', CopySourceRange).groups()
+            data = data[int(start):int(end) + 1]
+        self.transfer(len(data))
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        upload = self.upload(UploadId, 'UploadPartCopy')
+        with self.lock:
+            upload['Parts'][PartNumber] = (etag, data)
+        return {'CopyPartResult': {'ETag': etag}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.call('CompleteMultipartUpload')
+        upload = self.upload(UploadId, 'CompleteMultipartUpload')
+        parts = []
+        for part in MultipartUpload['Parts']:
+            stored = upload['Parts'].get(part['PartNumber'])
+            if stored is None or stored[0] != part['ETag']:
+                raise clientError('InvalidPart', 'Part {} was not uploaded'.format(part['PartNumber']), 'CompleteMultipartUpload')
+            parts.append(stored)
+        with self.lock:
+            del self.uploads[UploadId]
+        self.put(Bucket, Key, b''.join(data for _, data in parts), upload['Metadata'])
+        digest = hashlib.md5(b''.join(bytes.fromhex(etag.strip('"')) for etag, _ in parts)).hexdigest()
+        self.objects(Bucket)[Key]['ETag'] = '"{}-{}"'.format(digest, len(parts))
+        return {'Bucket': Bucket, 'Key': Key, 'ETag': self.objects(Bucket)[Key]['ETag']}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.call('AbortMultipartUpload')
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000, StartAfter='', **kwargs):
+        self.call('ListObjectsV2')
+        keys = sorted(key for key in self.objects(Bucket) if key.startswith(Prefix) and key > StartAfter)
+        start = int(ContinuationToken) if ContinuationToken else 0
+        page = keys[start:start + MaxKeys]
+        response = {'KeyCount': len(page), 'Contents': [
+            {'Key': key, 'Size': len(self.objects(Bucket)[key]['Body']), 'ETag': self.objects(Bucket)[key]['ETag']}
+            for key in page]}
+        if start + MaxKeys < len(keys):
+            response['IsTruncated'] = True
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+
+# --- DynamoDB --------------------------------------------------------------------------------
+
+def typedValue(value):
+    if 'N' in value:
+        return Decimal(value['N'])
+    if 'S' in value:
+        return value['S']
+    if 'BOOL' in value:
+        return value['BOOL']
+    return json.dumps(value, sort_keys=True)
+
+
+class Expression:
+    # Evaluates the small subset of condition and update expressions the solution uses:
+    # AND / OR / NOT / parentheses, attribute_exists / attribute_not_exists, = <> < <= > >=,
+    # SET (with if_not_exists, list_append and +), ADD and REMOVE.
+
+    TOKEN = re.compile(r'\s*(<>|<=|>=|[=<>(),+]|[#:]?[A-Za-z_][A-Za-z0-9_.]*)')
+
+    def __init__(self, names=None, values=None):
+        self.names = names or {}
+        self.values = values or {}
+
+    def tokenize(self, text):
+        tokens, position = [], 0
+        text = text.strip()
+        while position < len(text):
+            match = self.TOKEN.match(text, position)
+            if not match:
+                raise clientError('ValidationException', 'Invalid expression: {}'.format(text), 'Expression')
+            tokens.append(match.group(1))
+            position = match.end()
+        return tokens
+
+    def name(self, token):
+        return self.names.get(token, token)
+
+    def operand(self, token, item):
+        if token.startswith(':'):
+            return self.values[token]
+        return item.get(self.name(token))
+
+    # Conditions
+
+    def condition(self, text, item):
+        self.tokens = self.tokenize(text)
+        self.position = 0
+        return self.orExpression(item)
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def orExpression(self, item):
+        result = self.andExpression(item)
+        while self.peek() and self.peek().upper() == 'OR':
+            self.take()
+            right = self.andExpression(item)
+            result = result or right
+        return result
+
+    def andExpression(self, item):
+        result = self.notExpression(item)
+        while self.peek() and self.peek().upper() == 'AND':
+            self.take()
+            right = self.notExpression(item)
+            result = result and right
+        return result
+
+    def notExpression(self, item):
+        if self.peek() and self.peek().upper() == 'NOT':
+            self.take()
+            return not self.notExpression(item)
+        return self.comparison(item)
+
+    def comparison(self, item):
+        token = self.take()
+        if token == '(':
+            result = self.orExpression(item)
+            self.take()  # ')'
+            return result
+        if token in ('attribute_exists', 'attribute_not_exists'):
+            self.take()  # '('
+            path = self.name(self.take())
+            self.take()  # ')'
+            return (path in item) == (token == 'attribute_exists')
+        operator = self.take()
+        left = self.operand(token, item)
+        right = self.operand(self.take(), item)
+        if left is None or right is None:
+            return operator == '<>' and left != right
+        left, right = typedValue(left), typedValue(right)
+        return {'=': left == right, '<>': left != right, '<': left < right,
+                '<=': left <= right, '>': left > right, '>=': left >= right}[operator]
+
+    # Updates
+
+    def update(self, text, item):
+        clauses = re.split(r'\b(SET|ADD|REMOVE)\b', text.strip(), flags=re.IGNORECASE)
+        for keyword, body in zip(clauses[1::2], clauses[2::2]):
+            for action in self.splitActions(body):
+                getattr(self, 'apply' + keyword.upper().capitalize())(action, item)
+
+    def splitActions(self, body):
+        actions, depth, current = [], 0, ''
+        for char in body:
+            if char == ',' and depth == 0:
+                actions.append(current.strip())
+                current = ''
+                continue
+            depth += {'(': 1, ')': -1}.get(char, 0)
+            current += char
+        if current.strip():
+            actions.append(current.strip())
+        return actions
+
+    def value(self, text, item):
+        text = text.strip()
+        function = re.match(r'(if_not_exists|list_append)\s*\((.*)\)$', text)
+        if function:
+            first, second = self.splitActions(function.group(2))
+            if function.group(1) == 'if_not_exists':
+                current = item.get(self.name(first))
+                return current if current is not None else self.value(second, item)
+            return {'L': self.value(first, item)['L'] + self.value(second, item)['L']}
+        if '+' in text:
+            left, right = text.split('+', 1)
+            return {'N': str(typedValue(self.value(left, item)) + typedValue(self.value(right, item)))}
+        return self.operand(text, item)
+
+    def applySet(self, action, item):
+        path, expression = action.split('=', 1)
+        item[self.name(path.strip())] = self.value(expression, item)
+
+    def applyAdd(self, action, item):
+        path, value = action.split()
+        path, value = self.name(path), self.values[value]
+        if 'N' in value:
+            current = typedValue(item[path]) if path in item else Decimal(0)
+            item[path] = {'N': str(current + Decimal(value['N']))}
+        else:
+            setType = next(iter(value))
+            item[path] = {setType: sorted(set(item.get(path, {}).get(setType, [])) | set(value[setType]))}
+
+    def applyRemove(self, action, item):
+        item.pop(self.name(action.strip()), None)
+
+
+class ConditionalCheckFailedException(ClientError):
+    pass
+
+
+class LocalDynamoDB(Service):
+    name = 'dynamodb'
+
+    def __init__(self, metrics, latencyMs=0.0):
+        super().__init__(metrics, latencyMs)
+        self.tables = {}  # name -> (hashKey, {key: item})
+        self.lock = threading.Lock()
+        self.listeners = []  # callables(tableName, item) notified on every write
+        self.exceptions = mock.Mock(ConditionalCheckFailedException=ConditionalCheckFailedException)
+
+    def create_table(self, TableName, HashKey):
+        self.tables[TableName] = (HashKey, {})
+        return TableName
+
+    def table(self, name):
+        if name not in self.tables:
+            raise clientError('ResourceNotFoundException', 'Requested resource not found: {}'.format(name), 'DynamoDB')
+        return self.tables[name]
+
+    def keyOf(self, tableName, item):
+        value = item[self.table(tableName)[0]]
+        return value.get('S', value.get('N'))
+
+    def write(self, tableName, item):
+        hashKey, items = self.table(tableName)
+        items[self.keyOf(tableName, item)] = item
+        for listener in self.listeners:
+            listener(tableName, item)
+
+    def checkCondition(self, operation, ConditionExpression, names, values, current, returnOld):
+        if ConditionExpression and not Expression(names, values).condition(ConditionExpression, current or {}):
+            extra = {'Item': current} if returnOld == 'ALL_OLD' and current else {}
+            error = ConditionalCheckFailedException(
+                dict({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}}, **extra),
+                operation)
+            raise error
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValuesOnConditionCheckFailure=None, **kwargs):
+        self.call('PutItem')
+        with self.lock:
+            current = self.table(TableName)[1].get(self.keyOf(TableName, Item))
+            self.checkCondition('PutItem', ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                                current, ReturnValuesOnConditionCheckFailure)
+            self.write(TableName, dict(Item))
+        return {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.call('GetItem')
+        with self.lock:
+            item = self.table(TableName)[1].get(self.keyOf(TableName, Key))
+        return {'Item': dict(item)} if item else {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues=None, ReturnValuesOnConditionCheckFailure=None, **kwargs):
+        self.call('UpdateItem')
+        with self.lock:
+            hashKey, items = self.table(TableName)
+            current = items.get(self.keyOf(TableName, Key))
+            self.checkCondition('UpdateItem', ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                                current, ReturnValuesOnConditionCheckFailure)
+            item = dict(current) if current else dict(Key)
+            Expression(ExpressionAttributeNames, ExpressionAttributeValues).update(UpdateExpression, item)
+            self.write(TableName, item)
+        return {'Attributes': dict(item)} if ReturnValues == 'ALL_NEW' else {}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.call('BatchWriteItem')
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise clientError('ValidationException', 'Too many items requested for the BatchWriteItem call', 'BatchWriteItem')
+        with self.lock:
+            for tableName, requests in RequestItems.items():
+                for request in requests:
+                    if 'PutRequest' in request:
+                        self.write(tableName, dict(request['PutRequest']['Item']))
+                    else:
+                        self.table(tableName)[1].pop(self.keyOf(tableName, request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': {}}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self.call('BatchGetItem')
+        responses = {}
+        with self.lock:
+            for tableName, request in RequestItems.items():
+                items = self.table(tableName)[1]
+                found = [items.get(self.keyOf(tableName, key)) for key in request['Keys']]
+                responses[tableName] = [dict(item) for item in found if item]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def scan(self, TableName, Segment=0, TotalSegments=1, ExclusiveStartKey=None, Limit=1000, **kwargs):
+        self.call('Scan')
+        with self.lock:
+            hashKey, items = self.table(TableName)
+            keys = sorted(key for key in items if hash(key) % TotalSegments == Segment)
+        start = keys.index(ExclusiveStartKey[hashKey]['S']) + 1 if ExclusiveStartKey else 0
+        page = keys[start:start + Limit]
+        response = {'Items': [dict(items[key]) for key in page], 'Count': len(page)}
+        if start + Limit < len(keys):
+            response['LastEvaluatedKey'] = {hashKey: {'S': page[-1]}}
+        return response
+
+    def items(self, tableName):
+        with self.lock:
+            return list(self.table(tableName)[1].values())
+
+
+# --- Firehose and Step Functions -------------------------------------------------------------
+
+class LocalFirehose(Service):
+    name = 'firehose'
+
+    def __init__(self, metrics, latencyMs=0.0):
+        super().__init__(metrics, latencyMs)
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def put_record(self, DeliveryStreamName, Record):
+        self.call('PutRecord')
+        with self.lock:
+            self.records.setdefault(DeliveryStreamName, []).append(Record['Data'])
+        return {'RecordId': str(uuid.uuid4())}
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.call('PutRecordBatch')
+        with self.lock:
+            self.records.setdefault(DeliveryStreamName, []).extend(record['Data'] for record in Records)
+        return {'FailedPutCount': 0, 'RequestResponses': [{'RecordId': str(uuid.uuid4())} for _ in Records]}
+
+
+class LocalStepFunctions(Service):
+    name = 'stepfunctions'
+
+    def __init__(self, metrics, latencyMs=0.0):
+        super().__init__(metrics, latencyMs)
+        self.taskResults = {}  # taskToken -> (time, output)
+        self.executions = []
+        self.exceptions = mock.Mock(ExecutionAlreadyExists=type('ExecutionAlreadyExists', (ClientError,), {}))
+
+    def send_task_success(self, taskToken, output):
+        self.call('SendTaskSuccess')
+        self.taskResults[taskToken] = (time.time(), output)
+        return {}
+
+    def start_execution(self, stateMachineArn, input, name=None, **kwargs):
+        self.call('StartExecution')
+        executionArn = '{}:{}'.format(stateMachineArn.replace(':stateMachine:', ':execution:'), name or uuid.uuid4())
+        if any(execution['executionArn'] == executionArn for execution in self.executions):
+            raise self.exceptions.ExecutionAlreadyExists(
+                {'Error': {'Code': 'ExecutionAlreadyExists', 'Message': 'Execution Already Exists'}}, 'StartExecution')
+        self.executions.append({'executionArn': executionArn, 'input': input})
+        return {'executionArn': executionArn, 'startDate': time.time()}
+
+
+# --- Rekognition -----------------------------------------------------------------------------
+
+class QuotaBucket:
+    # Account-level TPS quota: calls beyond it are throttled, not delayed
+
+    def __init__(self, tps):
+        self.tps = float(tps)
+        self.tokens = self.tps
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tps, self.tokens + (now - self.updated) * self.tps)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class FakeRekognition(Service):
+    # IndexFaces returns the faces stored in the image object's 'faces' metadata (a JSON list of
+    # bounding boxes), so simulated manifests can be matched against what "Rekognition" finds.
+    # latencyMs is the median of a log-normal call latency; indexTps is the IndexFaces quota.
+    name = 'rekognition'
+
+    def __init__(self, metrics, s3, latencyMs=300.0, jitter=0.3, indexTps=50, listFacesTps=5, seed=7):
+        super().__init__(metrics, 0)
+        self.s3 = s3
+        self.medianLatency = latencyMs / 1000.0
+        self.jitter = jitter
+        self.indexQuota = QuotaBucket(indexTps)
+        self.listQuota = QuotaBucket(listFacesTps)
+        self.random = random.Random(seed)
+        self.randomLock = threading.Lock()
+        self.collections = {}  # CollectionId -> {FaceId: face}
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.throttles = 0
+        self.exceptions = mock.Mock(
+            ResourceNotFoundException=type('ResourceNotFoundException', (ClientError,), {}),
+            ThrottlingException=type('ThrottlingException', (ClientError,), {}))
+
+    def sleep(self):
+        with self.randomLock:
+            latency = self.medianLatency * self.random.lognormvariate(0, self.jitter) if self.medianLatency else 0
+        self.latencies.append(latency)
+        time.sleep(latency)
+
+    def throttle(self, quota, operation):
+        if not quota.take():
+            with self.lock:
+                self.throttles += 1
+            self.metrics.count(self.name, operation + 'Throttled')
+            raise clientError('ThrottlingException', 'Rate exceeded', operation)
+
+    def collection(self, collectionId, operation):
+        with self.lock:
+            if collectionId not in self.collections:
+                raise self.exceptions.ResourceNotFoundException(
+                    {'Error': {'Code': 'ResourceNotFoundException', 'Message': 'Collection not found'}}, operation)
+            return self.collections[collectionId]
+
+    def create_collection(self, CollectionId, **kwargs):
+        with self.lock:
+            self.collections.setdefault(CollectionId, {})
+        return {'StatusCode': 200}
+
+    def add_face(self, collectionId, boundingBox, externalImageId='', imageId=None, faceId=None):
+        face = {'FaceId': faceId or str(uuid.uuid4()), 'ImageId': imageId or str(uuid.uuid4()),
+                'ExternalImageId': externalImageId, 'BoundingBox': dict(boundingBox), 'Confidence': 99.9}
+        with self.lock:
+            self.collections.setdefault(collectionId, {})[face['FaceId']] = face
+        return face
+
+    def index_faces(self, CollectionId, Image, ExternalImageId='', QualityFilter='AUTO', **kwargs):
+        self.call('IndexFaces')
+        self.throttle(self.indexQuota, 'IndexFaces')
+        self.collection(CollectionId, 'IndexFaces')
+        self.sleep()
+        obj = self.s3.get(Image['S3Object']['Bucket'], Image['S3Object']['Name'], 'IndexFaces')
+        boxes = json.loads(obj['Metadata'].get('faces', '[]'))
+        imageId = str(uuid.uuid4())
+        records = []
+        for box in boxes:
+            face = self.add_face(CollectionId, box, ExternalImageId, imageId)
+            records.append({'Face': dict(face), 'FaceDetail': {'BoundingBox': dict(box), 'Confidence': 99.9}})
+        return {'FaceRecords': records, 'UnindexedFaces': [], 'FaceModelVersion': '7.0'}
+
+    def list_faces(self, CollectionId, MaxResults=1000, NextToken=None, **kwargs):
+        self.call('ListFaces')
+        self.throttle(self.listQuota, 'ListFaces')
+        faces = self.collection(CollectionId, 'ListFaces')
+        self.sleep()
+        with self.lock:
+            faceIds = sorted(faces)
+        start = int(NextToken) if NextToken else 0
+        page = faceIds[start:start + MaxResults]
+        response = {'Faces': [dict(faces[faceId]) for faceId in page], 'FaceModelVersion': '7.0'}
+        if start + MaxResults < len(faceIds):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+
+# --- Wiring ----------------------------------------------------------------------------------
+
+class LocalAWS:
+
+    def __init__(self, latencyMs=0.0, timeScale=1.0, rekognitionLatencyMs=300.0, indexTps=50, listFacesTps=5, seed=7):
+        self.metrics = Metrics()
+        self.sqs = LocalSQS(self.metrics, latencyMs, timeScale)
+        self.s3 = LocalS3(self.metrics, latencyMs)
+        self.dynamodb = LocalDynamoDB(self.metrics, latencyMs)
+        self.firehose = LocalFirehose(self.metrics, latencyMs)
+        self.stepfunctions = LocalStepFunctions(self.metrics, latencyMs)
+        self.rekognition = FakeRekognition(self.metrics, self.s3, rekognitionLatencyMs, indexTps=indexTps,
+                                           listFacesTps=listFacesTps, seed=seed)
+
+    def client(self, service, *args, **kwargs):
+        services = {'sqs': self.sqs, 's3': self.s3, 'dynamodb': self.dynamodb, 'firehose': self.firehose,
+                    'stepfunctions': self.stepfunctions, 'rekognition': self.rekognition}
+        if service not in services:
+            raise ValueError("No local stand-in for {}".format(service))
+        return services[service]
+
+    @contextmanager
+    def patched(self):
+        # boto3 sessions, clients and resources created inside the block use the stand-ins
+        session = mock.Mock()
+        session.client.side_effect = self.client
+        with mock.patch('boto3.client', side_effect=self.client), \
+                mock.patch('boto3.resource', side_effect=self.client), \
+                mock.patch('boto3.Session', return_value=session), \
+                mock.patch('boto3.session.Session', return_value=session):
+            yield self
@@ -0,0 +1,71 @@
+# Simulated queue / throttle model for concurrency_controller.AimdController.
+#
+# Each reindex execution environment offers `per_env_tps` IndexFaces calls per second; anything
+# above the account quota is throttled. Halfway through, another workload takes part of the quota.
+# The controller should settle just under quota / per_env_tps in both phases, with bounded throttling
+# once it has found the ceiling.
+#
+#   python simulate_concurrency_controller.py --quota 50 --per-env-tps 1.2
+
+import argparse, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions'))
+
+from concurrency_controller import AimdController
+
+WINDOW_SECONDS = 300
+
+
+def simulate(controller, quota, perEnvTps, rounds, initial, backlog, competingShare):
+    concurrency, state, trace = initial, {}, []
+    for step in range(rounds):
+        available = quota * (1 - competingShare) if step >= rounds // 2 else quota
+        offered = concurrency * perEnvTps
+        served = min(offered, available)
+        signals = {
+            "throttles": int((offered - served) * WINDOW_SECONDS),
+            "requests": int(served * WINDOW_SECONDS),
+            "failed": 0,
+            "records": int(offered * WINDOW_SECONDS),
+            "backlog": backlog,
+        }
+        backlog = max(0, backlog - int(served * WINDOW_SECONDS))
+        concurrency, reason, state = controller.decide(concurrency, signals, state)
+        trace.append((step, available, concurrency, reason, signals["throttles"]))
+    return trace
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quota', type=float, default=50)
+    parser.add_argument('--per-env-tps', type=float, default=1.2)
+    parser.add_argument('--rounds', type=int, default=60)
+    parser.add_argument('--initial', type=int, default=5)
+    parser.add_argument('--competing-share', type=float, default=0.3)
+    parser.add_argument('--max-concurrency', type=int, default=1000)
+    args = parser.parse_args()
+
+    controller = AimdController(maximum=args.max_concurrency)
+    trace = simulate(controller, args.quota, args.per_env_tps, args.rounds, args.initial, 10 ** 9, args.competing_share)
+
+    print("{:>5}{:>12}{:>14}{:>10}{:>12}".format("step", "quota", "concurrency", "reason", "throttles"))
+    for step, available, concurrency, reason, throttles in trace:
+        print("{:>5}{:>12.1f}{:>14}{:>10}{:>12}".format(step, available, concurrency, reason, throttles))
+
+    # Converged: the last rounds of each phase stay within 2 environments of the ideal value, and once
+    # the ceiling is found at most one round in holdRounds + 1 goes over the quota
+    half = args.rounds // 2
+    for phaseStart, phaseEnd, available in ((0, half, args.quota), (half, args.rounds, args.quota * (1 - args.competing_share))):
+        ideal = available / args.per_env_tps
+        tail = [concurrency for _, _, concurrency, _, _ in trace[phaseEnd - 5:phaseEnd]]
+        print("ideal {:.1f} -- last rounds {}".format(ideal, tail))
+        assert all(abs(value - ideal) <= 2 for value in tail), (ideal, tail)
+        settled = trace[phaseStart + 10:phaseEnd]
+        throttled = [step for step, _, _, reason, _ in settled if reason == "throttled"]
+        assert len(throttled) <= len(settled) // (controller.holdRounds + 1) + 1, throttled
+        # Probes only go one environment over the ceiling: a throttled round costs a few percent of its calls
+        assert all(throttles <= 0.05 * available * WINDOW_SECONDS for step, _, _, reason, throttles in settled), settled
+    print("ok")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# Simulated multi-job run for job_scheduler.JobScheduler.
+#
+# Several jobs share the reindex queue and the IndexFaces TPS: a bulk backfill starts first, then
+# jobs of other business units with standard and interactive priority. Each job's Map state runs
+# --map-concurrency batches of 40 records at a time and the ReIndexing side drains the queue in
+# arrival order at the TPS quota. Time is simulated in 1 second steps.
+#   FIFO      - the Processor enqueues every batch as soon as it is read (JobScheduling Off)
+#   FairShare - the Processor takes tokens from the job's bucket first (the real JobScheduler against
+#               the local DynamoDB stand-in, on a simulated clock); batches that cannot be admitted in
+#               time go back to the Map state; the allocation runs every minute and when a
+#               refused batch finds it older than 5 seconds
+# Reports the completion time of every job under both modes and checks that the scheduler keeps the
+# TPS busy (makespan close to FIFO) while the interactive job finishes close to its time alone.
+# Then runs one Map batch through the real Processor handler and checks that the tokens of the
+# records that did not become IndexFaces jobs (invalid, missing, collapsed) go back to the job.
+#
+#   python simulate_job_scheduler.py --tps 50 --map-concurrency 100
+
+import argparse, collections, contextlib, math, os, random, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from local_aws import LocalAWS, LocalDynamoDB, Metrics
+from job_scheduler import JobScheduler
+from simulate_pipeline import buildManifest, loadHandler, parseDistribution, RESULTS_TABLE
+
+MAP_BATCH_SIZE = 40  # ItemBatcher MaxItemsPerBatch in template.yaml
+ADMISSION_WAIT_SECONDS = 30  # lambda_processing
+ALLOCATION_PERIOD = 60  # Scheduler schedule
+MAX_RETRY_DELAY = 60  # JobThrottled retry of the Map state
+
+# name, priority, weight, records, start second
+JOBS = [
+    ("backfill", "bulk", 1, 150000, 0),
+    ("unit-a", "standard", 1, 30000, 300),
+    ("unit-b", "standard", 2, 30000, 300),
+    ("lookup", "interactive", 1, 6000, 900),
+]
+
+
+class Job:
+
+    def __init__(self, name, priority, weight, records, start, mapConcurrency):
+        self.name, self.priority, self.weight, self.start = name, priority, weight, start
+        self.unread = records
+        self.served = 0
+        self.records = records
+        self.finished = None
+        self.servedAt = {}  # second -> records served of every job, at the start and end of this one
+        # Next time each Map child of the job tries to enqueue its batch
+        self.children = [start] * min(mapConcurrency, math.ceil(records / MAP_BATCH_SIZE))
+        self.batches = [0] * len(self.children)
+
+
+def nextBatch(job):
+    batch = min(MAP_BATCH_SIZE, job.unread)
+    job.unread -= batch
+    return batch
+
+
+def simulate(args, fairShare):
+    rng = random.Random(args.seed)
+    clock = [0.0]
+    scheduler = None
+    if fairShare:
+        dynamodb = LocalDynamoDB(Metrics())
+        scheduler = JobScheduler(dynamodb.create_table('Scheduler', 'JobId'), dynamodb, clock=lambda: clock[0])
+    jobs = [Job(*spec, mapConcurrency=args.map_concurrency) for spec in JOBS]
+    queue = collections.deque()  # [job, records]
+    depth, maxDepth, second = 0, 0, 0
+    while any(job.finished is None for job in jobs):
+        clock[0] = second
+        for job in jobs:
+            if job.start == second and scheduler:
+                # lambda_stepfunctions.start_job
+                scheduler.register(job.name, job.priority, job.weight)
+                scheduler.allocate(args.tps)
+        if scheduler and second % ALLOCATION_PERIOD == 0:
+            scheduler.allocate(args.tps)
+
+        # Map children: each one holds a batch until it is enqueued, then reads the next one
+        for job in jobs:
+            for child, at in enumerate(job.children):
+                if at is None or at > second:
+                    continue
+                if not job.batches[child]:
+                    job.batches[child] = nextBatch(job)
+                    if not job.batches[child]:
+                        job.children[child] = None
+                        continue
+                if scheduler:
+                    wait = scheduler.admit(job.name, job.batches[child])
+                    if wait:
+                        scheduler.throttled(job.name)
+                        if scheduler.reallocate(args.tps):
+                            wait = scheduler.admit(job.name, job.batches[child])
+                    if wait:
+                        if wait > ADMISSION_WAIT_SECONDS:
+                            job.children[child] = second + rng.uniform(1, MAX_RETRY_DELAY)
+                        else:
+                            job.children[child] = second + wait * rng.uniform(1.0, 1.2)
+                        continue
+                queue.append([job, job.batches[child]])
+                depth += job.batches[child]
+                job.batches[child] = 0
+                # Processor invocation and the next Map iteration
+                job.children[child] = second + 1
+        maxDepth = max(maxDepth, depth)
+
+        # ReIndexing side: IndexFaces at the quota, in queue order
+        capacity = args.tps
+        while capacity and queue:
+            entry = queue[0]
+            served = min(capacity, entry[1])
+            entry[1] -= served
+            capacity -= served
+            depth -= served
+            entry[0].served += served
+            if not entry[1]:
+                queue.popleft()
+        for job in jobs:
+            if job.start == second:
+                job.servedAt[second] = {other.name: other.served for other in jobs}
+            if job.finished is None and job.served == job.records:
+                job.finished = second + 1
+                job.servedAt[second + 1] = {other.name: other.served for other in jobs}
+        second += 1
+    return jobs, maxDepth
+
+
+def checkRefunds(tps, seed):
+    # Returns (records, jobs enqueued, tokens admitted to the job)
+    aws = LocalAWS(rekognitionLatencyMs=0)
+    queueUrl = aws.sqs.create_queue('FaceReindexQueue')
+    aws.dynamodb.create_table(RESULTS_TABLE, 'OldFaceId')
+    os.environ.update({'AWS_DEFAULT_REGION': 'us-east-1', 'reindexsqsurl': queueUrl, 'kinesis_stream': 'ValidationResults',
+                       'dynamoTable': RESULTS_TABLE, 'indexfacestps': str(tps),
+                       'schedulertable': aws.dynamodb.create_table('Scheduler', 'JobId')})
+    manifest = buildManifest(aws, MAP_BATCH_SIZE, parseDistribution("1:0.7,2:0.3"), 'new-collection', seed, duplicates=0.2)
+    del manifest[0]['ExternalImageId']
+    manifest[1]['Key'] = 'images/missing.jpg'
+    scheduler = JobScheduler(os.environ['schedulertable'], aws.dynamodb)
+    with aws.patched():
+        handler = loadHandler('lambda_processing')
+        scheduler.register('job-refund', 'standard', 1)
+        scheduler.allocate(tps)
+        handler({'Items': manifest, 'BatchInput': {'executionId': 'arn:aws:states:us-east-1:000000000000:execution:RIS:job-refund-0'}}, None)
+    return len(manifest), len(aws.sqs.queue(queueUrl)), int(float(scheduler.get('job-refund')['Admitted']['N']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tps', type=float, default=50)
+    parser.add_argument('--map-concurrency', type=int, default=100, help='Map batches in flight per job')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    results = {}
+    # The scheduler's allocation log lines are left out
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for name, fairShare in (("FIFO", False), ("FairShare", True)):
+            results[name] = simulate(args, fairShare)
+        records, enqueued, admitted = checkRefunds(args.tps, args.seed)
+
+    print("{:<10}{:>12}{:>8}{:>10}{:>8}{:>18}{:>18}".format("job", "priority", "weight", "records", "start",
+                                                             "FIFO seconds", "FairShare seconds"))
+    fifo, fair = results["FIFO"][0], results["FairShare"][0]
+    for before, after in zip(fifo, fair):
+        print("{:<10}{:>12}{:>8}{:>10}{:>8}{:>18}{:>18}".format(before.name, before.priority, before.weight, before.records,
+                                                                before.start, before.finished - before.start,
+                                                                after.finished - after.start))
+    makespans = {name: max(job.finished for job in jobs) for name, (jobs, _) in results.items()}
+    print("\nmakespan: FIFO {} s, FairShare {} s; deepest reindex queue: FIFO {} records, FairShare {} records".format(
+        makespans["FIFO"], makespans["FairShare"], results["FIFO"][1], results["FairShare"][1]))
+
+    # The TPS is used as long as a job has records left, except for the share of a finished job until
+    # the allocator sees it idle
+    ideal = math.ceil(sum(job.records for job in fair) / args.tps)
+    assert makespans["FairShare"] <= ideal * 1.08, (makespans["FairShare"], ideal)
+    # The interactive job gets most of the TPS: it finishes within 1.5x the time it would take alone
+    lookup = next(job for job in fair if job.priority == "interactive")
+    assert lookup.finished - lookup.start <= 1.5 * lookup.records / args.tps, lookup.finished - lookup.start
+    # Bulk work is not starved while the interactive job runs
+    served = [lookup.servedAt[second]["backfill"] for second in (lookup.start, lookup.finished)]
+    assert served[1] > served[0], served
+    # Processor handler: only the enqueued IndexFaces jobs keep their tokens
+    print("Processor batch: {} records, {} IndexFaces jobs enqueued, {} tokens kept by the job".format(records, enqueued, admitted))
+    assert enqueued < records and admitted == enqueued, (records, enqueued, admitted)
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
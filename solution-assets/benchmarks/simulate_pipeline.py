@@ -0,0 +1,410 @@
+# Offline throughput simulator for the whole reindexing pipeline.
+#
+# Drives the real handlers (lambda_processing, lambda_reindex, lambda_dynamo, lambda_checksqs and,
+# with --tracker, lambda_completion) against the in-process stand-ins of local_aws.py:
+#   - the Map state is a thread pool invoking the Processing function with batches of 40 items,
+#   - each SQS event source mapping is a pool of pollers invoking its function with ReportBatchItemFailures
+#     semantics, redelivering failed messages after the (scaled) visibility timeout,
+#   - Rekognition IndexFaces has a log-normal latency and a TPS quota; calls above it are throttled.
+# Queue delays and visibility timeouts are multiplied by --time-scale so runs stay short.
+#
+# Reports images/s, AWS calls per image, p50/p99 end-to-end image latency (Map batch start to the
+# first results or logs write) and billed Lambda milliseconds per function.
+#
+#   python simulate_pipeline.py --images 2000 --index-tps 50 --reindex-concurrency 50
+#   python simulate_pipeline.py --images 2000 --json > baseline.json
+#   python simulate_pipeline.py --images 2000 --baseline baseline.json --tolerance 0.1
+
+import argparse, contextlib, importlib.util, json, math, os, random, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_FUNCTIONS = os.path.join(BENCHMARKS, '..', 'lambda_functions')
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, LAMBDA_FUNCTIONS)
+
+from local_aws import LocalAWS
+
+MAP_BATCH_SIZE = 40  # ItemBatcher MaxItemsPerBatch in template.yaml
+STORE_BATCH_SIZE = 10
+MEMORY_MB = 128
+IMAGE_BUCKET = 'photos-bucket'
+RESULTS_TABLE = 'ReIndexResults'
+REINDEX_VISIBILITY = 60  # ReindexQueueSettings in template.yaml
+EXPORT_BUCKET = 'ris-results-export'
+
+
+def parseDistribution(text):
+    # "0:0.05,1:0.8,2:0.1,3:0.05" -> [(faces, cumulative weight)]
+    pairs = [(int(faces), float(weight)) for faces, weight in (part.split(':') for part in text.split(','))]
+    total = sum(weight for _, weight in pairs)
+    cumulative, running = [], 0.0
+    for faces, weight in pairs:
+        running += weight / total
+        cumulative.append((faces, running))
+    return cumulative
+
+
+def sampleFaces(rng, distribution):
+    point = rng.random()
+    for faces, cumulative in distribution:
+        if point <= cumulative:
+            return faces
+    return distribution[-1][0]
+
+
+def buildManifest(aws, images, distribution, collectionId, seed, duplicates=0.0):
+    # One image object per record; the faces the Rekognition fake will find are stored in the object
+    # metadata and the manifest provides the same boxes, slightly shifted, as the "old" faces.
+    # A `duplicates` share of the records point at the previous record's image under another
+    # ExternalImageId, like images indexed twice in a legacy collection.
+    rng = random.Random(seed)
+    manifest = []
+    for number in range(images):
+        if manifest and rng.random() < duplicates:
+            key = manifest[-1]['Key']
+            boxes = [face['BoundingBoxes'] for face in manifest[-1]['Faces']]
+            boxes = [dict(box, Left=box['Left'] - 0.005) for box in boxes]
+        else:
+            count = sampleFaces(rng, distribution)
+            boxes = []
+            for position in range(count):
+                left = (position % 4) * 0.25 + 0.02
+                top = (position // 4) * 0.25 + 0.02
+                boxes.append({'Width': 0.2, 'Height': 0.2, 'Left': round(left, 4), 'Top': round(top, 4)})
+            key = 'images/{:08d}.jpg'.format(number)
+            # Distinct content per image: the Processor also collapses identical objects by ETag
+            body = b'\xff\xd8' + key.encode('utf-8') + bytes(1024)
+            aws.s3.put(IMAGE_BUCKET, key, body, {'faces': json.dumps(boxes)})
+        manifest.append({
+            'Bucket': IMAGE_BUCKET,
+            'Key': key,
+            'ExternalImageId': 'ext-{:08d}'.format(number),
+            'CollectionId': collectionId,
+            'Faces': [{
+                'UserId': 'user-{}'.format(number),
+                'FaceId': 'old-{:08d}-{}'.format(number, position),
+                'ImageId': 'old-image-{:08d}'.format(number),
+                'BoundingBoxes': dict(box, Left=box['Left'] + 0.005)
+            } for position, box in enumerate(boxes)]
+        })
+    return manifest
+
+
+class Invocations:
+    # Billed duration per function: every invocation is rounded up to the next millisecond
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.billedMs = {}
+        self.count = {}
+        self.errors = {}
+
+    def invoke(self, name, handler, event):
+        start = time.perf_counter()
+        try:
+            return handler(event, None)
+        except Exception:
+            with self.lock:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            raise
+        finally:
+            billed = math.ceil((time.perf_counter() - start) * 1000)
+            with self.lock:
+                self.billedMs[name] = self.billedMs.get(name, 0) + billed
+                self.count[name] = self.count.get(name, 0) + 1
+
+
+class EventSourceMapping:
+    # SQS event source mapping with ReportBatchItemFailures: deletes the successful messages and lets
+    # the failed ones (or the whole batch if the function raises) become visible again. Every poller
+    # is one execution environment with its own copy of the handler module, so module-level state
+    # (clients, token bucket, buffers) is per environment as in Lambda.
+
+    def __init__(self, name, queue, module, invocations, batchSize, concurrency):
+        self.name = name
+        self.queue = queue
+        self.module = module
+        self.invocations = invocations
+        self.batchSize = batchSize
+        self.concurrency = concurrency
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def poll(self, handler):
+        while not self.stopped.is_set():
+            records = self.queue.receive(self.batchSize)
+            if not records:
+                time.sleep(0.005)
+                continue
+            try:
+                response = self.invocations.invoke(self.name, handler, {'Records': records}) or {}
+                failed = {failure['itemIdentifier'] for failure in response.get('batchItemFailures', [])}
+            except Exception:
+                failed = {record['messageId'] for record in records}
+            for record in records:
+                if record['messageId'] in failed:
+                    self.queue.release(record['messageId'])
+                else:
+                    self.queue.delete(record['messageId'])
+
+    def start(self):
+        for environment in range(self.concurrency):
+            handler = loadHandler(self.module, environment)
+            thread = threading.Thread(target=self.poll, args=(handler,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+
+
+class LatencyTracker:
+    # Image latency: Map batch start to the first write of its results or error logs
+
+    def __init__(self, logsTable):
+        self.logsTable = logsTable
+        self.started = {}
+        self.finished = {}
+        self.lock = threading.Lock()
+
+    def start(self, items):
+        now = time.perf_counter()
+        with self.lock:
+            for item in items:
+                self.started.setdefault(item['Key'], now)
+
+    def onWrite(self, tableName, item):
+        if tableName == RESULTS_TABLE and 'Key' in item:
+            key = item['Key']['S']
+        elif tableName == self.logsTable and 'Payload' in item:
+            key = json.loads(item['Payload']['S']).get('Key')
+        else:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            self.finished.setdefault(key, now)
+
+    def latencies(self):
+        with self.lock:
+            return sorted(self.finished[key] - self.started[key] for key in self.finished if key in self.started)
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def configureEnvironment(args, aws):
+    reindexDlq = aws.sqs.create_queue('FaceReindexDLQ')
+    storeDlq = aws.sqs.create_queue('StoreQueueDLQ')
+    reindexQueue = aws.sqs.create_queue('FaceReindexQueue', visibilityTimeout=REINDEX_VISIBILITY, maxReceiveCount=5,
+                                        deadLetterQueue=aws.sqs.queues[reindexDlq])
+    storeQueue = aws.sqs.create_queue('StoreQueue', visibilityTimeout=30, maxReceiveCount=5,
+                                      deadLetterQueue=aws.sqs.queues[storeDlq])
+    aws.dynamodb.create_table(RESULTS_TABLE, 'OldFaceId')
+    aws.dynamodb.create_table('ReIndexLogs', 'FaceId')
+    env = {
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'reindexsqsurl': reindexQueue,
+        'dynamosqsurl': storeQueue,
+        'kinesis_stream': 'ValidationResults',
+        'dynamologs': 'ReIndexLogs',
+        'dynamoTable': RESULTS_TABLE,
+        'qualityfilter': 'AUTO',
+        'indexfacestps': str(args.index_tps),
+        'maxconcurrency': str(args.reindex_concurrency),
+        'directpersist': 'true' if args.direct_persist else 'false',
+        'maxreceivecount': '5',
+        'queuevisibility': str(REINDEX_VISIBILITY),
+    }
+    if args.tracker:
+        env['progresstable'] = aws.dynamodb.create_table('JobProgress', 'ExecutionId')
+    if args.ledger:
+        env['ledgertable'] = aws.dynamodb.create_table('ImageLedger', 'ImageKey')
+    if args.scheduler:
+        env['schedulertable'] = aws.dynamodb.create_table('Scheduler', 'JobId')
+    if args.export:
+        env['exportlocation'] = 's3://{}/results/'.format(EXPORT_BUCKET)
+    os.environ.update(env)
+    return reindexQueue, storeQueue, reindexDlq, storeDlq
+
+
+def loadHandler(name, environment=0):
+    # A fresh module object per execution environment, created inside the patched block so its
+    # clients are the local stand-ins
+    spec = importlib.util.spec_from_file_location('{}_env{}'.format(name, environment),
+                                                  os.path.join(LAMBDA_FUNCTIONS, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.lambda_handler
+
+
+def simulate(args):
+    aws = LocalAWS(latencyMs=args.aws_latency_ms, timeScale=args.time_scale,
+                   rekognitionLatencyMs=args.index_latency_ms, indexTps=args.index_tps, seed=args.seed)
+    aws.rekognition.create_collection(CollectionId='new-collection')
+    reindexQueue, storeQueue, reindexDlq, storeDlq = configureEnvironment(args, aws)
+    manifest = buildManifest(aws, args.images, parseDistribution(args.faces), 'new-collection', args.seed, args.duplicates)
+    aws.metrics.calls.clear()
+
+    latency = LatencyTracker('ReIndexLogs')
+    aws.dynamodb.listeners.append(latency.onWrite)
+    invocations = Invocations()
+    executionId = 'arn:aws:states:us-east-1:000000000000:execution:RIS-local:simulation'
+
+    with aws.patched(), open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        processing = [loadHandler('lambda_processing', environment) for environment in range(args.map_concurrency)]
+        checkSqs = loadHandler('lambda_checksqs')
+        mappings = [
+            EventSourceMapping('ReIndexing', aws.sqs.queues[reindexQueue], 'lambda_reindex', invocations,
+                               args.reindex_batch_size, args.reindex_concurrency),
+            EventSourceMapping('StoreResults', aws.sqs.queues[storeQueue], 'lambda_dynamo', invocations,
+                               STORE_BATCH_SIZE, args.store_concurrency),
+        ]
+        start, startWall = time.perf_counter(), time.time()
+        for mapping in mappings:
+            mapping.start()
+
+        environments = threading.local()
+        available = list(processing)
+
+        def processBatch(items):
+            if not hasattr(environments, 'handler'):
+                environments.handler = available.pop()
+            latency.start(items)
+            for attempt in range(100000):
+                try:
+                    invocations.invoke('Processor', environments.handler,
+                                       {'Items': items, 'BatchInput': {'executionId': executionId, 'resume': False}})
+                    return
+                except Exception as e:
+                    # JobThrottled retry of the Map state (--scheduler): backoff with full jitter
+                    if type(e).__name__ != 'JobThrottled':
+                        raise
+                    time.sleep(random.uniform(0, min(60, 5 * 2 ** attempt)) * args.time_scale)
+
+        batches = [manifest[i:i + MAP_BATCH_SIZE] for i in range(0, len(manifest), MAP_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=args.map_concurrency) as executor:
+            list(executor.map(processBatch, batches))
+        mapDone = time.perf_counter()
+
+        if args.tracker:
+            invocations.invoke('Completion', loadHandler('lambda_completion'),
+                               {'executionId': executionId, 'taskToken': 'simulation'})
+
+        # Workflow tail: wait for the completion callback (--tracker) or poll CheckSQS
+        callbackAt = None
+        while True:
+            if args.tracker and 'simulation' in aws.stepfunctions.taskResults:
+                callbackAt = aws.stepfunctions.taskResults['simulation'][0]
+            response = invocations.invoke('CheckSQS', checkSqs, {})
+            if response['queuesAreEmpty']:
+                break
+            if time.perf_counter() - start > args.max_seconds:
+                break
+            time.sleep(max(0.05, args.check_interval * args.time_scale))
+        elapsed = time.perf_counter() - start
+        for mapping in mappings:
+            mapping.stop()
+
+    latencies = latency.latencies()
+    calls = {'{}.{}'.format(service, operation): count for (service, operation), count in sorted(aws.metrics.calls.items())}
+    apiCalls = sum(count for name, count in calls.items() if not name.endswith('Throttled'))
+    gbSeconds = sum(invocations.billedMs.values()) / 1000.0 * MEMORY_MB / 1024.0
+    return {
+        'images': args.images,
+        'completedImages': len(latencies),
+        'seconds': round(elapsed, 3),
+        'mapSeconds': round(mapDone - start, 3),
+        'imagesPerSecond': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'apiCallsPerImage': round(apiCalls / float(args.images), 3),
+        'indexFacesPerImage': round(calls.get('rekognition.IndexFaces', 0) / float(args.images), 3),
+        'throttles': aws.rekognition.throttles,
+        'p50LatencySeconds': round(percentile(latencies, 0.5), 3),
+        'p99LatencySeconds': round(percentile(latencies, 0.99), 3),
+        'billedLambdaMs': dict(sorted(invocations.billedMs.items())),
+        'billedLambdaMsPerImage': round(sum(invocations.billedMs.values()) / float(args.images), 2),
+        'lambdaGbSeconds': round(gbSeconds, 3),
+        'invocations': dict(sorted(invocations.count.items())),
+        'deadLetters': len(aws.sqs.queues[reindexDlq]) + len(aws.sqs.queues[storeDlq]),
+        'results': len(aws.dynamodb.items(RESULTS_TABLE)),
+        'exportParts': len(aws.s3.objects(EXPORT_BUCKET)),
+        'exportBytes': sum(len(obj['Body']) for obj in aws.s3.objects(EXPORT_BUCKET).values()),
+        'callbackSeconds': round(callbackAt - startWall, 3) if callbackAt else None,
+        'calls': calls,
+    }
+
+
+def printReport(report):
+    print("Images: {images} -- completed: {completedImages} -- dead letters: {deadLetters} -- results rows: {results}".format(**report))
+    print("Wall time: {seconds}s (Map state {mapSeconds}s) -- {imagesPerSecond} images/s".format(**report))
+    print("Image latency: p50 {p50LatencySeconds}s -- p99 {p99LatencySeconds}s".format(**report))
+    print("AWS calls per image: {apiCallsPerImage} -- IndexFaces per image: {indexFacesPerImage} -- throttled: {throttles}".format(**report))
+    print("Billed Lambda: {billedLambdaMsPerImage} ms per image -- {lambdaGbSeconds} GB-s at {memory} MB".format(memory=MEMORY_MB, **report))
+    if report['exportParts']:
+        print("Parquet export: {exportParts} parts, {exportBytes} bytes".format(**report))
+    print("{:<16}{:>12}{:>16}".format("function", "invocations", "billed ms"))
+    for name, billed in report['billedLambdaMs'].items():
+        print("{:<16}{:>12}{:>16}".format(name, report['invocations'][name], billed))
+    print("{:<36}{:>10}".format("call", "count"))
+    for name, count in report['calls'].items():
+        print("{:<36}{:>10}".format(name, count))
+
+
+def regressions(report, baseline, tolerance):
+    # Throughput may not drop, and per-image costs may not grow, by more than `tolerance`
+    problems = []
+    if report['imagesPerSecond'] < baseline['imagesPerSecond'] * (1 - tolerance):
+        problems.append("images/s {} < baseline {}".format(report['imagesPerSecond'], baseline['imagesPerSecond']))
+    for metric in ('apiCallsPerImage', 'indexFacesPerImage', 'billedLambdaMsPerImage', 'p99LatencySeconds'):
+        if report[metric] > baseline[metric] * (1 + tolerance) + 1e-9:
+            problems.append("{} {} > baseline {}".format(metric, report[metric], baseline[metric]))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the reindexing pipeline against local AWS stand-ins")
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--faces', default='0:0.05,1:0.75,2:0.15,3:0.05', help='faces per image distribution, faces:weight,...')
+    parser.add_argument('--duplicates', type=float, default=0.0, help='share of records pointing at an image another record already uses')
+    parser.add_argument('--index-tps', type=float, default=50, help='Rekognition IndexFaces TPS quota')
+    parser.add_argument('--index-latency-ms', type=float, default=300.0, help='median IndexFaces latency')
+    parser.add_argument('--aws-latency-ms', type=float, default=5.0, help='latency of every other AWS call')
+    parser.add_argument('--map-concurrency', type=int, default=10)
+    parser.add_argument('--reindex-concurrency', type=int, default=50, help='ReIndexing event source maximum concurrency')
+    parser.add_argument('--reindex-batch-size', type=int, default=10)
+    parser.add_argument('--store-concurrency', type=int, default=10)
+    parser.add_argument('--direct-persist', action='store_true')
+    parser.add_argument('--tracker', action='store_true', help='enable the JobProgress completion tracker')
+    parser.add_argument('--ledger', action='store_true', help='enable the processed-image ledger')
+    parser.add_argument('--scheduler', action='store_true', help='admit the Map batches through the job scheduler')
+    parser.add_argument('--export', action='store_true', help='export the results as Parquet (needs pyarrow)')
+    parser.add_argument('--time-scale', type=float, default=0.1, help='multiplier for queue delays and visibility timeouts')
+    parser.add_argument('--check-interval', type=float, default=5.0, help='seconds between CheckSQS polls (scaled)')
+    parser.add_argument('--max-seconds', type=float, default=600.0)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--baseline', help='JSON report to compare against; exits 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    report = simulate(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        printReport(report)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = regressions(report, json.load(f), args.tolerance)
+        for problem in problems:
+            print("REGRESSION: " + problem, file=sys.stderr)
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
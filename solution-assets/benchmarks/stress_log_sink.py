@@ -0,0 +1,158 @@
+# Stress test for the ReIndexing error logs: the single NO_FACE_ID item updated with list_append
+# vs. log_sink.LogSink (per-invocation buffer, BatchWriteItem, sharded NO_FACE_ID keys).
+# Runs against an in-process DynamoDB stand-in that models what makes the old item hot:
+#   - writes to the same key are serialized and each costs the size of the whole item in WCU,
+#   - every key is limited to the 1000 WCU/s a single partition can take,
+#   - items are capped at 400 KB.
+#
+#   python stress_log_sink.py --invocations 400 --records 10 --concurrency 50
+
+import argparse, json, math, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions'))
+
+import log_sink, results_store
+from log_sink import LogSink
+
+ITEM_LIMIT = 400 * 1024
+
+
+class StubError(Exception):
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class StubDynamoClient:
+
+    def __init__(self, latencyMs, partitionWcu):
+        self.latency = latencyMs / 1000.0
+        self.partitionWcu = partitionWcu
+        self.items = {}
+        self.keyLocks = {}
+        self.consumed = {}  # key -> (second, WCU used in that second)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        self.tooLarge = 0
+
+    def keyLock(self, key):
+        with self.lock:
+            self.calls += 1
+            return self.keyLocks.setdefault(key, threading.Lock())
+
+    def consume(self, key, size):
+        # Per-key WCU budget for the current second; False when the write would be throttled
+        wcu = max(1, math.ceil(size / 1024.0))
+        second = int(time.monotonic())
+        with self.lock:
+            window, used = self.consumed.get(key, (second, 0))
+            if window != second:
+                used = 0
+            if used + wcu > self.partitionWcu:
+                self.throttled += 1
+                return False
+            self.consumed[key] = (second, used + wcu)
+            return True
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues):
+        key = Key['FaceId']['S']
+        with self.keyLock(key):
+            time.sleep(self.latency)
+            current = self.items.get(key, {'Payloads': []})
+            payloads = current['Payloads'] + ExpressionAttributeValues[':payload']
+            size = len(json.dumps(payloads))
+            if size > ITEM_LIMIT:
+                with self.lock:
+                    self.tooLarge += 1
+                raise StubError('ValidationException')
+            if not self.consume(key, size):
+                raise StubError('ProvisionedThroughputExceededException')
+            self.items[key] = {'Payloads': payloads}
+        return {}
+
+    def batch_write_item(self, RequestItems):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        unprocessed = {}
+        for tableName, requests in RequestItems.items():
+            for request in requests:
+                item = request['PutRequest']['Item']
+                key = item['FaceId']['S']
+                if self.consume(key, len(json.dumps(item))):
+                    with self.lock:
+                        self.items[key] = item
+                else:
+                    unprocessed.setdefault(tableName, []).append(request)
+        return {'UnprocessedItems': unprocessed}
+
+
+def noFacePayload(invocation, record):
+    return {"Bucket": "photos-bucket", "Key": "images/{:06d}-{:02d}.jpg".format(invocation, record),
+            "ExternalImageId": "ext-{}-{}".format(invocation, record), "CollectionId": "new-collection",
+            "Faces": []}
+
+
+def legacyLog(client, payload, error):
+    # The update the ReIndexing function used to issue for every record without faces
+    logEntry = {'FaceId': 'NO_FACE_ID', 'Payload': json.dumps(payload), 'ErrorReason': error}
+    try:
+        client.update_item(
+            TableName='bench-logs',
+            Key={'FaceId': {'S': 'NO_FACE_ID'}},
+            UpdateExpression="SET Payloads = list_append(if_not_exists(Payloads, :empty_list), :payload)",
+            ExpressionAttributeValues={':empty_list': [], ':payload': [logEntry]}
+        )
+        return True
+    except StubError:
+        return False
+
+
+def runLegacy(client, invocations, records, concurrency):
+    def invocation(number):
+        return sum(legacyLog(client, noFacePayload(number, record), "No faces provided by user") for record in range(records))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return sum(executor.map(invocation, range(invocations)))
+
+
+def runSink(client, invocations, records, concurrency):
+    def invocation(number):
+        sink = LogSink('bench-logs', client)
+        for record in range(records):
+            sink.add(noFacePayload(number, record), "No faces provided by user")
+        return records - sink.flush()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return sum(executor.map(invocation, range(invocations)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--invocations', type=int, default=400)
+    parser.add_argument('--records', type=int, default=10, help='records without faces per invocation')
+    parser.add_argument('--concurrency', type=int, default=50, help='concurrent ReIndexing invocations')
+    parser.add_argument('--latency-ms', type=float, default=2.0)
+    parser.add_argument('--partition-wcu', type=int, default=1000)
+    args = parser.parse_args()
+
+    # Keep the output readable: the sink prints a summary line per flush
+    log_sink.log = lambda *a, **k: None
+    results_store.log = lambda *a, **k: None
+    results_store.BACKOFF_BASE = 0.01
+
+    total = args.invocations * args.records
+    print("{:<12}{:>10}{:>10}{:>10}{:>12}{:>12}{:>10}".format(
+        "mode", "entries", "written", "calls", "throttled", "too large", "seconds"))
+    for name, run in (("list_append", runLegacy), ("LogSink", runSink)):
+        client = StubDynamoClient(args.latency_ms, args.partition_wcu)
+        start = time.perf_counter()
+        written = run(client, args.invocations, args.records, args.concurrency)
+        elapsed = time.perf_counter() - start
+        print("{:<12}{:>10}{:>10}{:>10}{:>12}{:>12}{:>10.2f}".format(
+            name, total, written, client.calls, client.throttled, client.tooLarge, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# Build the Lambda deployment packages the CloudFormation templates reference.
+#
+# Every function zip holds its handler module plus the shared modules of lambda_functions/ it imports,
+# directly or through another shared module (aws_clients, instrumentation, results_store, ...). The
+# packages are read from the templates (assets/<handler>.zip, validation-assets/<handler>.zip), so a new
+# function or a new shared import is picked up without editing this script. Third-party dependencies
+# (pyarrow, Pillow) come from the layers set in the template parameters, boto3 from the runtime.
+#
+#   python build_assets.py                       # writes dist/assets/*.zip and dist/validation-assets/*.zip
+#   python build_assets.py --list                # prints the modules of every package
+#   python build_assets.py --upload s3://my-assets-bucket/
+#
+# The templates read the packages from the rkra-<region> bucket: to deploy your own build, upload it
+# with --upload and replace that bucket name in the templates.
+
+import argparse, ast, os, re, zipfile
+from urllib.parse import urlparse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_FUNCTIONS = os.path.join(ROOT, "lambda_functions")
+TEMPLATES = [os.path.join(ROOT, "cloudformation_template", name) for name in ("template.yaml", "verification-template.yaml")]
+PACKAGE = re.compile(r'"((?:validation-)?assets)/(\w+)\.zip"')
+
+
+def packages(templates=TEMPLATES):
+    # [(folder, handler module)] in template order, each once
+    found = []
+    for path in templates:
+        with open(path) as f:
+            for folder, module in PACKAGE.findall(f.read()):
+                if (folder, module) not in found:
+                    found.append((folder, module))
+    return found
+
+
+def local_imports(module):
+    # Modules of lambda_functions/ imported anywhere in the module, including imports inside functions
+    with open(os.path.join(LAMBDA_FUNCTIONS, module + ".py")) as f:
+        tree = ast.parse(f.read(), module)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split(".")[0])
+    return {name for name in names if os.path.exists(os.path.join(LAMBDA_FUNCTIONS, name + ".py"))}
+
+
+def package_modules(handler):
+    # The handler and every shared module it needs, sorted
+    modules, pending = set(), [handler]
+    while pending:
+        module = pending.pop()
+        if module not in modules:
+            modules.add(module)
+            pending.extend(local_imports(module) - modules)
+    return sorted(modules)
+
+
+def build(output):
+    built = []
+    for folder, handler in packages():
+        os.makedirs(os.path.join(output, folder), exist_ok=True)
+        path = os.path.join(output, folder, handler + ".zip")
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for module in package_modules(handler):
+                archive.write(os.path.join(LAMBDA_FUNCTIONS, module + ".py"), module + ".py")
+        built.append((folder, path))
+    return built
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the Lambda packages referenced by the CloudFormation templates")
+    parser.add_argument("--output", default=os.path.join(ROOT, "dist"))
+    parser.add_argument("--list", action="store_true", help="Only print the modules of every package")
+    parser.add_argument("--upload", help="s3:// prefix to upload the packages to, keeping assets/ and validation-assets/")
+    args = parser.parse_args()
+
+    if args.list:
+        for folder, handler in packages():
+            print("{}/{}.zip: {}".format(folder, handler, ", ".join(module + ".py" for module in package_modules(handler))))
+        return
+
+    built = build(args.output)
+    for _, path in built:
+        print("Built {}".format(path))
+    if args.upload:
+        import boto3
+        s3_client = boto3.client("s3")
+        parsed = urlparse(args.upload)
+        prefix = parsed.path.lstrip("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        for folder, path in built:
+            key = "{}{}/{}".format(prefix, folder, os.path.basename(path))
+            s3_client.upload_file(path, parsed.netloc, key)
+            print("Uploaded s3://{}/{}".format(parsed.netloc, key))
+
+
+if __name__ == "__main__":
+    main()
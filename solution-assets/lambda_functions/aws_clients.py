@@ -0,0 +1,60 @@
+import os, threading
+from instrumentation import instrument
+
+# Shared registry of boto3 clients, created on first use.
+#
+# Handlers keep module-level client variables, but they are LazyClient placeholders: boto3 is only
+# imported and a client only built (endpoint resolution, service model loading) the first time an
+# invocation calls the service. An invocation of lambda_processing without failed records never pays
+# for the Firehose client, lambda_stepfunctions no longer builds a client per invocation.
+#
+# Clients share one tuned botocore Config:
+#   max_pool_connections - matched to the threads a handler runs against the service
+#   tcp_keepalive        - keeps pooled connections alive between invocations of a warm environment
+#   retries              - `adaptive` mode by default: standard retries plus client-side rate limiting
+#                          once the service starts throttling (`retrymode` / `maxattempts` to override)
+
+DEFAULT_POOL_SIZE = 10
+RETRY_MODE = os.environ.get('retrymode', 'adaptive')
+MAX_ATTEMPTS = int(os.environ.get('maxattempts', 5))
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+clients = {}  # (service, pool size) -> client
+lock = threading.Lock()
+
+
+def client_config(pool_size=DEFAULT_POOL_SIZE):
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=pool_size,
+        tcp_keepalive=True,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        retries={'mode': RETRY_MODE, 'max_attempts': MAX_ATTEMPTS}
+    )
+
+
+def get_client(service, pool_size=DEFAULT_POOL_SIZE):
+    key = (service, pool_size)
+    client = clients.get(key)
+    if client is None:
+        # Creating clients from the default session is not thread-safe
+        with lock:
+            client = clients.get(key)
+            if client is None:
+                import boto3
+                client = instrument(boto3.client(service, config=client_config(pool_size)))
+                clients[key] = client
+    return client
+
+
+class LazyClient:
+    # Stands in for a boto3 client until an attribute (an API call, .exceptions, .meta) is needed
+
+    def __init__(self, service, pool_size=DEFAULT_POOL_SIZE):
+        self.service = service
+        self.pool_size = pool_size
+
+    def __getattr__(self, name):
+        return getattr(get_client(self.service, self.pool_size), name)
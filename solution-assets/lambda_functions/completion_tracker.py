@@ -0,0 +1,108 @@
+import os
+from aws_clients import get_client
+from instrumentation import log
+
+# Per-execution progress counters for the reindex state machine.
+#
+# One item per Step Functions execution in the progress table:
+#   Expected  - records enqueued to the reindex queue (lambda_processing)
+#   Completed - records that reached a final state (lambda_reindex, lambda_dynamo)
+#   TaskToken - set by lambda_completion once the Map state has finished ("sealed")
+# Whoever brings the item to Sealed and Completed >= Expected sends the task token back, guarded
+# by a conditional write so the state machine is resumed exactly once.
+#
+# Counting is best effort: errors are logged and never fail the caller's batch, since the state
+# machine checks the queues and waits again when the callback does not arrive in time.
+# Disabled (no-op) when the `progresstable` environment variable is not set.
+
+
+class CompletionTracker:
+
+    def __init__(self, table_name=None, dynamodb_client=None, sfn_client=None):
+        self.table_name = table_name if table_name is not None else os.environ.get('progresstable')
+        self.dynamodb_client = dynamodb_client
+        self.sfn_client = sfn_client
+
+    @property
+    def enabled(self):
+        return bool(self.table_name)
+
+    def dynamodb(self):
+        if self.dynamodb_client is None:
+            self.dynamodb_client = get_client('dynamodb')
+        return self.dynamodb_client
+
+    def stepfunctions(self):
+        if self.sfn_client is None:
+            self.sfn_client = get_client('stepfunctions')
+        return self.sfn_client
+
+    def add(self, execution_id, attribute, count):
+        response = self.dynamodb().update_item(
+            TableName=self.table_name,
+            Key={'ExecutionId': {'S': execution_id}},
+            UpdateExpression="ADD #counter :count",
+            ExpressionAttributeNames={'#counter': attribute},
+            ExpressionAttributeValues={':count': {'N': str(count)}},
+            ReturnValues="ALL_NEW"
+        )
+        return response['Attributes']
+
+    def add_expected(self, execution_id, count):
+        if self.enabled and execution_id and count:
+            try:
+                self.add(execution_id, 'Expected', count)
+            except Exception as e:
+                log("Error while updating expected records", sampled=False, executionId=execution_id, error=str(e))
+
+    def add_completed(self, execution_id, count):
+        if self.enabled and execution_id and count:
+            try:
+                self.notify_if_done(execution_id, self.add(execution_id, 'Completed', count))
+            except Exception as e:
+                log("Error while updating completed records", sampled=False, executionId=execution_id, error=str(e))
+
+    def add_completed_counts(self, counts):
+        # counts: {execution_id: completed records}
+        for execution_id, count in counts.items():
+            self.add_completed(execution_id, count)
+
+    def seal(self, execution_id, task_token):
+        # Called once every record of the execution has been enqueued, and again with a new token each
+        # time the wait timed out while the queues still held messages: a notification sent to an
+        # expired token is sent again
+        response = self.dynamodb().update_item(
+            TableName=self.table_name,
+            Key={'ExecutionId': {'S': execution_id}},
+            UpdateExpression="SET TaskToken = :token REMOVE Notified",
+            ExpressionAttributeValues={':token': {'S': task_token}},
+            ReturnValues="ALL_NEW"
+        )
+        return self.notify_if_done(execution_id, response['Attributes'])
+
+    def notify_if_done(self, execution_id, item):
+        expected = int(item.get('Expected', {}).get('N', 0))
+        completed = int(item.get('Completed', {}).get('N', 0))
+        if 'TaskToken' not in item or 'Notified' in item or completed < expected:
+            return False
+        try:
+            self.dynamodb().update_item(
+                TableName=self.table_name,
+                Key={'ExecutionId': {'S': execution_id}},
+                UpdateExpression="SET Notified = :true",
+                ConditionExpression="attribute_not_exists(Notified)",
+                ExpressionAttributeValues={':true': {'BOOL': True}}
+            )
+        except self.dynamodb().exceptions.ConditionalCheckFailedException:
+            return False
+        log("Execution complete", sampled=False, executionId=execution_id, completed=completed, expected=expected)
+        self.stepfunctions().send_task_success(
+            taskToken=item['TaskToken']['S'],
+            output='{"expected": %d, "completed": %d}' % (expected, completed)
+        )
+        return True
+
+
+def is_final_attempt(record):
+    # The message goes to the DLQ after this receive if it fails again, so it counts as finished
+    return int(record.get('attributes', {}).get('ApproximateReceiveCount', 1)) >= int(os.environ.get('maxreceivecount', 5))
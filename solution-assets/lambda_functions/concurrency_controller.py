@@ -0,0 +1,78 @@
+import math
+
+# SQS event source mappings accept a MaximumConcurrency between 2 and 1000
+MIN_CONCURRENCY = 2
+MAX_CONCURRENCY = 1000
+
+# Controller table item holding the MaximumConcurrency applied to a function's event source mappings,
+# read by the function to split the IndexFaces TPS between its execution environments
+LIMIT_KEY = "MaximumConcurrency#{}"
+
+
+class AimdController:
+    # Additive-increase / multiplicative-decrease controller for an event source mapping's
+    # MaximumConcurrency.
+    #
+    # - Heavy throttling or failed records: multiplicative decrease.
+    # - Light throttling: back off proportionally to the throttle rate and remember that value as
+    #   the ceiling, so the controller settles just under the quota instead of sawtoothing.
+    # - After a throttled decrease: hold for `holdRounds` rounds before probing again, so the
+    #   controller spends most rounds at the ceiling instead of every other round above it.
+    # - Backlog and no throttling: add `increase` up to the known ceiling, then probe by 1.
+    # - No backlog: hold.
+    #
+    # Pure logic: signals come in as a dict and the state is a plain dict the caller persists.
+
+    def __init__(self, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY, increase=10, decrease=0.7,
+                 throttleTolerance=0.005, severeThrottle=0.1, errorTolerance=0.05, holdRounds=6):
+        self.minimum = max(MIN_CONCURRENCY, minimum)
+        self.maximum = min(MAX_CONCURRENCY, maximum)
+        self.increase = increase
+        self.decrease = decrease
+        self.throttleTolerance = throttleTolerance
+        self.severeThrottle = severeThrottle
+        self.errorTolerance = errorTolerance
+        self.holdRounds = holdRounds
+
+    def clamp(self, value):
+        return max(self.minimum, min(self.maximum, int(value)))
+
+    def decide(self, current, signals, state=None):
+        # signals: throttles, requests (successful calls), failed and records (reindex records failed and
+        # received), backlog (queued messages)
+        # Returns (newConcurrency, reason, newState)
+        state = dict(state or {})
+        current = self.clamp(current)
+        ceiling = state.get("ceiling")
+
+        throttles = signals.get("throttles", 0)
+        throttleRate = throttles / float(max(1, throttles + signals.get("requests", 0)))
+        errorRate = signals.get("failed", 0) / float(max(1, signals.get("records", 0)))
+        backlog = signals.get("backlog", 0)
+        hold = state.pop("hold", 0)
+
+        if throttleRate > self.severeThrottle:
+            new, reason = self.clamp(math.floor(current * self.decrease)), "throttled"
+            state["ceiling"], state["hold"] = new, self.holdRounds
+        elif throttleRate > self.throttleTolerance:
+            new, reason = self.clamp(current - max(1, math.ceil(current * throttleRate))), "throttled"
+            state["ceiling"], state["hold"] = new, self.holdRounds
+        elif errorRate > self.errorTolerance:
+            new, reason = self.clamp(math.floor(current * self.decrease)), "errors"
+        elif hold > 0:
+            # Settling at the ceiling found by the last decrease
+            new, reason = current, "settle"
+            state["hold"] = hold - 1
+        elif backlog <= current:
+            # Nothing queued beyond what the current concurrency already drains
+            new, reason = current, "hold"
+        elif ceiling is not None and current >= ceiling:
+            new, reason = self.clamp(current + 1), "probe"
+        elif ceiling is not None:
+            new, reason = self.clamp(min(current + self.increase, ceiling)), "backlog"
+        else:
+            new, reason = self.clamp(current + self.increase), "backlog"
+
+        state["throttleRate"] = round(throttleRate, 4)
+        state["errorRate"] = round(errorRate, 4)
+        return new, reason, state
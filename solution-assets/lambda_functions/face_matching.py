@@ -0,0 +1,160 @@
+# One-to-one assignment of faces provided in the manifest to faces indexed by Rekognition.
+#
+# Builds the provided x indexed IoU matrix in a single pass and solves the assignment that
+# maximises total IoU over the pairs above the threshold (Hungarian algorithm), so a provided
+# face can never be claimed twice and each indexed face gets its best compatible match.
+# Plain Python on purpose: the Lambda runtime does not ship NumPy. Candidate pairs are split
+# into connected components first, so group photos (where a box only overlaps its neighbours)
+# reduce to many 1x1 problems and the cubic solver only runs on genuinely ambiguous clusters.
+
+
+def calculate_iou(bb1, bb2):
+    bb1_x1, bb1_x2, bb1_y1, bb1_y2 = bb1["Left"], bb1["Left"] + bb1["Width"], bb1["Top"], bb1["Top"] + bb1["Height"]
+    bb2_x1, bb2_x2, bb2_y1, bb2_y2 = bb2["Left"], bb2["Left"] + bb2["Width"], bb2["Top"], bb2["Top"] + bb2["Height"]
+    x_left, y_top, x_right, y_bottom = max(bb1_x1, bb2_x1), max(bb1_y1, bb2_y1), min(bb1_x2, bb2_x2), min(bb1_y2,
+                                                                                                          bb2_y2)
+    if x_right < x_left or y_bottom < y_top: return 0
+    intersection_area = (x_right - x_left) * (y_bottom - y_top)
+    bb1_area, bb2_area = (bb1_x2 - bb1_x1) * (bb1_y2 - bb1_y1), (bb2_x2 - bb2_x1) * (bb2_y2 - bb2_y1)
+    iou = intersection_area / float(bb1_area + bb2_area - intersection_area)
+    return iou
+
+
+def box_edges(bb):
+    left, top = float(bb["Left"]), float(bb["Top"])
+    right, bottom = left + float(bb["Width"]), top + float(bb["Height"])
+    return left, top, right, bottom, (right - left) * (bottom - top)
+
+
+def iou_matrix(providedBoxes, indexedBoxes):
+    # Row per provided box, column per indexed box. Same arithmetic as calculate_iou,
+    # with the box edges unpacked once instead of once per pair.
+    provided = [box_edges(bb) for bb in providedBoxes]
+    indexed = [box_edges(bb) for bb in indexedBoxes]
+    matrix = []
+    for p_left, p_top, p_right, p_bottom, p_area in provided:
+        row = []
+        for i_left, i_top, i_right, i_bottom, i_area in indexed:
+            x_left = p_left if p_left > i_left else i_left
+            x_right = p_right if p_right < i_right else i_right
+            y_top = p_top if p_top > i_top else i_top
+            y_bottom = p_bottom if p_bottom < i_bottom else i_bottom
+            if x_right < x_left or y_bottom < y_top:
+                row.append(0.0)
+                continue
+            intersection = (x_right - x_left) * (y_bottom - y_top)
+            union = p_area + i_area - intersection
+            row.append(intersection / union if union > 0 else 0.0)
+        matrix.append(row)
+    return matrix
+
+
+def hungarian_max(weights):
+    # Maximum weight assignment for an n x m matrix with n <= m (shortest augmenting path with
+    # potentials, O(n^2 m)). Returns assignment[row] = column.
+    n, m = len(weights), len(weights[0])
+    INF = float("inf")
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    p = [0] * (m + 1)
+    way = [0] * (m + 1)
+    for row in range(1, n + 1):
+        p[0] = row
+        col0 = 0
+        minv = [INF] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[col0] = True
+            row0 = p[col0]
+            costs = weights[row0 - 1]
+            delta, col1 = INF, 0
+            for col in range(1, m + 1):
+                if not used[col]:
+                    current = -costs[col - 1] - u[row0] - v[col]
+                    if current < minv[col]:
+                        minv[col] = current
+                        way[col] = col0
+                    if minv[col] < delta:
+                        delta, col1 = minv[col], col
+            for col in range(m + 1):
+                if used[col]:
+                    u[p[col]] += delta
+                    v[col] -= delta
+                else:
+                    minv[col] -= delta
+            col0 = col1
+            if p[col0] == 0:
+                break
+        while col0:
+            col1 = way[col0]
+            p[col0] = p[col1]
+            col0 = col1
+
+    assignment = [0] * n
+    for col in range(1, m + 1):
+        if p[col]:
+            assignment[p[col] - 1] = col - 1
+    return assignment
+
+
+def candidate_components(matrix, threshold):
+    # Connected components of the bipartite graph whose edges are the pairs above the threshold
+    rows = len(matrix)
+    cols = len(matrix[0]) if rows else 0
+    rowEdges = [[col for col in range(cols) if matrix[row][col] > threshold] for row in range(rows)]
+    colEdges = [[] for _ in range(cols)]
+    for row, edges in enumerate(rowEdges):
+        for col in edges:
+            colEdges[col].append(row)
+
+    seenRows, seenCols = set(), set()
+    components = []
+    for start in range(rows):
+        if start in seenRows or not rowEdges[start]:
+            continue
+        compRows, compCols = [], []
+        stack = [("r", start)]
+        seenRows.add(start)
+        while stack:
+            kind, index = stack.pop()
+            if kind == "r":
+                compRows.append(index)
+                for col in rowEdges[index]:
+                    if col not in seenCols:
+                        seenCols.add(col)
+                        stack.append(("c", col))
+            else:
+                compCols.append(index)
+                for row in colEdges[index]:
+                    if row not in seenRows:
+                        seenRows.add(row)
+                        stack.append(("r", row))
+        components.append((sorted(compRows), sorted(compCols)))
+    return components
+
+
+def match_faces(providedFaces, indexedFaces, threshold):
+    # providedFaces: manifest faces ("BoundingBoxes"); indexedFaces: Rekognition FaceRecords.
+    # Returns {indexedIndex: (providedIndex, iou)} for every pair in the optimal assignment.
+    if not providedFaces or not indexedFaces:
+        return {}
+    matrix = iou_matrix([face["BoundingBoxes"] for face in providedFaces],
+                        [record["Face"]["BoundingBox"] for record in indexedFaces])
+
+    matches = {}
+    for compRows, compCols in candidate_components(matrix, threshold):
+        if len(compRows) == 1 and len(compCols) == 1:
+            row, col = compRows[0], compCols[0]
+            matches[col] = (row, matrix[row][col])
+            continue
+
+        # Pairs below the threshold are not allowed to match: weight them 0 and drop them afterwards
+        weights = [[matrix[row][col] if matrix[row][col] > threshold else 0.0 for col in compCols] for row in compRows]
+        transposed = len(compRows) > len(compCols)
+        if transposed:
+            weights = [list(column) for column in zip(*weights)]
+        for a, b in enumerate(hungarian_max(weights)):
+            row, col = (compRows[b], compCols[a]) if transposed else (compRows[a], compCols[b])
+            if matrix[row][col] > threshold:
+                matches[col] = (row, matrix[row][col])
+    return matches
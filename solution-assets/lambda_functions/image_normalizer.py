@@ -0,0 +1,216 @@
+import hashlib
+import io
+import os
+import re
+import struct
+import threading
+from instrumentation import metrics, log
+
+# Optional image normalization for lambda_processing.
+#
+# IndexFaces reads the image straight from S3 and rejects objects above 15 MB and formats other than
+# JPEG and PNG; every such record costs an IndexFaces call, the retries of the message and a log
+# write. With `normalizelocation` set, the Processor:
+#   1. reads the format and dimensions from the first bytes of each image (a ranged GetObject, not
+#      the whole object),
+#   2. downsizes or transcodes the images Rekognition would reject, on a worker pool, to a derived
+#      JPEG under `normalizelocation`, keyed by the source object and its ETag so every image is
+#      converted once and later jobs reuse it,
+#   3. points the IndexFaces job at the derived object ("Image"). Results keep the Bucket/Key of the
+#      manifest.
+#
+# Bounding boxes are relative to the image. A derived image covers the whole source, at the same
+# aspect ratio and in the orientation Rekognition reads the source in (the EXIF orientation of JPEGs
+# is applied to the pixels), so the provided BoundingBoxes match it without rescaling and the IoU
+# matching of lambda_reindex is unchanged. Objects that are not images or are smaller than
+# MIN_DIMENSION pixels fail up front instead of in IndexFaces.
+#
+# Needs Pillow in the function (e.g. a Lambda layer). Without it images are passed on unchanged.
+
+REKOGNITION_MAX_BYTES = 15 * 1024 * 1024
+SUPPORTED_FORMATS = {"jpeg", "png"}
+MIN_DIMENSION = 80
+# Optional cap on the longest side, 0 keeps the resolution unless the object is too large
+MAX_DIMENSION = int(os.environ.get('normalizemaxdimension', 0))
+TARGET_BYTES = 12 * 1024 * 1024  # margin under the limit for the encoded JPEG
+JPEG_QUALITY = 90
+HEADER_BYTES = 64 * 1024
+MAX_HEADER_BYTES = 1024 * 1024  # JPEGs with a large embedded thumbnail put the frame header further in
+NORMALIZE_WORKERS = 4
+
+# JPEG start-of-frame markers carry the dimensions (not DHT C4, JPG C8, DAC CC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(header):
+    # (width, height) from the first SOF segment, None when the header stops before it
+    position = 2
+    while position + 4 <= len(header):
+        if header[position] != 0xFF:
+            return None
+        marker = header[position + 1]
+        if marker == 0xFF:  # fill byte
+            position += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:  # markers without a length
+            position += 2
+            continue
+        length = struct.unpack(">H", header[position + 2:position + 4])[0]
+        if marker in JPEG_SOF_MARKERS:
+            if position + 9 > len(header):
+                return None
+            height, width = struct.unpack(">HH", header[position + 5:position + 9])
+            return width, height
+        position += 2 + length
+    return None
+
+
+def image_info(header):
+    # (format, width, height) from the first bytes of an image; width and height are None when they
+    # are not in the header, the format is "unknown" for anything that is not an image
+    if header[:3] == b"\xff\xd8\xff":
+        size = jpeg_size(header)
+        return ("jpeg",) + (size or (None, None))
+    if header[:8] == b"\x89PNG\r\n\x1a\n" and len(header) >= 24:
+        return ("png",) + struct.unpack(">II", header[16:24])
+    if header[:6] in (b"GIF87a", b"GIF89a") and len(header) >= 10:
+        return ("gif",) + struct.unpack("<HH", header[6:10])
+    if header[:2] == b"BM" and len(header) >= 26:
+        width, height = struct.unpack("<ii", header[18:26])
+        return "bmp", abs(width), abs(height)
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp", None, None
+    if header[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff", None, None
+    if header[4:8] == b"ftyp" and header[8:12] in (b"heic", b"heix", b"mif1", b"msf1", b"avif"):
+        return "heif", None, None
+    return "unknown", None, None
+
+
+def target_size(size, long_side):
+    # Same aspect ratio, longest side `long_side`
+    factor = long_side / float(max(size))
+    return max(1, int(round(size[0] * factor))), max(1, int(round(size[1] * factor)))
+
+
+def to_jpeg(body, image_format):
+    # Decodes an image and encodes it as a JPEG Rekognition accepts: at most MAX_DIMENSION on the
+    # longest side (when set) and at most TARGET_BYTES
+    from PIL import Image, ImageOps
+    image = Image.open(io.BytesIO(body))
+    long_side = max(image.size)
+    if MAX_DIMENSION:
+        long_side = min(long_side, MAX_DIMENSION)
+    if image_format == "jpeg":
+        # Decodes at a reduced scale right away when downsizing: less memory and time for large images
+        image.draft("RGB", target_size(image.size, long_side))
+        # Rekognition applies the EXIF orientation of JPEGs, the derived image has it baked in
+        image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "P", "PA"):
+        image = image.convert("RGBA")
+        flattened = Image.new("RGB", image.size, (255, 255, 255))
+        flattened.paste(image, mask=image.getchannel("A"))
+        image = flattened
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    while True:
+        size = target_size(image.size, long_side)
+        resized = image.resize(size, Image.LANCZOS) if size != image.size else image
+        output = io.BytesIO()
+        resized.save(output, "JPEG", quality=JPEG_QUALITY)
+        if output.tell() <= TARGET_BYTES or long_side <= MIN_DIMENSION:
+            return output.getvalue()
+        long_side = max(MIN_DIMENSION, int(long_side * 0.75))
+
+
+class ImageNormalizer:
+
+    def __init__(self, s3_client, location, workers=NORMALIZE_WORKERS):
+        match = re.match(r"s3://([^/]+)/?(.*)", location)
+        self.bucket = match.group(1)
+        self.prefix = match.group(2)
+        if self.prefix and not self.prefix.endswith("/"):
+            self.prefix += "/"
+        self.s3_client = s3_client
+        # Decoding holds the whole image in memory: conversions are limited to `workers` at a time
+        self.conversions = threading.Semaphore(workers)
+        self.derived = set()  # derived keys known to exist, kept for the life of the environment
+        self.lock = threading.Lock()
+        self.available = None
+
+    def pillow(self):
+        if self.available is None:
+            try:
+                import PIL.Image
+                self.available = True
+            except ImportError:
+                log("Pillow is not available, images are not normalized", sampled=False)
+                self.available = False
+        return self.available
+
+    def inspect(self, bucket, key):
+        # (format, width, height, object size, ETag) from ranged reads of the start of the object
+        length = HEADER_BYTES
+        while True:
+            response = self.s3_client.get_object(Bucket=bucket, Key=key, Range="bytes=0-{}".format(length - 1))
+            header = response["Body"].read()
+            total = int(response.get("ContentRange", "/{}".format(len(header))).rsplit("/", 1)[-1])
+            image_format, width, height = image_info(header)
+            if width is not None or image_format != "jpeg" or len(header) >= total or length >= MAX_HEADER_BYTES:
+                return image_format, width, height, total, response.get("ETag", "")
+            length *= 4
+
+    def derived_key(self, bucket, key, etag):
+        digest = hashlib.sha256("{}/{}/{}".format(bucket, key, etag).encode("utf-8")).hexdigest()[:40]
+        return self.prefix + digest + ".jpg"
+
+    def exists(self, derived_key):
+        with self.lock:
+            if derived_key in self.derived:
+                return True
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=derived_key)
+        except Exception:
+            return False
+        with self.lock:
+            self.derived.add(derived_key)
+        return True
+
+    def convert(self, bucket, key, image_format, derived_key):
+        with self.conversions:
+            body = self.s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+            try:
+                jpeg = to_jpeg(body, image_format)
+            except Exception as e:
+                return "Image normalization failed: {} image could not be decoded ({})".format(image_format, e)
+        self.s3_client.put_object(Bucket=self.bucket, Key=derived_key, Body=jpeg, ContentType="image/jpeg",
+                                  Metadata={"source": "s3://{}/{}".format(bucket, key)})
+        with self.lock:
+            self.derived.add(derived_key)
+        metrics.add("NormalizedImages")
+        return None
+
+    def normalize(self, bucket, key):
+        # Returns (derived S3 object or None, failure reason or None). Images Rekognition accepts are
+        # left as they are.
+        image_format, width, height, size, etag = self.inspect(bucket, key)
+        if image_format == "unknown":
+            return None, "Image validation failed: object is not an image"
+        if width is not None and min(width, height) < MIN_DIMENSION:
+            return None, f"Image validation failed: {width}x{height} is below the {MIN_DIMENSION} pixel minimum"
+        oversized = size > REKOGNITION_MAX_BYTES or (MAX_DIMENSION and width and max(width, height) > MAX_DIMENSION)
+        if image_format in SUPPORTED_FORMATS and not oversized:
+            return None, None
+        if not self.pillow():
+            return None, None
+
+        derived_key = self.derived_key(bucket, key, etag)
+        if self.exists(derived_key):
+            metrics.add("NormalizationCacheHits")
+            return {"Bucket": self.bucket, "Key": derived_key}, None
+        reason = self.convert(bucket, key, image_format, derived_key)
+        if reason:
+            return None, reason
+        log("Image normalized", bucket=bucket, key=key, format=image_format, bytes=size, derived=derived_key)
+        return {"Bucket": self.bucket, "Key": derived_key}, None
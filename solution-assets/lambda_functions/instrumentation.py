@@ -0,0 +1,165 @@
+import json, os, time, random, functools, threading
+
+# Shared instrumentation for the Lambda handlers of the solution.
+#
+#   instrument(client)  - times every call of a boto3 client, per operation, and counts its retries,
+#                         throttles and errors
+#   metrics             - per-invocation metrics, flushed as CloudWatch Embedded Metric Format (EMF) lines
+#   @instrumented       - wraps a lambda_handler: resets the metrics, times the invocation, flushes the metrics
+#   log(message, ...)   - structured JSON log line, sampled at `logsamplerate` unless sampled=False
+#
+# EMF lines are written to stdout like any other log line, CloudWatch Logs extracts the metrics under
+# the `metricsnamespace` namespace with the function name as dimension. No PutMetricData calls are made.
+# Outside Lambda (no AWS_LAMBDA_FUNCTION_NAME, e.g. the benchmarks) the metrics are still collected but
+# not written, unless `emitmetrics` is set to true; `emitmetrics=false` silences them in Lambda too.
+
+NAMESPACE = os.environ.get('metricsnamespace', 'RekognitionReindex')
+LOG_SAMPLE_RATE = float(os.environ.get('logsamplerate', 0.01))
+EMIT_METRICS = os.environ.get('emitmetrics', str('AWS_LAMBDA_FUNCTION_NAME' in os.environ)).lower() == 'true'
+EMF_MAX_VALUES = 100  # EMF limit of values per metric in one document
+
+THROTTLING_ERRORS = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+    'SlowDown', 'RequestThrottled', 'BandwidthLimitExceeded', 'LimitExceededException'
+}
+
+
+class InvocationMetrics:
+    # Thread-safe: records of a batch are processed concurrently
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.values = {}  # name -> (unit, [values])
+            self.counters = {}  # name -> (unit, total)
+
+    def put(self, name, value, unit='Milliseconds'):
+        # One value per observation, e.g. the latency of every call
+        with self.lock:
+            self.values.setdefault(name, (unit, []))[1].append(value)
+
+    def add(self, name, value=1, unit='Count'):
+        # Summed over the invocation
+        with self.lock:
+            current = self.counters.get(name, (unit, 0))[1]
+            self.counters[name] = (unit, current + value)
+
+    def total(self, name):
+        with self.lock:
+            return self.counters.get(name, (None, 0))[1]
+
+    def documents(self, dimensions):
+        with self.lock:
+            series = {name: (unit, list(values)) for name, (unit, values) in self.values.items()}
+            series.update({name: (unit, [total]) for name, (unit, total) in self.counters.items()})
+        if not series:
+            return []
+
+        # Metrics with more than EMF_MAX_VALUES values are spread over several documents
+        documents = []
+        for chunk in range(max((len(values) - 1) // EMF_MAX_VALUES + 1 for _, values in series.values())):
+            document = dict(dimensions)
+            definitions = []
+            for name, (unit, values) in sorted(series.items()):
+                part = values[chunk * EMF_MAX_VALUES:(chunk + 1) * EMF_MAX_VALUES]
+                if not part:
+                    continue
+                document[name] = part if len(part) > 1 else part[0]
+                definitions.append({'Name': name, 'Unit': unit})
+            document['_aws'] = {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [sorted(dimensions)],
+                    'Metrics': definitions
+                }]
+            }
+            documents.append(document)
+        return documents
+
+    def flush(self, dimensions=None):
+        if dimensions is None:
+            dimensions = {'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')}
+        if EMIT_METRICS:
+            for document in self.documents(dimensions):
+                print(json.dumps(document))
+        self.reset()
+
+
+metrics = InvocationMetrics()
+
+
+def log(message, sampled=True, **fields):
+    # Errors and summaries pass sampled=False and are always written
+    if sampled and random.random() >= LOG_SAMPLE_RATE:
+        return
+    entry = {'message': message}
+    entry.update(fields)
+    print(json.dumps(entry, default=str))
+
+
+def operationName(eventName):
+    # 'after-call.dynamodb.BatchWriteItem' -> 'BatchWriteItem'
+    return eventName.rsplit('.', 1)[-1]
+
+
+def beforeCall(context=None, **kwargs):
+    if context is not None:
+        context['instrumentationStart'] = time.perf_counter()
+
+
+def afterCall(event_name, parsed=None, context=None, **kwargs):
+    operation = operationName(event_name)
+    start = context.get('instrumentationStart') if context is not None else None
+    if start is not None:
+        metrics.put(operation + 'Latency', (time.perf_counter() - start) * 1000.0)
+    metrics.add(operation + 'Calls')
+    parsed = parsed or {}
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if retries:
+        metrics.add(operation + 'Retries', retries)
+    if 'Error' in parsed:
+        metrics.add(operation + 'Errors')
+
+
+def needsRetry(event_name, response=None, **kwargs):
+    # Called for every attempt; only looks at the error code and leaves the decision to botocore
+    if response and len(response) > 1 and response[1]:
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLING_ERRORS:
+            metrics.add(operationName(event_name) + 'Throttles')
+            metrics.add('Throttles')
+    return None
+
+
+def instrument(client):
+    # Registers the timing handlers on a boto3 client and returns it. Clients without botocore
+    # events (e.g. test doubles) are returned unchanged.
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        return client
+    events.register('before-call', beforeCall, unique_id='instrumentation-before-call')
+    events.register('after-call', afterCall, unique_id='instrumentation-after-call')
+    # Ahead of the retry handler, which stops the event once it decided to retry
+    events.register_first('needs-retry', needsRetry, unique_id='instrumentation-needs-retry')
+    return client
+
+
+def instrumented(handler):
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        metrics.reset()
+        start = time.perf_counter()
+        try:
+            return handler(event, context)
+        except Exception:
+            metrics.add('HandlerErrors')
+            raise
+        finally:
+            metrics.put('HandlerDuration', (time.perf_counter() - start) * 1000.0)
+            metrics.flush()
+    return wrapper
@@ -0,0 +1,325 @@
+import math
+import os
+import time
+from aws_clients import get_client
+from instrumentation import log
+
+# Weighted fair sharing of the account IndexFaces TPS between the jobs running at the same time.
+#
+# Every job enqueues into the one reindex queue, so without a scheduler concurrent jobs are served in
+# arrival order: a backfill of millions of records fills the queue and a small job started after it
+# waits until the queue has drained. With the scheduler, each job has a token bucket in the scheduler
+# table and the Processor takes tokens for a batch before enqueueing it:
+#   Rate      - tokens (IndexFaces jobs) per second, set by allocate()
+#   Tokens    - balance, may go negative: a batch is admitted whenever the balance is >= 0
+#   Admitted  - IndexFaces jobs enqueued, Throttled - batches that had to wait for tokens
+#   AdmittedAt, RefusedAt - last batch admitted and last batch that had to wait
+#   Version   - buckets are updated with read-modify-write, guarded by a condition on it
+# A batch that is not admitted is retried by the Map state, so the backlog of every job stays in its
+# manifest and the reindex queue only holds what the IndexFaces TPS drains.
+#
+# allocate() splits the TPS between the jobs by priority tier (interactive, then standard, then
+# bulk) and by weight within a tier, max-min fair: a job that uses less than its share leaves the
+# rest to the others. Every job with a backlog keeps a floor, so bulk jobs are never starved.
+# The Scheduler function allocates every minute; a Processor whose batch has to wait allocates
+# again when the last allocation is older than REALLOCATE_SECONDS, so the share of a job that just
+# finished goes to the others without waiting for the schedule.
+# Disabled (admits everything) when the `schedulertable` environment variable is not set.
+
+PRIORITIES = {"interactive": 0, "standard": 1, "bulk": 2}
+DEFAULT_PRIORITY = "standard"
+
+FLOOR_SHARE = 0.05     # of the TPS, split between the jobs with a backlog
+MIN_RATE = 0.1         # rate of idle jobs, until the next allocation
+BURST_SECONDS = 2      # tokens a bucket accumulates while its job does not use them
+HEADROOM = 1.5         # demand of a job without backlog, relative to what it used
+MIN_PERIOD = 20        # seconds of counters needed to estimate the demand of a job
+IDLE_SECONDS = 15      # a job without batches waiting or admitted for that long has no demand
+REALLOCATE_SECONDS = 5
+ALLOCATION_KEY = "#allocation"  # item holding the time of the last allocation, not a job
+CONFLICT_RETRIES = 5
+TTL_SECONDS = 7 * 24 * 3600
+
+
+class JobThrottled(Exception):
+    # The job used its share of the TPS; the Map state retries the batch later
+    pass
+
+
+def number(item, attribute, default=0.0):
+    value = item.get(attribute)
+    return float(value['N']) if value else default
+
+
+def water_fill(capacity, jobs, rates, remaining):
+    # Weighted max-min split of capacity between jobs, capped by their remaining demand.
+    # Adds to rates and remaining in place, returns the capacity left over.
+    active = [job for job in jobs if remaining[job["job"]] > 0]
+    while active and capacity > 1e-9:
+        fair = capacity / sum(job["weight"] for job in active)
+        saturated = [job for job in active if remaining[job["job"]] <= fair * job["weight"]]
+        if not saturated:
+            for job in active:
+                rates[job["job"]] += fair * job["weight"]
+                remaining[job["job"]] -= fair * job["weight"]
+            return 0.0
+        for job in saturated:
+            rates[job["job"]] += remaining[job["job"]]
+            capacity -= remaining[job["job"]]
+            remaining[job["job"]] = 0.0
+        active = [job for job in active if remaining[job["job"]] > 0]
+    return capacity
+
+
+def fair_shares(capacity, jobs, floor_share=FLOOR_SHARE):
+    # jobs: [{"job", "priority" (0 first), "weight", "demand" (tokens/s, math.inf with a backlog)}]
+    # Returns {job: rate}, the rates add up to capacity as long as one job has a demand
+    rates = {job["job"]: 0.0 for job in jobs}
+    remaining = {job["job"]: job["demand"] for job in jobs}
+    active = [job for job in jobs if job["demand"] > 0]
+    if not active:
+        return rates
+    floor = capacity * floor_share / len(active)
+    for job in active:
+        grant = min(floor, remaining[job["job"]])
+        rates[job["job"]] += grant
+        remaining[job["job"]] -= grant
+        capacity -= grant
+    for priority in sorted({job["priority"] for job in active}):
+        capacity = water_fill(capacity, [job for job in active if job["priority"] == priority], rates, remaining)
+    # Demand is an estimate: what no job asked for goes to the jobs by weight, so a job picking up
+    # speed is not held back until the next allocation
+    if capacity > 1e-9:
+        total_weight = sum(job["weight"] for job in active)
+        for job in active:
+            rates[job["job"]] += capacity * job["weight"] / total_weight
+    return rates
+
+
+def job_settings(settings):
+    # Priority and weight of a job file ({"priority": "interactive", "weight": 2}), with defaults
+    priority = settings.get("priority", DEFAULT_PRIORITY)
+    if priority not in PRIORITIES:
+        raise ValueError("priority must be one of {}, got {!r}".format(", ".join(PRIORITIES), priority))
+    weight = float(settings.get("weight", 1))
+    if not weight > 0 or math.isinf(weight):
+        raise ValueError("weight must be a positive number, got {!r}".format(settings.get("weight")))
+    return priority, weight
+
+
+class JobScheduler:
+
+    def __init__(self, table_name=None, dynamodb_client=None, clock=time.time):
+        self.table_name = table_name if table_name is not None else os.environ.get('schedulertable')
+        self.dynamodb_client = dynamodb_client
+        self.clock = clock
+
+    @property
+    def enabled(self):
+        return bool(self.table_name)
+
+    def dynamodb(self):
+        if self.dynamodb_client is None:
+            self.dynamodb_client = get_client('dynamodb')
+        return self.dynamodb_client
+
+    def get(self, job):
+        return self.dynamodb().get_item(
+            TableName=self.table_name,
+            Key={'JobId': {'S': job}},
+            ConsistentRead=True
+        ).get('Item')
+
+    def register(self, job, priority=DEFAULT_PRIORITY, weight=1.0, collections=()):
+        # Called by the launcher; a job registered again (redelivered upload) keeps its bucket
+        now = self.clock()
+        values = {
+            ':priority': {'S': priority},
+            ':weight': {'N': repr(float(weight))},
+            ':rate': {'N': repr(MIN_RATE)},
+            ':zero': {'N': '0'},
+            ':now': {'N': repr(now)},
+            ':expires': {'N': str(int(now + TTL_SECONDS))}
+        }
+        expression = ("SET Priority = :priority, Weight = :weight, ExpiresAt = :expires, Rate = if_not_exists(Rate, :rate), "
+                      "Tokens = if_not_exists(Tokens, :zero), Updated = if_not_exists(Updated, :now), "
+                      "Version = if_not_exists(Version, :zero), RegisteredAt = if_not_exists(RegisteredAt, :now)")
+        if collections:
+            expression += " ADD Collections :collections"
+            values[':collections'] = {'SS': sorted(set(collections))}
+        self.dynamodb().update_item(
+            TableName=self.table_name,
+            Key={'JobId': {'S': job}},
+            UpdateExpression=expression,
+            ExpressionAttributeValues=values
+        )
+
+    def admit(self, job, tokens, collections=()):
+        # Takes tokens for a batch of the job: returns 0 when admitted, else the seconds until the
+        # job's balance is back to 0
+        if not self.enabled or tokens <= 0:
+            return 0.0
+        for attempt in range(CONFLICT_RETRIES):
+            item = self.get(job)
+            if item is None:
+                # Execution started by hand: it gets a share from the next allocation
+                log("Job not registered with the scheduler", sampled=False, jobId=job)
+                self.register(job, collections=collections)
+                continue
+            now = self.clock()
+            rate = max(MIN_RATE, number(item, 'Rate', MIN_RATE))
+            balance = min(max(1.0, rate * BURST_SECONDS), number(item, 'Tokens') + max(0.0, now - number(item, 'Updated', now)) * rate)
+            if balance < 0:
+                return -balance / rate
+            values = {
+                ':tokens': {'N': repr(balance - tokens)},
+                ':now': {'N': repr(now)},
+                ':version': item.get('Version', {'N': '0'}),
+                ':next': {'N': str(int(number(item, 'Version')) + 1)},
+                ':admitted': {'N': str(tokens)},
+                ':expires': {'N': str(int(now + TTL_SECONDS))}
+            }
+            expression = ("SET Tokens = :tokens, Updated = :now, AdmittedAt = :now, Version = :next, ExpiresAt = :expires "
+                          "ADD Admitted :admitted")
+            if collections:
+                expression += ", Collections :collections"
+                values[':collections'] = {'SS': sorted(set(collections))}
+            try:
+                self.dynamodb().update_item(
+                    TableName=self.table_name,
+                    Key={'JobId': {'S': job}},
+                    UpdateExpression=expression,
+                    ConditionExpression="Version = :version",
+                    ExpressionAttributeValues=values
+                )
+                return 0.0
+            except self.dynamodb().exceptions.ConditionalCheckFailedException:
+                continue
+        # Busy bucket, tried again after a short wait
+        return 0.05
+
+    def refund(self, job, tokens):
+        # Tokens taken for records that did not become IndexFaces jobs (invalid, collapsed, unchanged)
+        if not self.enabled or tokens <= 0:
+            return
+        try:
+            self.dynamodb().update_item(
+                TableName=self.table_name,
+                Key={'JobId': {'S': job}},
+                UpdateExpression="ADD Tokens :tokens, Admitted :admitted, Version :one",
+                ConditionExpression="attribute_exists(JobId)",
+                ExpressionAttributeValues={':tokens': {'N': str(tokens)}, ':admitted': {'N': str(-tokens)}, ':one': {'N': '1'}}
+            )
+        except Exception as e:
+            log("Error while refunding scheduler tokens", sampled=False, jobId=job, error=str(e))
+
+    def throttled(self, job):
+        # Once per batch that has to wait for tokens: tells the allocator the job has a backlog
+        if not self.enabled:
+            return
+        try:
+            self.dynamodb().update_item(
+                TableName=self.table_name,
+                Key={'JobId': {'S': job}},
+                UpdateExpression="SET RefusedAt = :now ADD Throttled :one",
+                ConditionExpression="attribute_exists(JobId)",
+                ExpressionAttributeValues={':now': {'N': repr(self.clock())}, ':one': {'N': '1'}}
+            )
+        except Exception as e:
+            log("Error while counting a throttled batch", sampled=False, jobId=job, error=str(e))
+
+    def jobs(self):
+        paginator = self.dynamodb().get_paginator('scan')
+        for page in paginator.paginate(TableName=self.table_name, ConsistentRead=True):
+            yield from page.get('Items', [])
+
+    def demand(self, item, now):
+        # Tokens/s the job would use: unbounded before its first allocation and while batches wait
+        # for tokens, 0 once it is idle, what it used plus headroom otherwise
+        if 'AllocatedAt' not in item or now - number(item, 'RefusedAt', -math.inf) <= IDLE_SECONDS:
+            return math.inf
+        if now - max(number(item, prop, -math.inf) for prop in ('AdmittedAt', 'RegisteredAt')) > IDLE_SECONDS:
+            return 0.0
+        elapsed = now - number(item, 'AllocatedAt')
+        if elapsed < MIN_PERIOD:
+            return number(item, 'Demand', math.inf)
+        return max(0.0, number(item, 'Admitted') - number(item, 'AdmittedMark')) / elapsed * HEADROOM
+
+    def allocate(self, capacity):
+        # Splits capacity (IndexFaces TPS) between the jobs and sets their rates; returns the allocation
+        if not self.enabled:
+            return []
+        now = self.clock()
+        items = {item['JobId']['S']: item for item in self.jobs() if item['JobId']['S'] != ALLOCATION_KEY}
+        jobs = [{
+            "job": job,
+            "priority": PRIORITIES.get(item.get('Priority', {}).get('S'), PRIORITIES[DEFAULT_PRIORITY]),
+            "weight": number(item, 'Weight', 1.0),
+            "demand": self.demand(item, now)
+        } for job, item in items.items()]
+        rates = fair_shares(capacity, jobs)
+        allocation = []
+        for job in jobs:
+            rate = max(MIN_RATE, rates[job["job"]])
+            self.set_rate(job["job"], items[job["job"]], rate, job["demand"])
+            allocation.append(dict(job, rate=round(rate, 3), demand=None if math.isinf(job["demand"]) else round(job["demand"], 3),
+                                   collections=items[job["job"]].get('Collections', {}).get('SS', [])))
+        log("Allocated IndexFaces TPS", sampled=False, capacity=capacity,
+            jobs=[entry for entry in allocation if entry["demand"] != 0])
+        return allocation
+
+    def reallocate(self, capacity):
+        # Allocates unless another invocation did within REALLOCATE_SECONDS; returns True if it did
+        if not self.enabled:
+            return False
+        now = self.clock()
+        try:
+            self.dynamodb().update_item(
+                TableName=self.table_name,
+                Key={'JobId': {'S': ALLOCATION_KEY}},
+                UpdateExpression="SET AllocatedAt = :now",
+                ConditionExpression="attribute_not_exists(AllocatedAt) OR AllocatedAt < :due",
+                ExpressionAttributeValues={':now': {'N': repr(now)}, ':due': {'N': repr(now - REALLOCATE_SECONDS)}}
+            )
+        except self.dynamodb().exceptions.ConditionalCheckFailedException:
+            return False
+        self.allocate(capacity)
+        return True
+
+    def set_rate(self, job, item, rate, demand):
+        for attempt in range(CONFLICT_RETRIES):
+            now = self.clock()
+            old_rate = max(MIN_RATE, number(item, 'Rate', MIN_RATE))
+            # Tokens up to now accrue at the old rate
+            balance = min(max(1.0, old_rate * BURST_SECONDS), number(item, 'Tokens') + max(0.0, now - number(item, 'Updated', now)) * old_rate)
+            values = {
+                ':rate': {'N': repr(rate)},
+                ':tokens': {'N': repr(balance)},
+                ':now': {'N': repr(now)},
+                ':version': item.get('Version', {'N': '0'}),
+                ':next': {'N': str(int(number(item, 'Version')) + 1)},
+                ':admitted': item.get('Admitted', {'N': '0'})
+            }
+            expression = "SET Rate = :rate, Tokens = :tokens, Updated = :now, Version = :next"
+            # The admitted count keeps accumulating until the period is long enough to estimate the demand
+            if now - number(item, 'AllocatedAt', -math.inf) >= MIN_PERIOD:
+                expression += ", AdmittedMark = :admitted, AllocatedAt = :now"
+                if math.isinf(demand):
+                    expression += " REMOVE Demand"
+                else:
+                    expression += ", Demand = :demand"
+                    values[':demand'] = {'N': repr(demand)}
+            else:
+                del values[':admitted']
+            try:
+                self.dynamodb().update_item(
+                    TableName=self.table_name,
+                    Key={'JobId': {'S': job}},
+                    UpdateExpression=expression,
+                    ConditionExpression="Version = :version",
+                    ExpressionAttributeValues=values
+                )
+                return
+            except self.dynamodb().exceptions.ConditionalCheckFailedException:
+                item = self.get(job) or item
+        log("Job rate not updated, bucket busy", sampled=False, jobId=job, rate=rate)
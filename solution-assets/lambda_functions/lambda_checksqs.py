@@ -1,6 +1,9 @@
-import boto3, json, os
-sqsClient = boto3.client('sqs')
+import json, os
+from aws_clients import LazyClient
+from instrumentation import instrumented
+sqsClient = LazyClient('sqs')
 
+@instrumented
 def lambda_handler(event, context):
     status = False
     
@@ -0,0 +1,17 @@
+import json
+from completion_tracker import CompletionTracker
+from instrumentation import instrumented
+
+tracker = CompletionTracker()
+
+@instrumented
+def lambda_handler(event, context):
+    # Invoked with .waitForTaskToken after the Map state: stores the token, and resumes the
+    # execution right away if every record has already been processed
+    done = tracker.seal(event['executionId'], event['taskToken'])
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps('Execution sealed'),
+        'completed': done
+    }
@@ -1,38 +1,58 @@
-import json, boto3, os
+import json, os
+from results_store import BatchWriter, buildDynamoItems
+from results_export import ResultsExporter, EXPORT_LOCATION
+from completion_tracker import CompletionTracker, is_final_attempt
+from aws_clients import LazyClient
+from instrumentation import instrumented, metrics, log
 
-dynClient = boto3.client('dynamodb')
+dynClient = LazyClient('dynamodb')
+s3Client = LazyClient('s3')
+tracker = CompletionTracker()
 
+
+@instrumented
 def lambda_handler(event, context):
+    writer = BatchWriter(os.environ["dynamoTable"], dynClient)
+    exporter = ResultsExporter(EXPORT_LOCATION, s3Client) if EXPORT_LOCATION else None
+    failedMessages = set()
+    executions = {}  # messageId -> ExecutionId
+    payloads = {}  # messageId -> payload, for the export
+
+    for record in event['Records']:
+        try:
+            # Get SQS data
+            payload = json.loads(record["body"])
+            executions[record["messageId"]] = payload.get("ExecutionId")
+            for dynamoitem in buildDynamoItems(payload):
+                writer.add(record["messageId"], dynamoitem)
+            payloads[record["messageId"]] = payload
+        except (ValueError, KeyError, TypeError) as e:
+            log("Invalid record", sampled=False, messageId=record.get("messageId"), error=str(e))
+            failedMessages.add(record["messageId"])
+
+    failedMessages.update(writer.flush())
+
+    # Only what reached the table is exported; a failed export sends the messages back to the queue
+    if exporter:
+        for messageId, payload in payloads.items():
+            if messageId not in failedMessages:
+                exporter.add(messageId, payload)
+        failedMessages.update(exporter.flush())
+    metrics.add("Records", len(event['Records']))
+    metrics.add("FailedRecords", len(failedMessages))
+    log("Results stored", records=len(event['Records']), roundTrips=writer.roundTrips, failed=len(failedMessages))
+
+    # Written records and records failing for the last time (next stop is the DLQ) are finished
+    completed = {}
     for record in event['Records']:
-        print("Reading record")
-        print("--------------")
-
-        # Get SQS data
-        payload = json.loads(record["body"])
-        print(payload)
-        
-        for face in payload["Faces"]:
-            dynamoitem = {
-                'Bucket': {'S': str(payload["Bucket"])},
-                'Key': {'S': str(payload["Key"])},
-                'ExternalImageId': {'S': str(payload["ExternalImageId"])},
-                'UserID': {'S': str(face["UserID"])},
-                'FaceId': {'S': str(face["FaceId"])},
-                'OldFaceId': {'S': str(face["OldFaceId"])},
-                'OldImageId': {'S': str(face["OldImageId"])},
-                'ImageId': {'S': str(face["ImageId"])},
-                'BoundingBoxes':{'S': json.dumps(face["BoundingBoxes"])}
-            }
-            
-            if "IsNewFace" in face:
-                dynamoitem.update({'IsNewFace':{'S': str(face["IsNewFace"])}})
-
-            response = dynClient.put_item(
-                TableName=os.environ["dynamoTable"],
-                Item=dynamoitem)
-            print(response)
+        executionId = executions.get(record["messageId"])
+        if executionId and (record["messageId"] not in failedMessages or is_final_attempt(record)):
+            completed[executionId] = completed.get(executionId, 0) + 1
+    tracker.add_completed_counts(completed)
 
+    # Partial batch response: only the failed messages return to the queue
     return {
         'statusCode': 200,
-        'body': json.dumps('Results sent to Dynamo')
-    }
\ No newline at end of file
+        'body': json.dumps('Results sent to Dynamo'),
+        'batchItemFailures': [{'itemIdentifier': messageId} for messageId in sorted(failedMessages)]
+    }
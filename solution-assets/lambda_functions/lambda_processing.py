@@ -1,69 +1,342 @@
-import boto3
 import json
 import os
+import random
+import time
 import botocore
+from concurrent.futures import ThreadPoolExecutor
+from s3_index import IndexedValidator
+from record_schema import validate_records
+from image_normalizer import ImageNormalizer
+from completion_tracker import CompletionTracker
+from job_scheduler import JobScheduler, JobThrottled
+from results_export import jobOf
+from results_store import storedFaceIds
+from reindex_ledger import ImageLedger, imageKey, recordFingerprint
+from aws_clients import LazyClient
+from instrumentation import instrumented, metrics, log
 
-sqs_client = boto3.client('sqs')
-s3_client = boto3.client('s3')
-firehose_client = boto3.client('firehose')
+S3_WORKERS = 16
+MAX_RETRIES = 5
+MAX_FANOUT = 50  # records sharing one IndexFaces job, keeps the job message well under 256 KiB
+
+# SendMessageBatch: 10 entries and 256 KiB per call. PutRecordBatch: 500 records and 4 MiB per call.
+SQS_BATCH_COUNT = 10
+SQS_BATCH_BYTES = 256 * 1024
+FIREHOSE_BATCH_COUNT = 500
+FIREHOSE_BATCH_BYTES = 4 * 1024 * 1024
+
+# Time a batch waits in the invocation for its job's share of the TPS before the Map state retries it,
+# and time kept to process it once admitted
+ADMISSION_WAIT_SECONDS = 30
+PROCESSING_RESERVE_SECONDS = 15
+
+sqs_client = LazyClient('sqs')
+s3_client = LazyClient('s3', pool_size=S3_WORKERS)
+firehose_client = LazyClient('firehose')
+dynamodb_client = LazyClient('dynamodb')
+tracker = CompletionTracker()
+scheduler = JobScheduler(dynamodb_client=dynamodb_client)
+ledger = ImageLedger(client=dynamodb_client)
+
+# (bucket, key) -> (ETag, ContentLength) seen by HeadObject in this invocation, used to find
+# identical images stored under different keys
+object_tags = {}
 
 def validate_s3(bucket, key):
     try:
         response = s3_client.head_object(Bucket=bucket, Key=key)
         if response['ContentLength'] == 0:
             return False, "S3 validation failed: Object has zero bytes"
+        if response.get('ETag'):
+            object_tags[(bucket, key)] = (response['ETag'], response['ContentLength'])
         return True, None
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == '404':
             return False, "S3 validation failed: Object does not exist"
         return False, f"S3 validation failed: {str(e)}"
 
-def validate_schema(item):
-    expected_properties = {"Bucket", "Key", "ExternalImageId", "CollectionId"}
-    missing_props = expected_properties - set(item.keys())
-    if missing_props:
-        return False, item, f"Missing required properties: {', '.join(missing_props)}"
+# Optional index mode: check keys against a prebuilt bucket index, HeadObject only for keys it does not hold
+indexed_validator = IndexedValidator(s3_client, os.environ['s3indexlocation'], validate_s3) if os.environ.get('s3indexlocation') else None
+
+# Optional image normalization: images IndexFaces would reject are converted to a derived copy first
+normalizer = ImageNormalizer(s3_client, os.environ['normalizelocation']) if os.environ.get('normalizelocation') else None
+
+def check_s3(bucket, key):
+    if indexed_validator:
+        return indexed_validator.validate(bucket, key)
+    return validate_s3(bucket, key)
+
+def image_identity(item):
+    # Same S3 object, or same content under another key when HeadObject returned an ETag
+    tag = object_tags.get((item["Bucket"], item["Key"]))
+    if tag:
+        return item["CollectionId"], "etag", tag
+    return item["CollectionId"], "key", item["Bucket"], item["Key"]
+
+def plan_jobs(items):
+    # Collapses records of the same image (~8% of legacy collections) into one IndexFaces job: the
+    # first record carries the others under "Duplicates" and lambda_reindex fans the indexed faces
+    # out to all of them. Records without faces never call IndexFaces and are not grouped.
+    jobs = []
+    groups = {}
+    collapsed = 0
+    for item in items:
+        if not item.get("Faces"):
+            jobs.append(item)
+            continue
+        identity = image_identity(item)
+        job = groups.get(identity)
+        if job is None or len(job.get("Duplicates", [])) + 1 >= MAX_FANOUT:
+            groups[identity] = item
+            jobs.append(item)
+        else:
+            job.setdefault("Duplicates", []).append(
+                {prop: item[prop] for prop in ("Bucket", "Key", "ExternalImageId", "Faces", "Fingerprint", "ObjectTag") if prop in item})
+            collapsed += 1
+    # Counted here: normalization later drops the jobs it rejects, with their duplicates
+    metrics.add("CollapsedItems", collapsed)
+    return jobs
+
+def job_records(job):
+    # The job and the records collapsed into it, as they appeared in the manifest
+    duplicates = job.pop("Duplicates", [])
+    records = [job] + [dict(duplicate, CollectionId=job["CollectionId"]) for duplicate in duplicates]
+    for record in records:
+        for prop in ("ExecutionId", "Fingerprint", "ObjectTag", "Image"):
+            record.pop(prop, None)
+    return records
+
+def normalize_jobs(jobs):
+    # Returns the jobs to enqueue, pointed at the derived image where one was needed, and the failed
+    # records of the jobs whose image IndexFaces cannot read. Jobs without faces never call IndexFaces.
+    indexed = [job for job in jobs if job.get("Faces")]
+
+    def normalize(job):
+        try:
+            return normalizer.normalize(job["Bucket"], job["Key"])
+        except Exception as e:
+            # Left to IndexFaces, as without normalization
+            log("Image normalization skipped", sampled=False, bucket=job["Bucket"], key=job["Key"], error=str(e))
+            return None, None
+
+    with ThreadPoolExecutor(max_workers=S3_WORKERS) as executor:
+        results = dict(zip(map(id, indexed), executor.map(normalize, indexed)))
+    ready, rejected = [], []
+    for job in jobs:
+        image, reason = results.get(id(job), (None, None))
+        if reason:
+            rejected.extend({"record": record, "reason": reason} for record in job_records(job))
+            continue
+        if image:
+            job["Image"] = image
+        ready.append(job)
+    metrics.add("RejectedImages", len(jobs) - len(ready))
+    return ready, rejected
+
+def add_fingerprints(items):
+    # Recorded in the ledger when the record completes, so a later delta job can tell it is unchanged
+    for item in items:
+        tag = object_tags.get((item["Bucket"], item["Key"]))
+        if tag:
+            item["ObjectTag"] = tag[0]
+        item["Fingerprint"] = recordFingerprint(item, item.get("ObjectTag"))
+
+def image_of(item):
+    return item["CollectionId"], item["Bucket"], item["Key"], item["ExternalImageId"]
+
+def skip_unchanged(items):
+    # Delta mode: items the ledger holds as DONE with the same fingerprint (same record, same S3
+    # object) were reindexed by an earlier job and are not enqueued again
+    if not ledger.enabled:
+        log("Delta mode needs the image ledger, enqueueing every item", sampled=False)
+        return items
+    completed = ledger.completedFingerprints([image_of(item) for item in items])
+    pending = [item for item in items if completed.get(imageKey(*image_of(item))) != item["Fingerprint"]]
+    metrics.add("UnchangedItems", len(items) - len(pending))
+    log("Delta: skipped unchanged items", sampled=False, skipped=len(items) - len(pending))
+    return pending
 
-    for prop, value in item.items():
-        if prop in expected_properties and not isinstance(value, str):
-            return False, item, f"Invalid type for property '{prop}': expected 'str', got '{type(value).__name__}'"
+def old_face_ids(item):
+    faces = item.get("Faces") if isinstance(item, dict) else None
+    if not isinstance(faces, list) or not faces:
+        return []
+    if not all(isinstance(face, dict) and isinstance(face.get("FaceId"), str) for face in faces):
+        return []
+    return [face["FaceId"] for face in faces]
 
-    return True, item, None
+def skip_reindexed(items, table_name):
+    # Resume mode: items whose faces all have a row in the results table were reindexed by an
+    # earlier run and are not enqueued again
+    stored = storedFaceIds(dynamodb_client, table_name, [face_id for item in items for face_id in old_face_ids(item)])
+    pending = [item for item in items if not old_face_ids(item) or not set(old_face_ids(item)) <= stored]
+    metrics.add("SkippedItems", len(items) - len(pending))
+    log("Resume: skipped items already in the results table", sampled=False, skipped=len(items) - len(pending))
+    return pending
 
 def process_items(items):
     success_items = []
-    failed_items = []
-    for item in items:
-        schema_validation, validated_item, schema_reason = validate_schema(item)
-        if schema_validation:
-            s3_validation, s3_reason = validate_s3(validated_item["Bucket"], validated_item["Key"])
+    # Malformed records are rejected here instead of costing an IndexFaces call in lambda_reindex
+    schema_valid, failed_items = validate_records(items)
+
+    # HeadObject checks run in parallel, results come back in input order
+    with ThreadPoolExecutor(max_workers=S3_WORKERS) as executor:
+        results = executor.map(lambda item: check_s3(item["Bucket"], item["Key"]), schema_valid)
+        for validated_item, (s3_validation, s3_reason) in zip(schema_valid, results):
             if s3_validation:
                 success_items.append(validated_item)
             else:
                 failed_items.append({"record": validated_item, "reason": s3_reason})
-        else:
-            failed_items.append({"record": item, "reason": schema_reason})
     return success_items, failed_items
 
+def admit_batch(job, items, context):
+    # Waits until the job's token bucket admits the batch; a batch still waiting when the invocation
+    # runs out of time goes back to the Map state, which retries it (JobThrottled)
+    collections = {item["CollectionId"] for item in items if isinstance(item, dict) and isinstance(item.get("CollectionId"), str)}
+    budget = ADMISSION_WAIT_SECONDS
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        budget = min(budget, context.get_remaining_time_in_millis() / 1000.0 - PROCESSING_RESERVE_SECONDS)
+    deadline = time.time() + budget
+    waited, refused = 0.0, False
+    while True:
+        wait = scheduler.admit(job, len(items), collections)
+        if wait and not refused:
+            refused = True
+            scheduler.throttled(job)
+            # Shares of finished jobs are handed out before the next scheduled allocation
+            if scheduler.reallocate(float(os.environ['indexfacestps'])):
+                continue
+        if not wait:
+            metrics.put("AdmissionWait", waited * 1000)
+            return
+        if time.time() + wait > deadline:
+            metrics.add("ThrottledBatches")
+            raise JobThrottled(f"Job {job} is over its share of the IndexFaces TPS, retry in {wait:.1f}s")
+        # Jitter spreads the batches waiting for the same bucket
+        wait *= random.uniform(1.0, 1.2)
+        time.sleep(wait)
+        waited += wait
+
+def batches(entries, max_count, max_bytes, size):
+    # Split entries into batches bounded by entry count and total payload size
+    batch, batch_bytes = [], 0
+    for entry in entries:
+        entry_bytes = size(entry)
+        if batch and (len(batch) == max_count or batch_bytes + entry_bytes > max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(entry)
+        batch_bytes += entry_bytes
+    if batch:
+        yield batch
+
+def backoff(attempt):
+    time.sleep(min(2.0, 0.05 * (2 ** attempt)))
+
+def send_to_sqs(items, queue_url):
+    # Returns the items that could not be enqueued, with the reason
+    entries = [{'Id': str(position), 'MessageBody': json.dumps(item), 'DelaySeconds': 1} for position, item in enumerate(items)]
+    undelivered = []
+    for batch in batches(entries, SQS_BATCH_COUNT, SQS_BATCH_BYTES, lambda entry: len(entry['MessageBody'].encode('utf-8'))):
+        pending = batch
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                response = sqs_client.send_message_batch(QueueUrl=queue_url, Entries=pending)
+            except Exception as e:
+                # Throttled after the client retries, or a network error: the chunk is reported as not
+                # enqueued instead of failing the Map batch, whose retry would enqueue the earlier chunks again
+                log("Error while sending records to SQS", sampled=False, error=str(e))
+                undelivered.extend({"record": items[int(entry['Id'])], "reason": f"SQS send failed: {e}"} for entry in pending)
+                pending = []
+                break
+            failed = response.get('Failed', [])
+            # SenderFault entries will fail again (e.g. oversized message), only retry the others
+            retry_ids = {entry['Id'] for entry in failed if not entry.get('SenderFault')}
+            for entry in failed:
+                if entry.get('SenderFault'):
+                    undelivered.append({"record": items[int(entry['Id'])], "reason": f"SQS send failed: {entry.get('Code')} {entry.get('Message', '')}".strip()})
+            pending = [entry for entry in pending if entry['Id'] in retry_ids]
+            if not pending or attempt == MAX_RETRIES:
+                break
+            backoff(attempt)
+        for entry in pending:
+            undelivered.append({"record": items[int(entry['Id'])], "reason": "SQS send failed after retries"})
+    log("Sent valid records to SQS", sent=len(items) - len(undelivered))
+    return undelivered
+
+def send_to_firehose(failed_items, delivery_stream):
+    records = [{'Data': json.dumps(failed_item) + '\n'} for failed_item in failed_items]
+    for batch in batches(records, FIREHOSE_BATCH_COUNT, FIREHOSE_BATCH_BYTES, lambda record: len(record['Data'].encode('utf-8'))):
+        pending = batch
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                response = firehose_client.put_record_batch(DeliveryStreamName=delivery_stream, Records=pending)
+            except Exception as e:
+                # The valid records are already enqueued: failing the Map batch here would enqueue them again
+                log("Error while sending records to Kinesis Firehose", sampled=False, error=str(e))
+                break
+            if response.get('FailedPutCount', 0) == 0:
+                pending = []
+                break
+            # RequestResponses is positional: entries with an ErrorCode need to be sent again
+            pending = [record for record, result in zip(pending, response['RequestResponses']) if result.get('ErrorCode')]
+            if attempt < MAX_RETRIES:
+                backoff(attempt)
+        if pending:
+            log("Failed to send records to Kinesis Firehose", sampled=False, records=pending)
+    log("Sent failed items to Kinesis Firehose", sent=len(failed_items))
+
+@instrumented
 def lambda_handler(event, context):
     if "Items" in event:
         items = event["Items"]
     else:
         items = [event]
 
+    # Set by the Map state's ItemBatcher, lets the reindex side report when this execution is done
+    execution_id = event.get("BatchInput", {}).get("executionId")
+    object_tags.clear()
+
+    if event.get("BatchInput", {}).get("resume"):
+        items = skip_reindexed(items, os.environ['dynamoTable'])
+
+    # Multi-job scheduling: a token per record, the ones that do not become IndexFaces jobs are refunded
+    job_id = jobOf(execution_id)
+    if scheduler.enabled and items:
+        admit_batch(job_id, items, context)
+
     success_items, failed_items = process_items(items)
+    add_fingerprints(success_items)
+
+    if event.get("BatchInput", {}).get("delta"):
+        success_items = skip_unchanged(success_items)
 
-    sqsURL = os.environ['reindexsqsurl']
-    for item in success_items:
-        sqs_client.send_message(QueueUrl=sqsURL, MessageBody=json.dumps(item), DelaySeconds=1)
-        print(f"Sent valid record to SQS: {json.dumps(item)}")
+    jobs = plan_jobs(success_items)
+    undelivered = []
+    undelivered_records = 0
+    if normalizer and jobs:
+        jobs, rejected = normalize_jobs(jobs)
+        undelivered_records += len(rejected)
+        failed_items.extend(rejected)
+    if jobs:
+        if execution_id:
+            for job in jobs:
+                job["ExecutionId"] = execution_id
+        undelivered = send_to_sqs(jobs, os.environ['reindexsqsurl'])
+        tracker.add_expected(execution_id, len(jobs) - len(undelivered))
+        for failed_job in undelivered:
+            records = job_records(failed_job["record"])
+            undelivered_records += len(records)
+            failed_items.extend({"record": record, "reason": failed_job["reason"]} for record in records)
+    if scheduler.enabled:
+        scheduler.refund(job_id, len(items) - (len(jobs) - len(undelivered)))
+
+    metrics.add("Items", len(items))
+    metrics.add("EnqueuedItems", len(success_items) - undelivered_records)
+    metrics.add("IndexFacesJobs", len(jobs) - len(undelivered))
+    metrics.add("FailedItems", len(failed_items))
 
     if failed_items:
-        print("failed items: {}".format(failed_items))
-        firehose_delivery_stream = os.environ['kinesis_stream']
-        for failed_item in failed_items:
-            record = {'Data': json.dumps(failed_item) + '\n'}
-            firehose_client.put_record(DeliveryStreamName=firehose_delivery_stream, Record=record)
-            print(f"Sent failed item to Kinesis Firehose: {json.dumps(failed_item)}")
-
-    return {'statusCode': 200, 'body': json.dumps('Hello from Lambda!')}
\ No newline at end of file
+        log("Failed items", failed_items=failed_items)
+        send_to_firehose(failed_items, os.environ['kinesis_stream'])
+
+    return {'statusCode': 200, 'body': json.dumps('Hello from Lambda!')}
@@ -1,39 +1,83 @@
-import json, boto3, os, time
-
-rekClient = boto3.client('rekognition')
-sqsClient = boto3.client('sqs')
+import json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from face_matching import calculate_iou, match_faces
+from record_schema import faces_error
+from rate_limiter import TokenBucket, DeadlineExceeded
+from completion_tracker import CompletionTracker, is_final_attempt
+from log_sink import LogSink
+from results_store import BatchWriter, buildDynamoItems
+from results_export import ResultsExporter, EXPORT_LOCATION
+from reindex_ledger import ImageLedger, DONE, INDEXED
+from concurrency_controller import LIMIT_KEY
+from aws_clients import LazyClient
+from instrumentation import instrumented, metrics, log
+
+rekClient = LazyClient('rekognition')
+sqsClient = LazyClient('sqs')
+dynamoClient = LazyClient('dynamodb')
+s3Client = LazyClient('s3')
 
 IOU_Threshold = 0.5
+MAX_WORKERS = 10
+
+# Each execution environment gets its share of the account IndexFaces TPS quota: the quota divided by
+# the MaximumConcurrency UpdateConcurrency last applied to the event source mapping (controller table),
+# re-read every LIMIT_REFRESH_SECONDS. `maxconcurrency` is the mapping's initial MaximumConcurrency.
+INDEX_FACES_TPS = float(os.environ.get('indexfacestps', 50))
+LIMIT_REFRESH_SECONDS = 60
+indexFacesLimiter = TokenBucket(INDEX_FACES_TPS / float(os.environ.get('maxconcurrency', 50)))
+limitRefreshed = None
+# Records whose IndexFaces call cannot start this long before the function times out are handed back
+# to the queue (batchItemFailures), leaving time for the calls in flight and the end of the batch
+DEADLINE_MARGIN_SECONDS = 10
+invocationDeadline = None
+tracker = CompletionTracker()
+# Error logs are buffered per invocation and written with BatchWriteItem at the end of the batch
+logSink = LogSink(os.environ['dynamologs'], dynamoClient)
+
+# Direct persist mode: results are written to the results table at the end of the batch instead of
+# going through the DynamoDB queue and the StoreResults function. Records whose items could not be
+# written fall back to the queue.
+DIRECT_PERSIST = os.environ.get('directpersist', 'false').lower() == 'true'
+resultsWriter = BatchWriter(os.environ['dynamoTable'], dynamoClient) if DIRECT_PERSIST else None
+resultsExporter = ResultsExporter(EXPORT_LOCATION, s3Client) if DIRECT_PERSIST and EXPORT_LOCATION else None
+pendingResults = {}  # messageId -> results waiting for the batch write
+pendingLock = threading.Lock()
+
+# Processed-image ledger: skips completed images and never calls IndexFaces twice for one image
+ledger = ImageLedger(client=dynamoClient)
+
+
+def refreshIndexFacesRate():
+    global limitRefreshed
+    if not os.environ.get('controllertable'):
+        return
+    now = time.monotonic()
+    if limitRefreshed is not None and now - limitRefreshed < LIMIT_REFRESH_SECONDS:
+        return
+    limitRefreshed = now
+    try:
+        item = dynamoClient.get_item(
+            TableName=os.environ['controllertable'],
+            Key={'UUID': {'S': LIMIT_KEY.format(os.environ.get('AWS_LAMBDA_FUNCTION_NAME', ''))}}
+        ).get('Item')
+    except Exception as e:
+        log("Error while reading the event source mapping concurrency", sampled=False, error=str(e))
+        return
+    if item:
+        concurrency = max(1, int(item['MaximumConcurrency']['N']))
+        indexFacesLimiter.set_rate(INDEX_FACES_TPS / concurrency)
+        metrics.put("IndexFacesRate", INDEX_FACES_TPS / concurrency, unit='Count/Second')
 
 
-def bboxesProvided(ProvidedFaces):
-    complete = True
-    for face in ProvidedFaces:
-        if len(face["BoundingBoxes"].keys()) != 4:
-            complete = False
-        if all(face["BoundingBoxes"].values()) == False:
-            print("Missing bounding boxes")
-            complete = False
-            break
-    return complete
-
-
-# def validateSchema(ProvidedFaces): TODO
-
-
-def calculate_iou(bb1, bb2):
-    bb1_x1, bb1_x2, bb1_y1, bb1_y2 = bb1["Left"], bb1["Left"] + bb1["Width"], bb1["Top"], bb1["Top"] + bb1["Height"]
-    bb2_x1, bb2_x2, bb2_y1, bb2_y2 = bb2["Left"], bb2["Left"] + bb2["Width"], bb2["Top"], bb2["Top"] + bb2["Height"]
-    x_left, y_top, x_right, y_bottom = max(bb1_x1, bb2_x1), max(bb1_y1, bb2_y1), min(bb1_x2, bb2_x2), min(bb1_y2,
-                                                                                                          bb2_y2)
-    if x_right < x_left or y_bottom < y_top: return 0
-    intersection_area = (x_right - x_left) * (y_bottom - y_top)
-    bb1_area, bb2_area = (bb1_x2 - bb1_x1) * (bb1_y2 - bb1_y1), (bb2_x2 - bb2_x1) * (bb2_y2 - bb2_y1)
-    iou = intersection_area / float(bb1_area + bb2_area - intersection_area)
-    return iou
+def startDeadline(context):
+    global invocationDeadline
+    remaining = context.get_remaining_time_in_millis() / 1000.0 if context is not None else None
+    invocationDeadline = time.monotonic() + remaining - DEADLINE_MARGIN_SECONDS if remaining else None
 
 
 def rekogIndexFaces(bucket, key, collectionId, externalImageId):
+    indexFacesLimiter.acquire(deadline=invocationDeadline)
     rek_response = rekClient.index_faces(
         CollectionId=collectionId,
         Image={
@@ -48,266 +92,424 @@ def rekogIndexFaces(bucket, key, collectionId, externalImageId):
     return rek_response["FaceRecords"]
 
 
-def sendResultstoDynamo(updatedRecords):
+def imageObject(payload):
+    # The derived copy when the Processor normalized the image, the manifest object otherwise
+    image = payload.get("Image") or payload
+    return image["Bucket"], image["Key"]
+
+
+def indexImage(payload):
+    # Returns the indexed faces. An image the ledger shows as already reindexed returns its stored
+    # faces, so its results are sent again: the ledger marks an image DONE once its results are
+    # queued, and a resumed or replayed record must still reach the results table if that message
+    # was lost. Results are keyed by OldFaceId, so storing them twice is harmless.
+    image = (payload["CollectionId"], payload["Bucket"], payload["Key"], payload["ExternalImageId"])
+    if not ledger.enabled:
+        return rekogIndexFaces(*imageObject(payload), payload["CollectionId"], payload["ExternalImageId"])
+
+    status, faceRecords = ledger.claim(*image, fingerprint=payload.get("Fingerprint"), objectTag=payload.get("ObjectTag"))
+    if status == DONE:
+        log("Image already reindexed, sending its results again", bucket=payload["Bucket"], key=payload["Key"])
+        metrics.add("ReemittedImages")
+        return faceRecords
+    if status == INDEXED:
+        # An earlier delivery indexed the image but did not get to hand on the results
+        log("Reusing faces indexed by an earlier delivery", bucket=payload["Bucket"], key=payload["Key"])
+        return faceRecords
+
+    faceRecords = rekogIndexFaces(*imageObject(payload), payload["CollectionId"], payload["ExternalImageId"])
+    ledger.recordFaces(*image, faceRecords)
+    return faceRecords
+
+
+def completeImages(records):
+    # Best effort: an image left INDEXED is picked up again with its stored faces
+    for record in records:
+        try:
+            payload = json.loads(record["body"])
+            for job in [payload] + payload.get("Duplicates", []):
+                ledger.complete(payload["CollectionId"], job["Bucket"], job["Key"], job["ExternalImageId"],
+                                job.get("Fingerprint"), job.get("ObjectTag"))
+        except Exception as e:
+            log("Error marking record as complete in the ledger", sampled=False, messageId=record.get("messageId"), error=str(e))
+
+
+def recordFaces(payloadFaces, rekogIndexedFaces):
+    metrics.put("FacesProvided", len(payloadFaces), "Count")
+    metrics.put("FacesIndexed", len(rekogIndexedFaces), "Count")
+    metrics.add("FacesProvidedTotal", len(payloadFaces))
+    log("Faces indexed", received=len(payloadFaces), indexed=len(rekogIndexedFaces))
+
+
+def sendResultstoDynamo(updatedRecords, executionId=None, messageId=None):
+    # Provided faces mapped to an indexed face above the IoU threshold, and faces only Rekognition found
+    faces = [face for results in [updatedRecords] + updatedRecords.get("Duplicates", []) for face in results["Faces"]]
+    metrics.add("MatchedFaces", sum(1 for face in faces if face.get("IsNewFace") is False))
+    metrics.add("NewFaces", sum(1 for face in faces if face.get("IsNewFace") is True))
+    # The execution id travels with the results so lambda_dynamo can report completion
+    if executionId:
+        updatedRecords["ExecutionId"] = executionId
+    if resultsWriter and messageId:
+        with pendingLock:
+            pendingResults[messageId] = updatedRecords
+        return True
+    return queueResults(updatedRecords)
+
+
+def queueResults(updatedRecords):
     sqs_response = sqsClient.send_message(
         QueueUrl=os.environ['dynamosqsurl'],
         MessageBody=json.dumps(updatedRecords),
         DelaySeconds=5,
     )
 
-    print(sqs_response)
-    print("Message Sent to DynamoDB queue")
-
-
-def sendLogstoDynamo(payload, error, dynamodb_table_name=os.environ['dynamologs']):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(dynamodb_table_name)
-
-    # Extract FaceId from the payload
-    faces = payload.get('Faces', [])
-    face_id = faces[0].get('FaceId') if faces else 'NO_FACE_ID'
-
-    log_entry = {
-        'FaceId': face_id,
-        'Payload': json.dumps(payload),
-        'ErrorReason': error
-    }
-
-    try:
-        if face_id == 'NO_FACE_ID':
-            # If no face is detected, append the payload to the list of payloads
-            response = table.update_item(
-                Key={'FaceId': 'NO_FACE_ID'},
-                UpdateExpression="SET Payloads = list_append(if_not_exists(Payloads, :empty_list), :payload)",
-                ExpressionAttributeValues={
-                    ':empty_list': [],
-                    ':payload': [log_entry],
-                }
-            )
-        else:
-            # If a face is detected, put the log entry directly
-            response = table.put_item(Item=log_entry)
-
-        print("Log entry successfully added to DynamoDB:", response)
-
-    except Exception as e:
-        print("Error while adding log entry to DynamoDB:", e)
-
-
-def lambda_handler(event, context):
-    for record in event['Records']:
-
-        # Get SQS data
-        payload = json.loads(record["body"])
-        print(payload)
-        # Get the number of faces provided by the customer
-        payloadFaces = payload["Faces"]
-
-        ## Scenario 1. No faces are provided by the customer.
-        ## TODO -- Replace BBCheck for Schema Validation
-        if len(payloadFaces) == 0 or bboxesProvided(payloadFaces) == False:
-            print("Faces Received: {}".format(len(payloadFaces)))
-            print("Error, No faces provided by user or missing bounding boxes values")
-            sendLogstoDynamo(payload, "No faces provided by user or missing bounding boxes values")
-
-        ## Scenario 2. One face is provided by the customer.
-        elif len(payloadFaces) == 1:
-            providedFace = payloadFaces[0]
-
-            rekogIndexedFaces = rekogIndexFaces(  # Index faces with Rekognition.
-                payload["Bucket"],
-                payload["Key"],
-                payload["CollectionId"],
-                payload["ExternalImageId"])
-
-            ## Scenario 2.1. Rekognition does not find any face to index
-            ## Action 1: Raise Error
-            if len(rekogIndexedFaces) == 0:
-                print("Faces Received: {} -- Faces Indexed: {}".format(len(payloadFaces), len(rekogIndexedFaces)))
-                print("Error, no faces found")  # Raise error
-                sendLogstoDynamo(payload, "1 face expected, no faces found.")
-            ## Scenario 2.2. Rekognition indexes 1 face
-            ## Action 1: Map face if iou is higher than 0.5
-            elif len(rekogIndexedFaces) == 1:
-                print("Faces Received: {} -- Faces Indexed: {}".format(len(payloadFaces), len(rekogIndexedFaces)))
-                rekogIndexFace = rekogIndexedFaces[0]["Face"]
-                iou = calculate_iou(providedFace["BoundingBoxes"], rekogIndexFace["BoundingBox"])
-                if iou > IOU_Threshold:
-                    updatedRecords = {
-                        "Bucket": payload["Bucket"],
-                        "Key": payload["Key"],
-                        "ExternalImageId": payload["ExternalImageId"],
-                        "Faces": [{
-                            "UserID": providedFace["UserId"],
-                            "OldFaceId": providedFace["FaceId"],
-                            "OldImageId": providedFace["ImageId"],
-                            "FaceId": rekogIndexFace["FaceId"],
-                            "ImageId": rekogIndexFace["ImageId"],
-                            "BoundingBoxes": rekogIndexFace["BoundingBox"],
-                            "IsNewFace": False
-                        }]
-                    }
-
-                else:
-                    print("Not able to map face found")
-                    updatedRecords = {
-                        "Bucket": payload["Bucket"],
-                        "Key": payload["Key"],
-                        "ExternalImageId": payload["ExternalImageId"],
-                        "Faces": [{
-                            "UserID": "NewFace-{}".format(rekogIndexFace["FaceId"]),
-                            "OldFaceId": "NewFace-{}".format(rekogIndexFace["FaceId"]),
-                            "OldImageId": "NewFace-{}".format(rekogIndexFace["FaceId"]),
-                            "FaceId": rekogIndexFace["FaceId"],
-                            "ImageId": rekogIndexFace["ImageId"],
-                            "BoundingBoxes": rekogIndexFace["BoundingBox"],
-                            "IsNewFace": True
-                        }]
-                    }
-                    sendLogstoDynamo(payload, "Not able to map face found.")
-                # Send records to Dynamo
-                sendResultstoDynamo(updatedRecords)
-
-            ## Scenario 2.3. Rekognition indexes more than 1 face
-            ## Action 1: Map provided face to one of the indexed faces with the best iou
-            ## Action 2: Notify new indexed faces
-            elif len(rekogIndexedFaces) > 1:
-                print("Faces Received: {} -- Faces Indexed: {}".format(len(payloadFaces), len(rekogIndexedFaces)))
-                sendLogstoDynamo(payload, "Indexed more than 1 expected face.")
+    log("Message sent to DynamoDB queue", messageId=sqs_response.get("MessageId"))
+    return True
+
+
+def persistResults():
+    # Direct persist mode: one buffered BatchWriteItem pass for the results of the whole batch. Items
+    # are keyed by OldFaceId, so writing the same results again (retried record, queue fallback) is
+    # idempotent. Returns (persisted, failed) messageIds; failed ones could not be queued either.
+    with pendingLock:
+        results = dict(pendingResults)
+        pendingResults.clear()
+    if not results:
+        return set(), set()
+
+    for messageId, updatedRecords in results.items():
+        for dynamoitem in buildDynamoItems(updatedRecords):
+            resultsWriter.add(messageId, dynamoitem)
+    unwritten = resultsWriter.flush()
+
+    # Results that could not be exported also take the queue: the StoreResults function writes and
+    # exports them again
+    if resultsExporter:
+        for messageId, updatedRecords in results.items():
+            if messageId not in unwritten:
+                resultsExporter.add(messageId, updatedRecords)
+        unwritten = unwritten | resultsExporter.flush()
+
+    failed = set()
+    for messageId in unwritten:
+        try:
+            queueResults(results[messageId])
+        except Exception as e:
+            log("Error sending results to the DynamoDB queue", sampled=False, messageId=messageId, error=str(e))
+            failed.add(messageId)
+    return set(results) - unwritten, failed
+
+
+def sendLogstoDynamo(payload, error):
+    metrics.add("LoggedErrors")
+    logSink.add(payload, error)
+
+
+def processRecord(record):
+    # Returns True when the results were forwarded to the DynamoDB queue (or buffered for the
+    # results table in direct persist mode), False when the record finished here (only logged)
+    # Get SQS data
+    payload = json.loads(record["body"])
+    log("Record received", payload=payload)
+
+    # Records of the same image collapsed into this job by the Processor function: the image is
+    # indexed once, with the ExternalImageId of the job, and the indexed faces are matched against
+    # the provided faces of every record
+    duplicates = [dict(duplicate, CollectionId=payload["CollectionId"]) for duplicate in payload.pop("Duplicates", [])]
+    indexed = []
+
+    def indexFaces():
+        if not indexed:
+            indexed.append(indexImage(payload))
+        return indexed[0]
+
+    results = [updatedRecords for updatedRecords in (mapFaces(job, indexFaces) for job in [payload] + duplicates) if updatedRecords]
+    if not results:
+        return False
+    # One results message per job, so the completion counts stay one per enqueued record
+    updatedRecords = results[0]
+    if len(results) > 1:
+        updatedRecords["Duplicates"] = results[1:]
+    # Partitions the columnar export of the results
+    updatedRecords["CollectionId"] = payload["CollectionId"]
+    return sendResultstoDynamo(updatedRecords, payload.get("ExecutionId"), record["messageId"])
+
+
+def mapFaces(payload, indexFaces):
+    # Returns the results of one record, or None when it finished here (only logged)
+    # Get the number of faces provided by the customer
+    payloadFaces = payload["Faces"]
+
+    ## Scenario 1. No faces are provided by the customer, or they are malformed.
+    ## The Processor already rejects malformed faces, this covers messages sent to the queue directly.
+    facesError = faces_error(payloadFaces) if payloadFaces else "No faces provided by user"
+    if facesError:
+        metrics.add("FacesProvidedTotal", len(payloadFaces))
+        log("No faces provided by user or invalid faces", received=len(payloadFaces), reason=facesError)
+        sendLogstoDynamo(payload, facesError)
+
+    ## Scenario 2. One face is provided by the customer.
+    elif len(payloadFaces) == 1:
+        providedFace = payloadFaces[0]
+
+        rekogIndexedFaces = indexFaces()  # Index faces with Rekognition.
+        if rekogIndexedFaces is None:
+            return None
+
+        ## Scenario 2.1. Rekognition does not find any face to index
+        ## Action 1: Raise Error
+        if len(rekogIndexedFaces) == 0:
+            recordFaces(payloadFaces, rekogIndexedFaces)
+            sendLogstoDynamo(payload, "1 face expected, no faces found.")
+        ## Scenario 2.2. Rekognition indexes 1 face
+        ## Action 1: Map face if iou is higher than 0.5
+        elif len(rekogIndexedFaces) == 1:
+            recordFaces(payloadFaces, rekogIndexedFaces)
+            rekogIndexFace = rekogIndexedFaces[0]["Face"]
+            iou = calculate_iou(providedFace["BoundingBoxes"], rekogIndexFace["BoundingBox"])
+            if iou > IOU_Threshold:
                 updatedRecords = {
                     "Bucket": payload["Bucket"],
                     "Key": payload["Key"],
                     "ExternalImageId": payload["ExternalImageId"],
-                    "Faces": []
+                    "Faces": [{
+                        "UserID": (providedFace.get("UserId") or ""),
+                        "OldFaceId": providedFace["FaceId"],
+                        "OldImageId": providedFace["ImageId"],
+                        "FaceId": rekogIndexFace["FaceId"],
+                        "ImageId": rekogIndexFace["ImageId"],
+                        "BoundingBoxes": rekogIndexFace["BoundingBox"],
+                        "IsNewFace": False
+                    }]
                 }
 
-                for indexedface in rekogIndexedFaces:
-                    iou = calculate_iou(providedFace["BoundingBoxes"], indexedface["Face"]["BoundingBox"])
-                    if iou > IOU_Threshold:
-                        updatedRecords["Faces"].append({
-                            "UserID": providedFace["UserId"],
-                            "OldFaceId": providedFace["FaceId"],
-                            "OldImageId": providedFace["ImageId"],
-                            "FaceId": indexedface["Face"]["FaceId"],
-                            "ImageId": indexedface["Face"]["ImageId"],
-                            "BoundingBoxes": indexedface["Face"]["BoundingBox"],
-                            "IsNewFace": False
-                        })
-                    else:
-                        updatedRecords["Faces"].append({
-                            "UserID": "NewFace-{}".format(indexedface["Face"]["FaceId"]),
-                            "OldFaceId": "NewFace-{}".format(indexedface["Face"]["FaceId"]),
-                            "OldImageId": "NewFace-{}".format(indexedface["Face"]["FaceId"]),
-                            "FaceId": indexedface["Face"]["FaceId"],
-                            "ImageId": indexedface["Face"]["ImageId"],
-                            "BoundingBoxes": indexedface["Face"]["BoundingBox"],
-                            "IsNewFace": True
-                        })
-
-                sendResultstoDynamo(updatedRecords)
-
-        ## Scenario 3. More than one face is provided by the customer.
-        elif len(payloadFaces) > 1:
-
-            rekogIndexedFaces = rekogIndexFaces(  # Index faces with Rekognition.
-                payload["Bucket"],
-                payload["Key"],
-                payload["CollectionId"],
-                payload["ExternalImageId"]
-            )
-
-            ## Scenario 3.1. Rekognition does not find any face to index
-            ## Action 1: Raise Error
-            if len(rekogIndexedFaces) == 0:
-                print("Faces Received: {} -- Faces Indexed: {}".format(len(payloadFaces), len(rekogIndexedFaces)))
-                print("Error, no faces provided")  # Raise error
-                sendLogstoDynamo(payload, ">1 face expected, no faces found.")
-
-            ## Scenario 3.2. Rekognition only indexes one face
-            ## Action 1: We try to map it to one of the input faces.
-            ## Action 2: We save the other provided faces with "Not reindexed" and notify customer.
-            ## Alternative: If there are more provided faces than rekognition can find, we raise an error.
-
-            elif len(rekogIndexedFaces) == 1:
-                print("Faces Received: {} -- Faces Indexed: {}".format(len(payloadFaces), len(rekogIndexedFaces)))
-                rekogIndexedFace = rekogIndexedFaces[0]["Face"]
-
+            else:
+                log("Not able to map face found", iou=iou)
                 updatedRecords = {
                     "Bucket": payload["Bucket"],
                     "Key": payload["Key"],
                     "ExternalImageId": payload["ExternalImageId"],
-                    "Faces": []
+                    "Faces": [{
+                        "UserID": "NewFace-{}".format(rekogIndexFace["FaceId"]),
+                        "OldFaceId": "NewFace-{}".format(rekogIndexFace["FaceId"]),
+                        "OldImageId": "NewFace-{}".format(rekogIndexFace["FaceId"]),
+                        "FaceId": rekogIndexFace["FaceId"],
+                        "ImageId": rekogIndexFace["ImageId"],
+                        "BoundingBoxes": rekogIndexFace["BoundingBox"],
+                        "IsNewFace": True
+                    }]
                 }
+                sendLogstoDynamo(payload, "Not able to map face found.")
+            return updatedRecords
+
+        ## Scenario 2.3. Rekognition indexes more than 1 face
+        ## Action 1: Map provided face to one of the indexed faces with the best iou
+        ## Action 2: Notify new indexed faces
+        elif len(rekogIndexedFaces) > 1:
+            recordFaces(payloadFaces, rekogIndexedFaces)
+            sendLogstoDynamo(payload, "Indexed more than 1 expected face.")
+            updatedRecords = {
+                "Bucket": payload["Bucket"],
+                "Key": payload["Key"],
+                "ExternalImageId": payload["ExternalImageId"],
+                "Faces": []
+            }
 
-                for providedFace in payloadFaces:
-                    iou = calculate_iou(providedFace["BoundingBoxes"], rekogIndexedFace["BoundingBox"])
-                    if (iou > IOU_Threshold):
-                        updatedRecords["Faces"].append({
-                            "UserID": providedFace["UserId"],
-                            "OldFaceId": providedFace["FaceId"],
-                            "OldImageId": providedFace["ImageId"],
-                            "FaceId": rekogIndexedFace["FaceId"],
-                            "ImageId": rekogIndexedFace["ImageId"],
-                            "BoundingBoxes": rekogIndexedFace["BoundingBox"],
-                            "IsNewFace": False
-                        })
-                    else:
-                        updatedRecords["Faces"].append({
-                            "UserID": providedFace["UserId"],
-                            "OldFaceId": providedFace["FaceId"],
-                            "OldImageId": providedFace["ImageId"],
-                            "FaceId": "Not reindexed",
-                            "ImageId": "Not reindexed",
-                            "BoundingBoxes": "Not reindexed"
-                        })
-                sendLogstoDynamo(payload, ">1 face expected, only 1 face found.")
-                sendResultstoDynamo(updatedRecords)
-
-            ## Scenario 3.3. Rekognition finds more than one face
-            ## Action 1: Try to match all of the indexed faces by rekognition to the original input.
-            ## Action 2: If new faces are discovered by rekog, we save them with "NewFaceIndexed"
-
-            elif len(rekogIndexedFaces) > 1:
-                print("Faces Received: {} -- Faces Indexed: {}".format(len(payloadFaces), len(rekogIndexedFaces)))
-                updatedRecords = {
-                    "Bucket": payload["Bucket"],
-                    "Key": payload["Key"],
-                    "ExternalImageId": payload["ExternalImageId"],
-                    "Faces": []
-                }
+            matches = match_faces(payloadFaces, rekogIndexedFaces, IOU_Threshold)
+            for position, indexedface in enumerate(rekogIndexedFaces):
+                if position in matches:
+                    updatedRecords["Faces"].append({
+                        "UserID": (providedFace.get("UserId") or ""),
+                        "OldFaceId": providedFace["FaceId"],
+                        "OldImageId": providedFace["ImageId"],
+                        "FaceId": indexedface["Face"]["FaceId"],
+                        "ImageId": indexedface["Face"]["ImageId"],
+                        "BoundingBoxes": indexedface["Face"]["BoundingBox"],
+                        "IsNewFace": False
+                    })
+                else:
+                    updatedRecords["Faces"].append({
+                        "UserID": "NewFace-{}".format(indexedface["Face"]["FaceId"]),
+                        "OldFaceId": "NewFace-{}".format(indexedface["Face"]["FaceId"]),
+                        "OldImageId": "NewFace-{}".format(indexedface["Face"]["FaceId"]),
+                        "FaceId": indexedface["Face"]["FaceId"],
+                        "ImageId": indexedface["Face"]["ImageId"],
+                        "BoundingBoxes": indexedface["Face"]["BoundingBox"],
+                        "IsNewFace": True
+                    })
+
+            return updatedRecords
+
+    ## Scenario 3. More than one face is provided by the customer.
+    elif len(payloadFaces) > 1:
+
+        rekogIndexedFaces = indexFaces()  # Index faces with Rekognition.
+        if rekogIndexedFaces is None:
+            return None
+
+        ## Scenario 3.1. Rekognition does not find any face to index
+        ## Action 1: Raise Error
+        if len(rekogIndexedFaces) == 0:
+            recordFaces(payloadFaces, rekogIndexedFaces)
+            sendLogstoDynamo(payload, ">1 face expected, no faces found.")
+
+        ## Scenario 3.2. Rekognition only indexes one face
+        ## Action 1: We try to map it to one of the input faces.
+        ## Action 2: We save the other provided faces with "Not reindexed" and notify customer.
+        ## Alternative: If there are more provided faces than rekognition can find, we raise an error.
+
+        elif len(rekogIndexedFaces) == 1:
+            recordFaces(payloadFaces, rekogIndexedFaces)
+            rekogIndexedFace = rekogIndexedFaces[0]["Face"]
+
+            updatedRecords = {
+                "Bucket": payload["Bucket"],
+                "Key": payload["Key"],
+                "ExternalImageId": payload["ExternalImageId"],
+                "Faces": []
+            }
+
+            # Only the best matching provided face can claim the indexed face
+            matches = match_faces(payloadFaces, rekogIndexedFaces, IOU_Threshold)
+            matchedPosition = matches[0][0] if 0 in matches else None
+            for position, providedFace in enumerate(payloadFaces):
+                if position == matchedPosition:
+                    updatedRecords["Faces"].append({
+                        "UserID": (providedFace.get("UserId") or ""),
+                        "OldFaceId": providedFace["FaceId"],
+                        "OldImageId": providedFace["ImageId"],
+                        "FaceId": rekogIndexedFace["FaceId"],
+                        "ImageId": rekogIndexedFace["ImageId"],
+                        "BoundingBoxes": rekogIndexedFace["BoundingBox"],
+                        "IsNewFace": False
+                    })
+                else:
+                    updatedRecords["Faces"].append({
+                        "UserID": (providedFace.get("UserId") or ""),
+                        "OldFaceId": providedFace["FaceId"],
+                        "OldImageId": providedFace["ImageId"],
+                        "FaceId": "Not reindexed",
+                        "ImageId": "Not reindexed",
+                        "BoundingBoxes": "Not reindexed"
+                    })
+            sendLogstoDynamo(payload, ">1 face expected, only 1 face found.")
+            return updatedRecords
+
+        ## Scenario 3.3. Rekognition finds more than one face
+        ## Action 1: Try to match all of the indexed faces by rekognition to the original input.
+        ## Action 2: If new faces are discovered by rekog, we save them with "NewFaceIndexed"
+
+        elif len(rekogIndexedFaces) > 1:
+            recordFaces(payloadFaces, rekogIndexedFaces)
+            updatedRecords = {
+                "Bucket": payload["Bucket"],
+                "Key": payload["Key"],
+                "ExternalImageId": payload["ExternalImageId"],
+                "Faces": []
+            }
+
+            # Optimal one-to-one assignment between provided and indexed faces
+            matches = match_faces(payloadFaces, rekogIndexedFaces, IOU_Threshold)
+            for position, rekogIndexedFace in enumerate(rekogIndexedFaces):
+                if position in matches:
+                    providedFace = payloadFaces[matches[position][0]]
+                    updatedRecords["Faces"].append({
+                        "UserID": (providedFace.get("UserId") or ""),
+                        "OldFaceId": providedFace["FaceId"],
+                        "OldImageId": providedFace["ImageId"],
+                        "FaceId": rekogIndexedFace["Face"]["FaceId"],
+                        "ImageId": rekogIndexedFace["Face"]["ImageId"],
+                        "BoundingBoxes": rekogIndexedFace["Face"]["BoundingBox"],
+                        "IsNewFace": False
+                    })
+                # If we cannot match the indexed face to any of the original input, notify the customer
+                else:
+                    updatedRecords["Faces"].append({
+                        "UserID": "NewFace-{}".format(rekogIndexedFace["Face"]["FaceId"]),
+                        "OldFaceId": "NewFace-{}".format(rekogIndexedFace["Face"]["FaceId"]),
+                        "OldImageId": "NewFace-{}".format(rekogIndexedFace["Face"]["FaceId"]),
+                        "FaceId": rekogIndexedFace["Face"]["FaceId"],
+                        "ImageId": rekogIndexedFace["Face"]["ImageId"],
+                        "BoundingBoxes": rekogIndexedFace["Face"]["BoundingBox"],
+                        "IsNewFace": True
+                    })
+                    sendLogstoDynamo(payload, "Not able to match indexed faces to any of the original input.")
+
+            return updatedRecords
+
+    return None
+
+
+def executionIdOf(record):
+    try:
+        return json.loads(record["body"]).get("ExecutionId")
+    except (ValueError, AttributeError):
+        return None
+
+
+@instrumented
+def lambda_handler(event, context):
+    records = event['Records']
+    refreshIndexFacesRate()
+    startDeadline(context)
+    ledger.startInvocation()
+    batchItemFailures = []
+    finished = []  # records that reached a final state in this invocation
+    handled = []  # records processed without error
+
+    # Records are processed concurrently; IndexFaces calls are paced by the shared token bucket
+    with ThreadPoolExecutor(max_workers=max(1, min(len(records), MAX_WORKERS))) as executor:
+        futures = {executor.submit(processRecord, record): record for record in records}
+        for future in as_completed(futures):
+            record = futures[future]
+            try:
+                if not future.result():
+                    finished.append(record)
+                handled.append(record)
+            except DeadlineExceeded:
+                # Not started: the IndexFaces share of this environment does not cover the whole batch
+                # before the timeout, so the record goes back to the queue instead of the batch timing out
+                metrics.add("DeferredRecords")
+                log("Record deferred, no IndexFaces token before the deadline", messageId=record.get("messageId"))
+                batchItemFailures.append({'itemIdentifier': record["messageId"]})
+                if is_final_attempt(record):
+                    finished.append(record)
+            except Exception as e:
+                log("Error processing record", sampled=False, messageId=record.get("messageId"), error=str(e))
+                batchItemFailures.append({'itemIdentifier': record["messageId"]})
+                if is_final_attempt(record):
+                    finished.append(record)
+
+    if resultsWriter:
+        persisted, failed = persistResults()
+        for record in records:
+            if record["messageId"] in persisted:
+                finished.append(record)
+            elif record["messageId"] in failed:
+                batchItemFailures.append({'itemIdentifier': record["messageId"]})
+                if is_final_attempt(record):
+                    finished.append(record)
+
+    logSink.flush()
+
+    if ledger.enabled:
+        failedIds = {failure['itemIdentifier'] for failure in batchItemFailures}
+        completeImages([record for record in handled if record["messageId"] not in failedIds])
+
+    completed = {}  # ExecutionId -> records that finished in this invocation
+    for record in finished:
+        executionId = executionIdOf(record)
+        completed[executionId] = completed.get(executionId, 0) + 1
+    tracker.add_completed_counts(completed)
+
+    metrics.add("Records", len(records))
+    metrics.add("FailedRecords", len(batchItemFailures))
+    provided = metrics.total("FacesProvidedTotal")
+    if provided:
+        metrics.put("IoUMatchRate", 100.0 * metrics.total("MatchedFaces") / provided, "Percent")
 
-                for rekogIndexedFace in rekogIndexedFaces:
-                    matchedFace = False
-                    for providedFace in payloadFaces:
-                        iou = calculate_iou(providedFace["BoundingBoxes"], rekogIndexedFace["Face"]["BoundingBox"])
-                        if (iou > IOU_Threshold):
-                            updatedRecords["Faces"].append({
-                                "UserID": providedFace["UserId"],
-                                "OldFaceId": providedFace["FaceId"],
-                                "OldImageId": providedFace["ImageId"],
-                                "FaceId": rekogIndexedFace["Face"]["FaceId"],
-                                "ImageId": rekogIndexedFace["Face"]["ImageId"],
-                                "BoundingBoxes": rekogIndexedFace["Face"]["BoundingBox"],
-                                "IsNewFace": False
-                            })
-                            matchedFace = True
-                            break
-                    # If we cannot match the indexed face to any of the original input, notify the customer
-                    if matchedFace == False:
-                        updatedRecords["Faces"].append({
-                            "UserID": "NewFace-{}".format(rekogIndexedFace["Face"]["FaceId"]),
-                            "OldFaceId": "NewFace-{}".format(rekogIndexedFace["Face"]["FaceId"]),
-                            "OldImageId": "NewFace-{}".format(rekogIndexedFace["Face"]["FaceId"]),
-                            "FaceId": rekogIndexedFace["Face"]["FaceId"],
-                            "ImageId": rekogIndexedFace["Face"]["ImageId"],
-                            "BoundingBoxes": rekogIndexedFace["Face"]["BoundingBox"],
-                            "IsNewFace": True
-                        })
-                        sendLogstoDynamo(payload, "Not able to match indexed faces to any of the original input.")
-
-                sendResultstoDynamo(updatedRecords)
-    time.sleep(0.6)
     return {
         'statusCode': 200,
-        'body': json.dumps('Index Correct')
-    }
\ No newline at end of file
+        'body': json.dumps('Index Correct'),
+        'batchItemFailures': batchItemFailures
+    }
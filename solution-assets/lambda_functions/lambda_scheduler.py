@@ -0,0 +1,22 @@
+import json
+import os
+from job_scheduler import JobScheduler
+from aws_clients import LazyClient
+from instrumentation import instrumented, metrics
+
+dynamodb_client = LazyClient('dynamodb')
+scheduler = JobScheduler(dynamodb_client=dynamodb_client)
+
+
+@instrumented
+def lambda_handler(event, context):
+    # Runs every minute: splits the IndexFaces TPS between the running jobs from their backlog
+    allocation = scheduler.allocate(float(os.environ['indexfacestps']))
+    backlogged = [entry for entry in allocation if entry['demand'] is None]
+    metrics.add("ActiveJobs", len([entry for entry in allocation if entry['demand'] != 0]))
+    metrics.add("BackloggedJobs", len(backlogged))
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(allocation)
+    }
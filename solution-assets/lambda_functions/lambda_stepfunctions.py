@@ -1,25 +1,111 @@
+import hashlib
 import json
 import os
-import boto3
+from urllib.parse import unquote_plus
+from aws_clients import LazyClient
+from job_scheduler import JobScheduler, job_settings
+from instrumentation import instrumented, log
 
+RESUME_PREFIX = "records/resume/"
+DELTA_PREFIX = "records/delta/"
+JOB_SUFFIX = ".job.json"
+
+# Manifest shards of one job are split over at most this many parallel executions
+MAX_EXECUTIONS = int(os.environ.get('maxexecutions', 1))
+
+# Created once per execution environment instead of once per invocation
+stepfunctions = LazyClient('stepfunctions')
+s3_client = LazyClient('s3')
+dynamodb_client = LazyClient('dynamodb')
+scheduler = JobScheduler(dynamodb_client=dynamodb_client)
+
+def manifest_keys(bucket, key):
+    # A job file (records/<name>.job.json) lists the manifest shards of one job, either
+    # {"manifests": ["manifests/shard-00000.json", ...]} or {"prefix": "manifests/2024-06-01/"}.
+    # Keep the shards outside records/, or each of them would also start its own job.
+    # A job file can also set the "priority" (interactive, standard, bulk) and "weight" of the job.
+    if not key.endswith(JOB_SUFFIX):
+        return bucket, [key], {}
+    job = json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read())
+    if not isinstance(job, dict):
+        raise ValueError("A job file holds a JSON object, got {}".format(type(job).__name__))
+    bucket = job.get("bucket", bucket)
+    keys = list(job.get("manifests", []))
+    if job.get("prefix"):
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=job["prefix"]):
+            keys.extend(obj["Key"] for obj in page.get("Contents", [])
+                        if obj["Key"].endswith(".json") and not obj["Key"].endswith(JOB_SUFFIX))
+    return bucket, keys, {prop: job[prop] for prop in ("priority", "weight") if prop in job}
+
+def job_id(records):
+    # Derived from the event: a redelivered S3 event gets the same id, and as executions are named
+    # after it, it cannot start the job a second time
+    uploads = sorted([record['s3']['bucket']['name'], record['s3']['object']['key'],
+                      record['s3']['object'].get('sequencer', '')] for record in records)
+    return "job-" + hashlib.sha256(json.dumps(uploads).encode('utf-8')).hexdigest()[:24]
+
+def start_job(bucket, keys, records, resume, delta, priority, weight):
+    job = job_id(records)
+    if scheduler.enabled:
+        # Registered before its first batch, and given its share of the TPS right away
+        scheduler.register(job, priority, weight)
+        scheduler.allocate(float(os.environ['indexfacestps']))
+    executions = max(1, min(MAX_EXECUTIONS, len(keys)))
+    started = []
+    for number in range(executions):
+        try:
+            response = stepfunctions.start_execution(
+                stateMachineArn=os.environ['statemachinearn'],
+                name="{}-{}".format(job, number),
+                input=json.dumps({"bucket": bucket, "keys": keys[number::executions], "jobId": job,
+                                  "res_prefix": "results/{}".format(job), "resume": resume, "delta": delta})
+            )
+            started.append(response['executionArn'])
+        except stepfunctions.exceptions.ExecutionAlreadyExists:
+            log("Execution already started for this upload", sampled=False, jobId=job, execution=number)
+    log("Job started", sampled=False, jobId=job, manifests=len(keys), executions=started, priority=priority, weight=weight)
+    return started
+
+@instrumented
 def lambda_handler(event, context):
-    # Get the S3 bucket and key from the event
-    s3_bucket = event['Records'][0]['s3']['bucket']['name']
-    s3_key = event['Records'][0]['s3']['object']['key']
+    # S3 sends one notification per object, so every manifest uploaded to records/ starts its own
+    # job; a job file groups the shards of one job. Records that do arrive in the same event (e.g. a
+    # redriven or hand-built event) under the same mode and priority are coalesced into one job.
+    # Every record of the event is handled, a bad job file only skips its own record.
+    jobs = {}  # (bucket, resume, delta, priority, weight) -> (manifest keys, event records)
+    for record in event['Records']:
+        s3_bucket = record['s3']['bucket']['name']
+        s3_key = unquote_plus(record['s3']['object']['key'])
 
-    # Define your Step Functions state machine ARN
-    state_machine_arn = os.environ['statemachinearn']
+        # Manifests uploaded under records/resume/ skip the items already in the results table,
+        # manifests under records/delta/ only enqueue the records new or changed since earlier jobs
+        resume = s3_key.startswith(RESUME_PREFIX)
+        delta = s3_key.startswith(DELTA_PREFIX)
 
-    # Create Step Functions client
-    stepfunctions = boto3.client('stepfunctions')
+        try:
+            bucket, keys, settings = manifest_keys(s3_bucket, s3_key)
+        except Exception as e:
+            log("Error reading the job file", sampled=False, bucket=s3_bucket, key=s3_key, error=str(e))
+            continue
+        if not keys:
+            log("No manifests found for the job file", sampled=False, bucket=s3_bucket, key=s3_key)
+            continue
+        try:
+            priority, weight = job_settings(settings)
+        except ValueError as e:
+            log("Invalid job file", sampled=False, bucket=s3_bucket, key=s3_key, error=str(e))
+            continue
+        job_keys, job_records = jobs.setdefault((bucket, resume, delta, priority, weight), ([], []))
+        job_keys.extend(key for key in keys if key not in job_keys)
+        job_records.append(record)
 
-    # Start execution of the Step Functions state machine
-    response = stepfunctions.start_execution(
-        stateMachineArn=state_machine_arn,
-        input=json.dumps({"bucket": s3_bucket, "key": s3_key, "res_prefix":"results"})
-    )
+    started = []
+    for (bucket, resume, delta, priority, weight), (keys, records) in jobs.items():
+        started.extend(start_job(bucket, keys, records, resume, delta, priority, weight))
 
     return {
         'statusCode': 200,
-        'body': json.dumps('Execution started successfully!')
+        'body': json.dumps('Execution started successfully!'),
+        'executions': started
     }
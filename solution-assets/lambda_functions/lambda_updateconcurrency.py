@@ -1,31 +1,144 @@
 import os
-import boto3
 import json
+import time
+from datetime import datetime, timedelta, timezone
+from concurrency_controller import AimdController, LIMIT_KEY
+from aws_clients import LazyClient
+from instrumentation import instrumented, metrics, NAMESPACE
 
 # Initialize AWS clients
-lambda_client = boto3.client('lambda')
+lambda_client = LazyClient('lambda')
+sqs_client = LazyClient('sqs')
+cloudwatch_client = LazyClient('cloudwatch')
+dynamodb_client = LazyClient('dynamodb')
 
+# Period of the UpdateConcurrencySchedule rule: each run looks at the metrics since the previous one
+WINDOW_SECONDS = int(os.environ.get('controlperiodseconds', 300))
+HISTORY_LENGTH = 50
+BACKLOG_ATTRIBUTES = ['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible', 'ApproximateNumberOfMessagesDelayed']
+
+
+def metric_query(query_id, namespace, metric_name, dimensions):
+    return {
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {
+                'Namespace': namespace,
+                'MetricName': metric_name,
+                'Dimensions': [{'Name': name, 'Value': value} for name, value in dimensions.items()]
+            },
+            'Period': 60,
+            'Stat': 'Sum'
+        },
+        'ReturnData': True
+    }
+
+
+def get_signals(function_name):
+    # Throttles and successful calls of IndexFaces, and the records the reindex function received and
+    # reported as failed. Failed records come back as partial batch responses, not as invocation errors,
+    # so AWS/Lambda Errors would stay near 0: read the Records and FailedRecords metrics it emits instead
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(seconds=WINDOW_SECONDS)
+    queries = [
+        metric_query('throttles', 'AWS/Rekognition', 'ThrottledCount', {'Operation': 'IndexFaces'}),
+        metric_query('requests', 'AWS/Rekognition', 'SuccessfulRequestCount', {'Operation': 'IndexFaces'}),
+        metric_query('failed', NAMESPACE, 'FailedRecords', {'FunctionName': function_name}),
+        metric_query('records', NAMESPACE, 'Records', {'FunctionName': function_name}),
+    ]
+    signals = {query['Id']: 0 for query in queries}
+    data = cloudwatch_client.get_metric_data(MetricDataQueries=queries, StartTime=start, EndTime=end)
+    for result in data['MetricDataResults']:
+        signals[result['Id']] = int(sum(result.get('Values', [])))
+    return signals
+
+
+def get_backlog():
+    # Messages waiting, in flight and delayed in the reindex queue
+    queue = sqs_client.get_queue_attributes(QueueUrl=os.environ['reindexsqsurl'], AttributeNames=BACKLOG_ATTRIBUTES)
+    return sum(int(queue["Attributes"].get(name, 0)) for name in BACKLOG_ATTRIBUTES)
+
+
+def load_state(uuid):
+    item = dynamodb_client.get_item(
+        TableName=os.environ['controllertable'],
+        Key={'UUID': {'S': uuid}},
+        ConsistentRead=True
+    ).get('Item')
+    if not item:
+        return {}, []
+    return json.loads(item['State']['S']), json.loads(item['History']['S'])
+
+
+def save_state(uuid, state, history):
+    dynamodb_client.put_item(
+        TableName=os.environ['controllertable'],
+        Item={
+            'UUID': {'S': uuid},
+            'State': {'S': json.dumps(state)},
+            'History': {'S': json.dumps(history[-HISTORY_LENGTH:])}
+        }
+    )
+
+
+def save_limit(function_name, max_concurrency):
+    dynamodb_client.put_item(
+        TableName=os.environ['controllertable'],
+        Item={
+            'UUID': {'S': LIMIT_KEY.format(function_name)},
+            'MaximumConcurrency': {'N': str(max_concurrency)},
+            'Updated': {'N': str(int(time.time()))}
+        }
+    )
+
+
+@instrumented
 def lambda_handler(event, context):
     # Get the function name and the limit from environment variables
     function_name = os.environ['FUNCTION_NAME']
     max_concurrency_limit = int(os.environ['MAX_CONCURRENCY_LIMIT'])
+    controller = AimdController(maximum=max_concurrency_limit)
+
+    # The schedule runs whether or not a job is running: between jobs the reindex queue is empty and
+    # the mappings are left as they are
+    backlog = get_backlog()
+    if not backlog:
+        metrics.add("IdleRuns")
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'updated_mappings': [], 'skipped': 'reindex queue empty'})
+        }
 
     # Get the event source mappings for the function
     event_source_mappings = lambda_client.list_event_source_mappings(FunctionName=function_name)['EventSourceMappings']
+    signals = get_signals(function_name)
+    signals['backlog'] = backlog
 
     # Initialize the response
     response = {
         'updated_mappings': [],
-        'skipped_mappings': []
+        'skipped_mappings': [],
+        'signals': signals
     }
 
     # Iterate over each event source mapping
+    total_concurrency = 0
     for mapping in event_source_mappings:
-        # Check if ScalingConfig.MaximumConcurrency is below the limit
-        if mapping.get('ScalingConfig', {}).get('MaximumConcurrency') is None or mapping['ScalingConfig']['MaximumConcurrency'] < max_concurrency_limit:
-            # Calculate the new MaximumConcurrency value
-            new_max_concurrency = min(max_concurrency_limit, mapping['ScalingConfig'].get('MaximumConcurrency', 0) + 50)
+        current_max_concurrency = mapping.get('ScalingConfig', {}).get('MaximumConcurrency') or max_concurrency_limit
+        state, history = load_state(mapping['UUID'])
+
+        new_max_concurrency, reason, state = controller.decide(current_max_concurrency, signals, state)
+        history.append({
+            'time': int(time.time()),
+            'from': current_max_concurrency,
+            'to': new_max_concurrency,
+            'reason': reason,
+            'signals': signals
+        })
+        save_state(mapping['UUID'], state, history)
+        total_concurrency += new_max_concurrency
 
+        if new_max_concurrency != current_max_concurrency:
             # Update the event source mapping
             lambda_client.update_event_source_mapping(
                 UUID=mapping['UUID'],
@@ -38,16 +151,22 @@ def lambda_handler(event, context):
             # Add the updated mapping to the response
             response['updated_mappings'].append({
                 'UUID': mapping['UUID'],
-                'new_max_concurrency': new_max_concurrency
+                'new_max_concurrency': new_max_concurrency,
+                'reason': reason
             })
         else:
             # Add the skipped mapping to the response
             response['skipped_mappings'].append({
                 'UUID': mapping['UUID'],
-                'current_max_concurrency': mapping['ScalingConfig']['MaximumConcurrency']
+                'current_max_concurrency': current_max_concurrency,
+                'reason': reason
             })
 
+    # The ReIndexing environments divide the IndexFaces TPS by the concurrency actually allowed
+    if total_concurrency:
+        save_limit(function_name, total_concurrency)
+
     return {
         'statusCode': 200,
         'body': json.dumps(response)
-    }
\ No newline at end of file
+    }
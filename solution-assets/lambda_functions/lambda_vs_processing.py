@@ -1,11 +1,13 @@
-import boto3, json, os
-sqsClient = boto3.client('sqs')
+import json, os
+from aws_clients import LazyClient
+from instrumentation import instrumented, log
+sqsClient = LazyClient('sqs')
 
+@instrumented
 def lambda_handler(event, context):
-    print(event)
+    log("Event received", event=event)
     if "Items" in event:
         for item in event["Items"]:
-            print(item)
             sqsURL = os.environ['validationsqsurl']
             response = sqsClient.send_message(
                 QueueUrl=sqsURL,
@@ -1,7 +1,12 @@
 import json
 import os
-import boto3
+from aws_clients import LazyClient
+from instrumentation import instrumented
 
+# Created once per execution environment instead of once per invocation
+stepfunctions = LazyClient('stepfunctions')
+
+@instrumented
 def lambda_handler(event, context):
     # Get the S3 bucket and key from the event
     s3_bucket = event['Records'][0]['s3']['bucket']['name']
@@ -10,9 +15,6 @@ def lambda_handler(event, context):
     # Define your Step Functions state machine ARN
     state_machine_arn = os.environ['statemachinearn']
 
-    # Create Step Functions client
-    stepfunctions = boto3.client('stepfunctions')
-
     # Start execution of the Step Functions state machine
     response = stepfunctions.start_execution(
         stateMachineArn=state_machine_arn,
@@ -1,12 +1,14 @@
-import boto3
 import json
 import os
 import botocore
-#from jsonschema import validate, ValidationError
+from s3_index import IndexedValidator
+from record_schema import record_error
+from aws_clients import LazyClient
+from instrumentation import instrumented, metrics, log
 
-sqs_client = boto3.client('sqs')
-s3_client = boto3.client('s3')
-firehose_client = boto3.client('firehose')
+sqs_client = LazyClient('sqs')
+s3_client = LazyClient('s3')
+firehose_client = LazyClient('firehose')
 
 def validate_s3(bucket, key):
     try:
@@ -20,36 +22,30 @@ def validate_s3(bucket, key):
         else:
             return False, f"S3 validation failed: {str(e)}"
 
-def validate_schema(record):
-    expected_properties = ["Bucket", "Key", "ExternalImageId", "CollectionId"]
+# Optional index mode: check keys against a prebuilt bucket index, HeadObject only for keys it does not hold
+indexed_validator = IndexedValidator(s3_client, os.environ['s3indexlocation'], validate_s3) if os.environ.get('s3indexlocation') else None
 
-    for prop in expected_properties:
-        if prop not in record:
-            return False, record, f"Missing required property: {prop}"
-
-        prop_type = type(record[prop]).__name__
-        expected_type = "str"  # Modify as needed for other expected types
-
-        if prop_type != expected_type:
-            return False, record, f"Invalid type for property '{prop}': expected '{expected_type}', got '{prop_type}'"
-
-    return True, record, None
+def check_s3(bucket, key):
+    if indexed_validator:
+        return indexed_validator.validate(bucket, key)
+    return validate_s3(bucket, key)
 
+@instrumented
 def lambda_handler(event, context):
     success_items = []
     failed_items = []
-    print("Records: {}".format(event['Records']))
+    log("Records received", records=event['Records'])
     for record in event['Records']:
         # Get SQS data
         payload = json.loads(record["body"])
 
-        # Validate against schema first
-        schema_validation, _, schema_reason = validate_schema(payload)
+        # Validate against schema first, same checks as the Processor
+        schema_reason = record_error(payload)
 
         # Check if schema validation passes
-        if schema_validation:
+        if schema_reason is None:
             # Proceed with S3 validation
-            s3_validation, s3_reason = validate_s3(payload["Bucket"], payload["Key"])
+            s3_validation, s3_reason = check_s3(payload["Bucket"], payload["Key"])
 
             # Check if S3 validation passes
             if s3_validation:
@@ -66,8 +62,11 @@ def lambda_handler(event, context):
             })
 
     # Send failed items to the alternative SQS queue with reasons
+    metrics.add("Records", len(event['Records']))
+    metrics.add("FailedItems", len(failed_items))
+
     if failed_items:
-        print("failed items: {}".format(failed_items))
+        log("Failed items", failed_items=failed_items)
         firehose_delivery_stream = os.environ['kinesis_stream']
         for failed_item in failed_items:
             record = {'Data': json.dumps(failed_item) + '\n'}
@@ -75,7 +74,7 @@ def lambda_handler(event, context):
                 DeliveryStreamName=firehose_delivery_stream,
                 Record=record
             )
-        print(f"Sent failed item to Kinesis Firehose: {json.dumps(failed_item)}")
+        log("Sent failed items to Kinesis Firehose", sent=len(failed_items))
 
     return {
         'statusCode': 200,
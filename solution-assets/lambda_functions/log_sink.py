@@ -0,0 +1,61 @@
+import json, time, hashlib, threading
+from instrumentation import log
+from results_store import batchWriteItems
+
+NO_FACE_ID = 'NO_FACE_ID'
+
+
+def noFaceKey(logEntry, loggedAt):
+    # Records without a FaceId used to be appended to a single NO_FACE_ID item: one hot partition
+    # key, growing towards the 400 KB item limit. Each entry now gets its own item under an hourly
+    # prefix, NO_FACE_ID#<yyyymmddHH>#<digest>. The digest is derived from the entry itself, so a
+    # retried record overwrites its own log instead of adding a duplicate, and keys spread across
+    # partitions. Scan with begins_with(FaceId, 'NO_FACE_ID#') to list them.
+    digest = hashlib.sha256((logEntry['Payload'] + '|' + logEntry['ErrorReason']).encode('utf-8')).hexdigest()[:16]
+    return '{}#{}#{}'.format(NO_FACE_ID, time.strftime('%Y%m%d%H', time.gmtime(loggedAt)), digest)
+
+
+class LogSink:
+    # Buffers the error logs of an invocation and writes them to the logs table with BatchWriteItem
+    # when flush() is called. Thread-safe: records of a batch are processed concurrently.
+    # Logging is best effort, entries still unprocessed after the retries are reported and dropped.
+
+    def __init__(self, tableName, client, clock=time.time):
+        self.tableName = tableName
+        self.client = client
+        self.clock = clock
+        self.pending = {}  # FaceId -> item, the last log for a key wins as with put_item
+        self.lock = threading.Lock()
+        self.roundTrips = 0
+
+    def add(self, payload, error):
+        faces = payload.get('Faces', [])
+        faceId = faces[0].get('FaceId') if faces else None
+        loggedAt = self.clock()
+        logEntry = {
+            'Payload': json.dumps(payload),
+            'ErrorReason': error
+        }
+        key = str(faceId) if faceId else noFaceKey(logEntry, loggedAt)
+        item = {
+            'FaceId': {'S': key},
+            'Payload': {'S': logEntry['Payload']},
+            'ErrorReason': {'S': error},
+            'LoggedAt': {'S': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(loggedAt))}
+        }
+        with self.lock:
+            self.pending[key] = item
+
+    def flush(self):
+        # Returns the number of log entries that could not be written
+        with self.lock:
+            items = list(self.pending.values())
+            self.pending = {}
+
+        unwritten, roundTrips = batchWriteItems(self.client, self.tableName, items)
+        self.roundTrips += roundTrips
+        if unwritten:
+            log("Log entries not written after retries", sampled=False, items=unwritten)
+        if items:
+            log("Log entries flushed", entries=len(items), roundTrips=self.roundTrips, unwritten=len(unwritten))
+        return len(unwritten)
@@ -0,0 +1,58 @@
+import threading, time
+
+
+class DeadlineExceeded(Exception):
+    # The tokens would not be available before the caller's deadline
+    pass
+
+
+class TokenBucket:
+    # Thread-safe token bucket. `rate` tokens are added per second up to `capacity`;
+    # acquire() blocks until enough tokens are available.
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive, got {}".format(rate))
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            self.refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1, deadline=None):
+        # Returns the time spent waiting for tokens. With a deadline (a time of `clock`), raises
+        # DeadlineExceeded without taking tokens as soon as the wait would run past it.
+        waited = 0.0
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                wait = (tokens - self.tokens) / self.rate
+                if deadline is not None and self.updated + wait > deadline:
+                    raise DeadlineExceeded("{:.1f}s wait for tokens runs past the deadline".format(wait))
+            self.sleep(wait)
+            waited += wait
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = float(rate)
+            self.capacity = max(1.0, self.rate)
+            self.tokens = min(self.tokens, self.capacity)
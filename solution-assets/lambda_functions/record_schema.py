@@ -0,0 +1,122 @@
+import math
+import re
+
+# Schema of the manifest records, shared by the Processor, the validation pipeline and the ReIndexing
+# function, so a record is rejected before it reaches the reindex queue and never costs an IndexFaces
+# call.
+#
+# Each record is checked in one pass over its fields and faces, with the Rekognition patterns for
+# CollectionId and ExternalImageId compiled once at import. A valid record, the common case, only runs
+# the inline checks of record_error and faces_error; the detailed checks run to find the reason when
+# one of them fails.
+#
+# Bounding boxes are relative to the image: Width and Height in (0, 1], Left and Top within [0, 1].
+# Rekognition returns boxes of faces cut by the image border with Left or Top slightly below 0 (or the
+# box ending past 1), so a box only has to overlap the image: -Width < Left < 1, -Height < Top < 1.
+# Left or Top of exactly 0 is valid.
+
+RECORD_PROPERTIES = ("Bucket", "Key", "CollectionId", "ExternalImageId")
+FACE_PROPERTIES = ("FaceId", "ImageId")
+BOUNDING_BOX_PROPERTIES = frozenset(("Width", "Height", "Left", "Top"))
+NUMBER_TYPES = (int, float)
+
+# IndexFaces parameter constraints
+COLLECTION_ID_PATTERN = re.compile(r"[a-zA-Z0-9_.\-]{1,255}")
+EXTERNAL_IMAGE_ID_PATTERN = re.compile(r"[a-zA-Z0-9_.\-:]{1,255}")
+collection_id_match = COLLECTION_ID_PATTERN.fullmatch
+external_image_id_match = EXTERNAL_IMAGE_ID_PATTERN.fullmatch
+
+
+def box_error(box):
+    if type(box) is not dict or box.keys() != BOUNDING_BOX_PROPERTIES:
+        return "BoundingBoxes must have exactly Width, Height, Left and Top"
+    for prop in ("Width", "Height", "Left", "Top"):
+        value = box[prop]
+        if type(value) is bool or not isinstance(value, NUMBER_TYPES) or not math.isfinite(value):
+            return f"BoundingBoxes '{prop}' is not a number"
+    width, height, left, top = box["Width"], box["Height"], box["Left"], box["Top"]
+    if not (0 < width <= 1 and 0 < height <= 1):
+        return "BoundingBoxes Width and Height must be greater than 0 and at most 1"
+    if not (-width < left < 1 and -height < top < 1):
+        return "BoundingBoxes outside of the image"
+    return None
+
+
+def face_error(face):
+    if type(face) is not dict:
+        return f"expected 'dict', got '{type(face).__name__}'"
+    for prop in FACE_PROPERTIES + ("BoundingBoxes",):
+        if prop not in face:
+            return f"missing property: {prop}"
+    for prop in FACE_PROPERTIES:
+        value = face[prop]
+        if type(value) is not str or not value:
+            return f"'{prop}' must be a non-empty string"
+    user_id = face.get("UserId")
+    if user_id is not None and type(user_id) is not str:
+        return f"'UserId' must be a string, got '{type(user_id).__name__}'"
+    return box_error(face["BoundingBoxes"])
+
+
+def faces_error(faces):
+    # Reason the Faces of a record are invalid, None when they are valid (an empty list is valid)
+    if type(faces) is not list:
+        return f"Invalid type for property 'Faces': expected 'list', got '{type(faces).__name__}'"
+    for position, face in enumerate(faces):
+        # Happy path inline: checks a valid face without a call per face
+        if (type(face) is dict and type(face.get("FaceId")) is str and face["FaceId"]
+                and type(face.get("ImageId")) is str and face["ImageId"]
+                and type(face.get("UserId", "")) is str):
+            box = face.get("BoundingBoxes")
+            if type(box) is dict and box.keys() == BOUNDING_BOX_PROPERTIES:
+                width, height, left, top = box["Width"], box["Height"], box["Left"], box["Top"]
+                # Chained comparisons are False for NaN; bool and infinity fall through to box_error
+                if (type(width) is float or type(width) is int) and (type(height) is float or type(height) is int) \
+                        and (type(left) is float or type(left) is int) and (type(top) is float or type(top) is int) \
+                        and 0 < width <= 1 and 0 < height <= 1 and -width < left < 1 and -height < top < 1:
+                    continue
+        reason = face_error(face)
+        if reason:
+            return f"Invalid face {position}: {reason}"
+    return None
+
+
+def record_error(record):
+    # Reason a manifest record is invalid, None when it is valid
+    if type(record) is not dict:
+        return f"Invalid record: expected 'dict', got '{type(record).__name__}'"
+    # Happy path inline, the checks below work out the reason otherwise
+    bucket, key, faces = record.get("Bucket"), record.get("Key"), record.get("Faces")
+    collection_id, external_image_id = record.get("CollectionId"), record.get("ExternalImageId")
+    if (type(bucket) is str and bucket and type(key) is str and key and type(faces) is list
+            and type(collection_id) is str and collection_id_match(collection_id)
+            and type(external_image_id) is str and external_image_id_match(external_image_id)):
+        return faces_error(faces)
+    missing = [prop for prop in RECORD_PROPERTIES if prop not in record]
+    if missing:
+        return f"Missing required properties: {', '.join(missing)}"
+    for prop in RECORD_PROPERTIES:
+        value = record[prop]
+        if type(value) is not str:
+            return f"Invalid type for property '{prop}': expected 'str', got '{type(value).__name__}'"
+    if not record["Bucket"] or not record["Key"]:
+        return "Bucket and Key must not be empty"
+    if not COLLECTION_ID_PATTERN.fullmatch(record["CollectionId"]):
+        return "Invalid CollectionId: 1 to 255 characters among a-z, A-Z, 0-9, '_', '.' and '-'"
+    if not EXTERNAL_IMAGE_ID_PATTERN.fullmatch(record["ExternalImageId"]):
+        return "Invalid ExternalImageId: 1 to 255 characters among a-z, A-Z, 0-9, '_', '.', '-' and ':'"
+    if "Faces" not in record:
+        return "Missing required properties: Faces"
+    return faces_error(record["Faces"])
+
+
+def validate_records(records):
+    # Splits a batch into (valid records, [{"record", "reason"}]) in input order
+    valid, failed = [], []
+    for record in records:
+        reason = record_error(record)
+        if reason is None:
+            valid.append(record)
+        else:
+            failed.append({"record": record, "reason": reason})
+    return valid, failed
@@ -0,0 +1,178 @@
+import os, json, time, hashlib
+from aws_clients import get_client
+from results_store import batchGetItems
+
+# Processed-image ledger for the ReIndexing function.
+#
+# One item per (CollectionId, Bucket, Key, ExternalImageId) in the ledger table, moved forward with
+# conditional writes:
+#   IN_PROGRESS - a delivery claimed the image, with a lease of `leaseSeconds` from the start of its invocation
+#   INDEXED     - IndexFaces succeeded, the compact FaceRecords are stored on the item
+#   DONE        - the results were handed on (results queue or table) or the errors logged
+# A redelivery after a timeout reuses the stored faces instead of indexing the image a second time,
+# and images that are DONE are matched again against their stored faces without calling IndexFaces,
+# e.g. when a partially failed job is run again, so their results are stored even if the first
+# results message was lost.
+#
+# Items also keep the Fingerprint of the record they completed (manifest record + S3 ETag). A DONE
+# image whose record changed is matched again against its stored faces, or indexed again when the S3
+# object itself changed; delta jobs use the fingerprints to only enqueue new or changed records.
+# Disabled (no-op) when the `ledgertable` environment variable is not set.
+
+IN_PROGRESS = 'IN_PROGRESS'
+INDEXED = 'INDEXED'
+DONE = 'DONE'
+
+# A claim expires this long before SQS can redeliver the message: the time between the event source
+# mapping receiving the batch and the invocation starting
+LEASE_MARGIN_SECONDS = 5
+
+
+class ImageBusy(Exception):
+    # Another delivery of the same image holds a live claim; the record is retried later
+    pass
+
+
+def imageKey(collectionId, bucket, key, externalImageId):
+    parts = json.dumps([collectionId, bucket, key, externalImageId])
+    return hashlib.sha256(parts.encode('utf-8')).hexdigest()
+
+
+def recordFingerprint(record, objectTag=None):
+    # What the reindexing of a record depends on: the manifest record and the version of the S3 object
+    parts = json.dumps([record.get(prop) for prop in ('CollectionId', 'Bucket', 'Key', 'ExternalImageId', 'Faces')] + [objectTag],
+                       sort_keys=True)
+    return hashlib.sha256(parts.encode('utf-8')).hexdigest()
+
+
+def compactFaces(faceRecords):
+    # Only the fields the face matching needs, keeps the ledger item small
+    return [{"Face": {
+        "FaceId": faceRecord["Face"]["FaceId"],
+        "ImageId": faceRecord["Face"]["ImageId"],
+        "BoundingBox": faceRecord["Face"]["BoundingBox"]
+    }} for faceRecord in faceRecords]
+
+
+class ImageLedger:
+
+    def __init__(self, tableName=None, client=None, leaseSeconds=None, clock=time.time):
+        self.tableName = tableName if tableName is not None else os.environ.get('ledgertable')
+        self.client = client
+        # Claims are leased from the start of the invocation until just before the reindex queue
+        # visibility timeout ends, so a redelivered message always finds the lease of the delivery
+        # it replaces expired instead of failing with ImageBusy
+        if leaseSeconds is None:
+            leaseSeconds = int(os.environ.get('queuevisibility', 60)) - LEASE_MARGIN_SECONDS
+        self.leaseSeconds = leaseSeconds
+        self.clock = clock
+        self.leaseStart = None
+
+    def startInvocation(self):
+        self.leaseStart = self.clock()
+
+    def leaseExpires(self, now):
+        start = now if self.leaseStart is None else min(now, self.leaseStart)
+        return str(int(start + self.leaseSeconds))
+
+    @property
+    def enabled(self):
+        return bool(self.tableName)
+
+    def dynamodb(self):
+        if self.client is None:
+            self.client = get_client('dynamodb')
+        return self.client
+
+    def claim(self, collectionId, bucket, key, externalImageId, fingerprint=None, objectTag=None):
+        # Returns (status, faceRecords): (IN_PROGRESS, None) when this delivery should index the
+        # image, (INDEXED, faces) when an earlier delivery already did, (DONE, faces) when the image is
+        # complete. Raises ImageBusy while another delivery holds the claim.
+        now = int(self.clock())
+        try:
+            self.dynamodb().put_item(
+                TableName=self.tableName,
+                Item={
+                    'ImageKey': {'S': imageKey(collectionId, bucket, key, externalImageId)},
+                    'CollectionId': {'S': collectionId},
+                    'Bucket': {'S': bucket},
+                    'Key': {'S': key},
+                    'ExternalImageId': {'S': externalImageId},
+                    'Status': {'S': IN_PROGRESS},
+                    'LeaseExpires': {'N': self.leaseExpires(now)}
+                },
+                ConditionExpression="attribute_not_exists(ImageKey) OR (#status = :inProgress AND LeaseExpires < :now)",
+                ExpressionAttributeNames={'#status': 'Status'},
+                ExpressionAttributeValues={':inProgress': {'S': IN_PROGRESS}, ':now': {'N': str(now)}},
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+            return IN_PROGRESS, None
+        except self.dynamodb().exceptions.ConditionalCheckFailedException as e:
+            item = e.response.get('Item', {})
+
+        status = item.get('Status', {}).get('S')
+        faceRecords = json.loads(item['FaceRecords']['S']) if 'FaceRecords' in item else None
+        if status == INDEXED:
+            return INDEXED, faceRecords
+        if status == DONE:
+            stored = item.get('Fingerprint', {}).get('S')
+            if fingerprint is None or stored is None or stored == fingerprint:
+                return DONE, faceRecords
+            storedTag = item.get('ObjectTag', {}).get('S')
+            if faceRecords is not None and (objectTag is None or storedTag is None or storedTag == objectTag):
+                # Same image, only the provided faces changed: match them against the stored faces
+                return INDEXED, faceRecords
+            # The image itself changed since it was reindexed
+            return self.reclaim(collectionId, bucket, key, externalImageId, stored, now)
+        raise ImageBusy("Image s3://{}/{} is being reindexed by another delivery".format(bucket, key))
+
+    def reclaim(self, collectionId, bucket, key, externalImageId, storedFingerprint, now):
+        try:
+            self.dynamodb().update_item(
+                TableName=self.tableName,
+                Key={'ImageKey': {'S': imageKey(collectionId, bucket, key, externalImageId)}},
+                UpdateExpression="SET #status = :inProgress, LeaseExpires = :lease REMOVE FaceRecords",
+                ConditionExpression="#status = :done AND Fingerprint = :stored",
+                ExpressionAttributeNames={'#status': 'Status'},
+                ExpressionAttributeValues={':inProgress': {'S': IN_PROGRESS}, ':done': {'S': DONE},
+                                           ':stored': {'S': storedFingerprint},
+                                           ':lease': {'N': self.leaseExpires(now)}}
+            )
+        except self.dynamodb().exceptions.ConditionalCheckFailedException:
+            raise ImageBusy("Image s3://{}/{} is being reindexed by another delivery".format(bucket, key))
+        return IN_PROGRESS, None
+
+    def recordFaces(self, collectionId, bucket, key, externalImageId, faceRecords):
+        faces = compactFaces(faceRecords)
+        self.dynamodb().update_item(
+            TableName=self.tableName,
+            Key={'ImageKey': {'S': imageKey(collectionId, bucket, key, externalImageId)}},
+            UpdateExpression="SET #status = :indexed, FaceRecords = :faces REMOVE LeaseExpires",
+            ExpressionAttributeNames={'#status': 'Status'},
+            ExpressionAttributeValues={':indexed': {'S': INDEXED}, ':faces': {'S': json.dumps(faces)}}
+        )
+
+    def complete(self, collectionId, bucket, key, externalImageId, fingerprint=None, objectTag=None):
+        values = {':done': {'S': DONE}}
+        update = "SET #status = :done"
+        if fingerprint:
+            update += ", Fingerprint = :fingerprint"
+            values[':fingerprint'] = {'S': fingerprint}
+        if objectTag:
+            update += ", ObjectTag = :objectTag"
+            values[':objectTag'] = {'S': objectTag}
+        self.dynamodb().update_item(
+            TableName=self.tableName,
+            Key={'ImageKey': {'S': imageKey(collectionId, bucket, key, externalImageId)}},
+            UpdateExpression=update + " REMOVE LeaseExpires",
+            ExpressionAttributeNames={'#status': 'Status'},
+            ExpressionAttributeValues=values
+        )
+
+    def completedFingerprints(self, images):
+        # images: (collectionId, bucket, key, externalImageId) tuples. Returns {ImageKey: Fingerprint}
+        # of the images that are DONE
+        items = batchGetItems(self.dynamodb(), self.tableName, [imageKey(*image) for image in images], 'ImageKey',
+                              projection="ImageKey, #status, Fingerprint", attributeNames={'#status': 'Status'})
+        return {item['ImageKey']['S']: item.get('Fingerprint', {}).get('S') for item in items
+                if item.get('Status', {}).get('S') == DONE}
@@ -0,0 +1,137 @@
+import io, os, json, hashlib
+from urllib.parse import urlparse
+from instrumentation import metrics, log
+
+# Columnar export of the reindexing results, next to the results table.
+#
+# Every batch written to the results table (StoreResults function, or the ReIndexing function in direct
+# persist mode) is also written as one Parquet part per collection and job:
+#
+#   s3://<exportlocation>/collection=<CollectionId>/job=<job id>/part-<digest>.parquet
+#
+# One row per face: the old -> new FaceId/ImageId mapping, UserID, ExternalImageId, the S3 object, the new
+# bounding box as four float columns and IsNewFace as a boolean, instead of one item per face with the
+# bounding box as a JSON string. The part name is derived from the SQS messages of the batch, so a
+# retried batch overwrites its part; a message delivered again in another batch can leave the same row
+# in two parts, which results_query.py drops when loading or compacting.
+#
+# Needs pyarrow in the function (e.g. the AWS SDK for pandas Lambda layer). Disabled when `exportlocation`
+# is empty.
+
+EXPORT_LOCATION = os.environ.get('exportlocation', '')
+COMPRESSION = 'zstd'
+NOT_REINDEXED = 'Not reindexed'
+
+COLUMNS = [
+    ('OldFaceId', 'string'), ('FaceId', 'string'), ('OldImageId', 'string'), ('ImageId', 'string'),
+    ('UserID', 'string'), ('ExternalImageId', 'string'), ('Bucket', 'string'), ('Key', 'string'),
+    ('Width', 'float32'), ('Height', 'float32'), ('Left', 'float32'), ('Top', 'float32'),
+    ('IsNewFace', 'bool_'),
+]
+
+
+def arrowSchema():
+    import pyarrow
+    return pyarrow.schema([(name, getattr(pyarrow, kind)()) for name, kind in COLUMNS])
+
+
+def jobOf(executionId):
+    # Executions started by the launcher are named <job id>-<n>; the parallel executions of a job share
+    # one partition. Executions started by hand keep their own name.
+    if not executionId:
+        return 'unknown'
+    name = executionId.rsplit(':', 1)[-1]
+    job, _, number = name.rpartition('-')
+    return job if job.startswith('job-') and number.isdigit() else name
+
+
+def exportRows(payload):
+    rows = []
+    for face in payload["Faces"]:
+        box = face.get("BoundingBoxes")
+        box = box if isinstance(box, dict) else {}
+        isNewFace = face.get("IsNewFace")
+        rows.append({
+            'OldFaceId': str(face["OldFaceId"]),
+            'FaceId': str(face["FaceId"]),
+            'OldImageId': str(face["OldImageId"]),
+            'ImageId': str(face["ImageId"]),
+            'UserID': str(face["UserID"]),
+            'ExternalImageId': str(payload["ExternalImageId"]),
+            'Bucket': str(payload["Bucket"]),
+            'Key': str(payload["Key"]),
+            # Faces that could not be reindexed have no bounding box
+            'Width': box.get("Width"),
+            'Height': box.get("Height"),
+            'Left': box.get("Left"),
+            'Top': box.get("Top"),
+            'IsNewFace': isNewFace if isinstance(isNewFace, bool) else None,
+        })
+    for duplicate in payload.get("Duplicates", []):
+        rows.extend(exportRows(duplicate))
+    return rows
+
+
+def parquetBytes(rows):
+    import pyarrow, pyarrow.parquet
+    table = pyarrow.Table.from_pylist(rows, schema=arrowSchema())
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(table, buffer, compression=COMPRESSION)
+    return buffer.getvalue()
+
+
+class ResultsExporter:
+    # Collects the results of a batch per (collection, job) partition and writes them with flush()
+
+    def __init__(self, location, client):
+        parsed = urlparse(location)
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.lstrip('/')
+        if self.prefix and not self.prefix.endswith('/'):
+            self.prefix += '/'
+        self.client = client
+        self.partitions = {}  # (collection, job) -> ([rows], set of messageIds)
+        self.available = None
+
+    def add(self, messageId, payload):
+        partition = (str(payload.get("CollectionId", 'unknown')), jobOf(payload.get("ExecutionId")))
+        rows, messages = self.partitions.setdefault(partition, ([], set()))
+        rows.extend(exportRows(payload))
+        messages.add(messageId)
+
+    def partKey(self, collection, job, messages):
+        digest = hashlib.sha256(json.dumps(sorted(messages)).encode('utf-8')).hexdigest()[:20]
+        return "{}collection={}/job={}/part-{}.parquet".format(self.prefix, collection, job, digest)
+
+    def flush(self):
+        # Returns the set of messageIds whose rows could not be written
+        partitions, self.partitions = self.partitions, {}
+        if not partitions:
+            return set()
+        if self.available is None:
+            try:
+                import pyarrow.parquet
+                self.available = True
+            except ImportError:
+                self.available = False
+        if not self.available:
+            # A deployment problem, not something retrying the messages would fix
+            log("pyarrow is not available, results are not exported", sampled=False, location=self.bucket)
+            metrics.add("ExportSkippedRows", sum(len(rows) for rows, _ in partitions.values()))
+            return set()
+
+        failed = set()
+        for (collection, job), (rows, messages) in partitions.items():
+            if not rows:
+                continue
+            key = self.partKey(collection, job, messages)
+            try:
+                body = parquetBytes(rows)
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=body)
+                metrics.add("ExportedRows", len(rows))
+                metrics.add("ExportedBytes", len(body), "Bytes")
+            except Exception as e:
+                log("Error exporting results", sampled=False, key=key, error=str(e))
+                metrics.add("ExportErrors")
+                failed.update(messages)
+        return failed
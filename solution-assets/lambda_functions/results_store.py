@@ -0,0 +1,133 @@
+import json, time, random, threading
+from instrumentation import log
+
+# Results table items and the buffered BatchWriteItem writer shared by the StoreResults function
+# (lambda_dynamo) and the ReIndexing function in direct persist mode. batchWriteItems is also the
+# write loop of the error logs (log_sink), so both tables retry and back off the same way.
+
+BATCH_WRITE_LIMIT = 25  # BatchWriteItem hard limit per call
+MAX_RETRIES = 8
+BACKOFF_BASE = 0.05
+BACKOFF_CAP = 2.0
+
+
+def buildDynamoItems(payload):
+    items = []
+    for face in payload["Faces"]:
+        dynamoitem = {
+            'Bucket': {'S': str(payload["Bucket"])},
+            'Key': {'S': str(payload["Key"])},
+            'ExternalImageId': {'S': str(payload["ExternalImageId"])},
+            'UserID': {'S': str(face["UserID"])},
+            'FaceId': {'S': str(face["FaceId"])},
+            'OldFaceId': {'S': str(face["OldFaceId"])},
+            'OldImageId': {'S': str(face["OldImageId"])},
+            'ImageId': {'S': str(face["ImageId"])},
+            'BoundingBoxes':{'S': json.dumps(face["BoundingBoxes"])}
+        }
+
+        if "IsNewFace" in face:
+            dynamoitem.update({'IsNewFace':{'S': str(face["IsNewFace"])}})
+
+        items.append(dynamoitem)
+
+    # Results of the records that shared the IndexFaces call of this one (duplicate images)
+    for duplicate in payload.get("Duplicates", []):
+        items.extend(buildDynamoItems(duplicate))
+    return items
+
+
+def backoff(attempt):
+    # Full jitter exponential backoff
+    time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt))))
+
+
+def batchWriteItems(client, tableName, items):
+    # BatchWriteItem for a list of items, 25 per call, retrying unprocessed items (and failed calls)
+    # with full jitter backoff. Returns the items still unwritten after MAX_RETRIES and the number of calls.
+    unwritten, roundTrips = [], 0
+    for i in range(0, len(items), BATCH_WRITE_LIMIT):
+        requests = [{'PutRequest': {'Item': item}} for item in items[i:i + BATCH_WRITE_LIMIT]]
+        attempt = 0
+        while requests:
+            try:
+                roundTrips += 1
+                response = client.batch_write_item(RequestItems={tableName: requests})
+                requests = response.get('UnprocessedItems', {}).get(tableName, [])
+            except Exception as e:
+                log("Error while writing batch to DynamoDB", sampled=False, table=tableName, error=str(e))
+            if not requests:
+                break
+            if attempt >= MAX_RETRIES:
+                log("Unprocessed items after retries", sampled=False, table=tableName, retries=MAX_RETRIES, items=len(requests))
+                unwritten.extend(request['PutRequest']['Item'] for request in requests)
+                break
+            backoff(attempt)
+            attempt += 1
+    return unwritten, roundTrips
+
+
+class BatchWriter:
+    # Buffers face items from every record in the SQS batch and flushes them with BatchWriteItem.
+    # Items are keyed by the table hash key (OldFaceId): BatchWriteItem rejects duplicate keys in a
+    # single call, so a later put for the same key replaces the earlier one, same as sequential put_item.
+
+    def __init__(self, tableName, client, hashKey='OldFaceId'):
+        self.tableName = tableName
+        self.client = client
+        self.hashKey = hashKey
+        self.pending = {}  # key -> item
+        self.owners = {}  # key -> set of SQS messageIds that wrote this key
+        self.lock = threading.Lock()
+        self.roundTrips = 0
+
+    def add(self, messageId, item):
+        key = item[self.hashKey]['S']
+        with self.lock:
+            self.pending[key] = item
+            self.owners.setdefault(key, set()).add(messageId)
+
+    def flush(self):
+        # Returns the set of messageIds whose items could not be written
+        unwritten, roundTrips = batchWriteItems(self.client, self.tableName, list(self.pending.values()))
+        self.roundTrips += roundTrips
+        failedKeys = [item[self.hashKey]['S'] for item in unwritten]
+
+        failedMessages = set()
+        for key in failedKeys:
+            failedMessages.update(self.owners[key])
+        self.pending = {}
+        self.owners = {}
+        return failedMessages
+
+
+BATCH_GET_LIMIT = 100  # BatchGetItem hard limit per call
+
+
+def batchGetItems(client, tableName, keys, hashKey, projection=None, attributeNames=None):
+    # BatchGetItem for a list of string hash keys, 100 per call, retrying unprocessed keys
+    found = []
+    keys = list(dict.fromkeys(keys))
+    for i in range(0, len(keys), BATCH_GET_LIMIT):
+        request = {tableName: {
+            'Keys': [{hashKey: {'S': key}} for key in keys[i:i + BATCH_GET_LIMIT]],
+            'ProjectionExpression': projection or hashKey
+        }}
+        if attributeNames:
+            request[tableName]['ExpressionAttributeNames'] = attributeNames
+        attempt = 0
+        while request:
+            response = client.batch_get_item(RequestItems=request)
+            found.extend(response.get('Responses', {}).get(tableName, []))
+            request = response.get('UnprocessedKeys')
+            if request:
+                if attempt >= MAX_RETRIES:
+                    raise RuntimeError("Unprocessed keys after {} retries".format(MAX_RETRIES))
+                backoff(attempt)
+                attempt += 1
+    return found
+
+
+def storedFaceIds(client, tableName, oldFaceIds, hashKey='OldFaceId'):
+    # Returns the subset of oldFaceIds that already have a row in the results table
+    return {item[hashKey]['S'] for item in batchGetItems(client, tableName, oldFaceIds, hashKey)}
@@ -0,0 +1,226 @@
+# Bloom-filter index of the non-empty objects in a bucket, used to validate manifest records
+# without one HeadObject per record.
+#
+# The index is built once from ListObjectsV2 (or an S3 Inventory manifest) and stored in S3 as a
+# single artifact: a JSON header line followed by the filter bits. Zero-byte objects are left out
+# of the filter, so a key that is in the filter exists and is non-empty (up to the configured
+# false-positive rate). Keys that are not in the filter are either missing, empty or newer than
+# the snapshot, and are checked with HeadObject.
+#
+# A hit is not checked with HeadObject: a false positive (about error_rate of the missing keys) or
+# an object deleted after the snapshot passes validation and fails later in IndexFaces. Rebuild the
+# index after deleting objects. If the index cannot be read, every key is checked with HeadObject.
+#
+# Build an index:
+#   python s3_index.py --bucket photos --prefix faces/ --expected-keys 20000000 \
+#       --index-location s3://my-records-bucket/s3-index/
+#   python s3_index.py --bucket photos --inventory-manifest s3://inventory-bucket/photos/daily/2024-01-01T00-00Z/manifest.json \
+#       --expected-keys 20000000 --index-location s3://my-records-bucket/s3-index/
+
+import argparse, csv, gzip, hashlib, io, json, math, threading, time
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus, urlparse
+from instrumentation import log
+
+INDEX_SUFFIX = ".bloom"
+CACHE_SECONDS = 900
+
+
+class BloomFilter:
+
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        # A loaded filter keeps a read-only view of the downloaded artifact instead of a copy
+        self.data = data if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        hashes = max(1, int(round(bits / capacity * math.log(2))))
+        return cls(bits, hashes)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        data = self.data
+        return all(data[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class S3Index:
+    # Filter plus the metadata of the snapshot it was built from
+
+    def __init__(self, bucket, prefixes, snapshot, count, bloom):
+        self.bucket = bucket
+        self.prefixes = prefixes
+        self.snapshot = snapshot
+        self.count = count
+        self.bloom = bloom
+
+    def covers(self, key):
+        return not self.prefixes or any(key.startswith(prefix) for prefix in self.prefixes)
+
+    def __contains__(self, key):
+        return key in self.bloom
+
+    def serialize(self):
+        header = {"bucket": self.bucket, "prefixes": self.prefixes, "snapshot": self.snapshot,
+                  "count": self.count, "bits": self.bloom.bits, "hashes": self.bloom.hashes}
+        return json.dumps(header).encode("utf-8") + b"\n" + bytes(self.bloom.data)
+
+    @classmethod
+    def deserialize(cls, body):
+        # The filter bits are read in place after the header line: a filter of tens of MB is held
+        # once, as the response body
+        offset = body.index(b"\n") + 1
+        header = json.loads(body[:offset])
+        data = memoryview(body)[offset:]
+        if len(data) < (header["bits"] + 7) // 8:
+            raise ValueError("Index truncated: {} of {} bytes".format(len(data), (header["bits"] + 7) // 8))
+        bloom = BloomFilter(header["bits"], header["hashes"], data)
+        return cls(header["bucket"], header["prefixes"], header["snapshot"], header["count"], bloom)
+
+
+def index_key(location, bucket):
+    # s3://records-bucket/s3-index/ + photos -> (records-bucket, s3-index/photos.bloom)
+    parsed = urlparse(location)
+    prefix = parsed.path.lstrip("/")
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    return parsed.netloc, "{}{}{}".format(prefix, bucket, INDEX_SUFFIX)
+
+
+def iter_list_objects(s3_client, bucket, prefixes):
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for prefix in prefixes or [""]:
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"], obj["Size"]
+
+
+def iter_inventory(s3_client, manifest_location):
+    # S3 Inventory (CSV): manifest.json lists gzipped CSV files described by fileSchema
+    parsed = urlparse(manifest_location)
+    manifest = json.loads(s3_client.get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip("/"))["Body"].read())
+    if manifest.get("fileFormat", "CSV") != "CSV":
+        raise ValueError("Only CSV inventory reports are supported, got {}".format(manifest.get("fileFormat")))
+    schema = [field.strip() for field in manifest["fileSchema"].split(",")]
+    key_field, size_field = schema.index("Key"), schema.index("Size")
+    destination = manifest["destinationBucket"].split(":::")[-1]
+    for inventory_file in manifest["files"]:
+        body = s3_client.get_object(Bucket=destination, Key=inventory_file["key"])["Body"]
+        with gzip.GzipFile(fileobj=body) as compressed:
+            for row in csv.reader(io.TextIOWrapper(compressed, encoding="utf-8")):
+                size = row[size_field]
+                yield unquote_plus(row[key_field]), int(size) if size else 0
+
+
+def build_index(objects, bucket, prefixes, expected_keys, error_rate=0.01):
+    snapshot = datetime.now(timezone.utc).isoformat()
+    bloom = BloomFilter.for_capacity(expected_keys, error_rate)
+    count = 0
+    for key, size in objects:
+        if size > 0:
+            bloom.add(key)
+            count += 1
+    return S3Index(bucket, prefixes or [], snapshot, count, bloom)
+
+
+def save_index(s3_client, index, location):
+    index_bucket, key = index_key(location, index.bucket)
+    s3_client.put_object(Bucket=index_bucket, Key=key, Body=index.serialize())
+    return index_bucket, key
+
+
+def load_index(s3_client, location, bucket):
+    index_bucket, key = index_key(location, bucket)
+    try:
+        body = s3_client.get_object(Bucket=index_bucket, Key=key)["Body"].read()
+        return S3Index.deserialize(body)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        # Access denied, throttled or corrupt: validate with HeadObject instead of failing the batch
+        log("Error while loading the S3 index, using HeadObject", sampled=False, bucket=index_bucket, key=key, error=str(e))
+        return None
+
+
+class IndexedValidator:
+    # Wraps a HeadObject based validate_s3(bucket, key) function. Indexes are loaded lazily per
+    # bucket and kept for CACHE_SECONDS, so warm Lambda invocations reuse them.
+
+    def __init__(self, s3_client, location, head_validate):
+        self.s3_client = s3_client
+        self.location = location
+        self.head_validate = head_validate
+        self.indexes = {}
+        self.head_checks = 0
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def index_for(self, bucket):
+        # Validation runs in a thread pool: load each index once, not once per thread. The download
+        # runs under a per-bucket lock, and while one thread refreshes an expired index the others
+        # keep using the old one
+        with self.lock:
+            cached = self.indexes.get(bucket)
+            loading = self.loading.setdefault(bucket, threading.Lock())
+        if cached is not None and time.monotonic() - cached[0] <= CACHE_SECONDS:
+            return cached[1]
+        if not loading.acquire(blocking=cached is None):
+            return cached[1]
+        try:
+            with self.lock:
+                cached = self.indexes.get(bucket)
+            if cached is None or time.monotonic() - cached[0] > CACHE_SECONDS:
+                cached = (time.monotonic(), load_index(self.s3_client, self.location, bucket))
+                with self.lock:
+                    self.indexes[bucket] = cached
+            return cached[1]
+        finally:
+            loading.release()
+
+    def validate(self, bucket, key):
+        index = self.index_for(bucket)
+        if index is not None and index.covers(key) and key in index:
+            return True, None
+        # Missing, empty, or created after the snapshot: ask S3
+        self.head_checks += 1
+        return self.head_validate(bucket, key)
+
+
+def main():
+    import boto3
+
+    parser = argparse.ArgumentParser(description="Build a Bloom-filter index of the non-empty objects in a bucket")
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--prefix", action="append", default=[], help="Only index keys under this prefix (repeatable)")
+    parser.add_argument("--inventory-manifest", help="s3:// URI of an S3 Inventory manifest.json to read instead of ListObjectsV2")
+    parser.add_argument("--expected-keys", type=int, required=True)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--index-location", required=True, help="s3:// prefix where the index artifact is stored")
+    args = parser.parse_args()
+
+    s3_client = boto3.client("s3")
+    if args.inventory_manifest:
+        objects = ((key, size) for key, size in iter_inventory(s3_client, args.inventory_manifest)
+                   if not args.prefix or any(key.startswith(prefix) for prefix in args.prefix))
+    else:
+        objects = iter_list_objects(s3_client, args.bucket, args.prefix)
+
+    index = build_index(objects, args.bucket, args.prefix, args.expected_keys, args.error_rate)
+    index_bucket, key = save_index(s3_client, index, args.index_location)
+    print("Indexed {} non-empty objects ({} KiB) -> s3://{}/{}".format(index.count, len(index.bloom.data) // 1024, index_bucket, key))
+
+
+if __name__ == "__main__":
+    main()